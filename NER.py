@@ -4,6 +4,9 @@ from spacy.tokens import Doc
 import streamlit as st
 import random
 
+from session_store import render_debug_panel, session_store
+from tagger import TAGS, encode_tags
+
 # Load the model
 try:
     model = joblib.load("model/model.joblib")
@@ -49,7 +52,8 @@ def tokens_to_features(tokens, i):
 
     return features
 
-def parse_and_visualize(text, selected_entities, highlighted_words=None):
+def predict(text):
+    # Compact prediction kept per session: tokens and int8 tag codes, no HTML
     try:
         tokens = text.split()
         features = [tokens_to_features(tokens, i) for i in range(len(tokens))]
@@ -58,44 +62,51 @@ def parse_and_visualize(text, selected_entities, highlighted_words=None):
             raise ValueError("Model is not loaded.")
         
         predictions = model.predict([features])[0]
-
-        # Define colors for each label and highlighted words
-        label_colors = {
-            "O": "#FFC0CB",
-            "ADDR": "#ADD8E6",
-            "LOC": "#fdffb6",
-            "POST": "#9ce7d5"
-        }
-        highlight_color = "#FFD700"  # Gold for highlighted words
-
-        # Initialize HTML output
-        html_output = '<div style="font-family: sans-serif; text-align: left; line-height: 1.5;">'
-        
-        for i, token in enumerate(tokens):
-            label = predictions[i]
-            label_color = label_colors.get(label, "#ffffff")  # Default to white if no color is assigned
-            
-            # Set color to highlight_color if the token is in highlighted_words
-            color = highlight_color if highlighted_words and token in highlighted_words else label_color
-
-            if label in selected_entities:
-                html_output += f'<div style="display: inline-block; margin: 0 5px; text-align: center; border: 1px solid {color}; background-color: {color}; padding: 5px; border-radius: 5px;">'
-                html_output += f'<div style="color: black; padding: 2px 5px; margin-top: 2px; border-radius: 3px;">{token}</div>'
-                html_output += f'<div style="background-color: white; color: #6D6875; padding: 2px 5px; margin-top: 2px; border-radius: 3px; font-weight: bold;">{label}</div>'
-                html_output += '</div>'
-            else:
-                html_output += f'<div style="display: inline-block; margin: 0 5px; text-align: center; padding: 5px;">'
-                html_output += f'<div>{token}</div>'
-                html_output += '</div>'
-        
-        html_output += '</div>'
-        
-        # Display the final HTML output with highlighted colors
-        return html_output
+        return tokens, encode_tags(predictions)
 
     except Exception as e:
         st.error(f"NER processing error: {e}")
+        return None
+
+
+def render_html(prediction, selected_entities, highlighted_words=None):
+    if prediction is None:
         return ""
+    tokens, tags = prediction
+
+    # Define colors for each label and highlighted words
+    label_colors = {
+        "O": "#FFC0CB",
+        "ADDR": "#ADD8E6",
+        "LOC": "#fdffb6",
+        "POST": "#9ce7d5"
+    }
+    highlight_color = "#FFD700"  # Gold for highlighted words
+
+    # Initialize HTML output
+    html_output = '<div style="font-family: sans-serif; text-align: left; line-height: 1.5;">'
+    
+    for token, code in zip(tokens, tags):
+        label = TAGS[code]
+        label_color = label_colors.get(label, "#ffffff")  # Default to white if no color is assigned
+        
+        # Set color to highlight_color if the token is in highlighted_words
+        color = highlight_color if highlighted_words and token in highlighted_words else label_color
+
+        if label in selected_entities:
+            html_output += f'<div style="display: inline-block; margin: 0 5px; text-align: center; border: 1px solid {color}; background-color: {color}; padding: 5px; border-radius: 5px;">'
+            html_output += f'<div style="color: black; padding: 2px 5px; margin-top: 2px; border-radius: 3px;">{token}</div>'
+            html_output += f'<div style="background-color: white; color: #6D6875; padding: 2px 5px; margin-top: 2px; border-radius: 3px; font-weight: bold;">{label}</div>'
+            html_output += '</div>'
+        else:
+            html_output += f'<div style="display: inline-block; margin: 0 5px; text-align: center; padding: 5px;">'
+            html_output += f'<div>{token}</div>'
+            html_output += '</div>'
+    
+    html_output += '</div>'
+    
+    # Display the final HTML output with highlighted colors
+    return html_output
 
 
 def shuffle_text(text):
@@ -111,15 +122,14 @@ st.title("Named Entity Recognition (NER)")
 # Text area input for user
 text_input = st.text_area("Enter text here:", "")
 
+# Predictions live in the session store under a per-session byte budget;
+# HTML is rendered from them on every run instead of being kept around
+session = session_store.session()
+
 # Function to update NER output based on selected entities
 def update_all_outputs():
-    if text_input:
-        # Update both main NER output and shuffled outputs when entities are changed
-        st.session_state.ner_output = parse_and_visualize(text_input, st.session_state.selected_entities)
-        st.session_state.shuffled_outputs = [
-            parse_and_visualize(shuffle_text(text_input), st.session_state.selected_entities)
-            for _ in range(5)
-        ]
+    # Stored predictions are re-rendered with the new entities below
+    st.session_state.highlight_main = False
 
 # Custom CSS for sidebar styling
 st.markdown(
@@ -156,34 +166,32 @@ st.sidebar.multiselect(
 
 # Adjusted function to update main output with highlighted words after shuffle
 def update_highlighted_words_output():
-    if text_input:
-        st.session_state.ner_output = parse_and_visualize(text_input, st.session_state.selected_entities, st.session_state.highlighted_words)
+    st.session_state.highlight_main = True
 
 
 # Modify the shuffle logic to show the highlighted words selection after shuffling
 with st.container():
     if st.button("Analyze") and text_input:
-        st.session_state.ner_output = parse_and_visualize(text_input, st.session_state.selected_entities)
+        session.put("ner_prediction", predict(text_input))
+        st.session_state.highlight_main = False
         st.session_state.show_shuffle = True  # Enable Shuffle button
 
     if st.session_state.get("show_shuffle", False):
         if st.button("Shuffle"):
-            st.session_state.shuffled_outputs = [
-                parse_and_visualize(shuffle_text(text_input), st.session_state.selected_entities)
-                for _ in range(5)
-            ]
+            session.put("shuffled_predictions", [predict(shuffle_text(text_input)) for _ in range(5)])
             st.session_state.show_shuffled_outputs = True  # Enable display of shuffled outputs and highlighted words selection
 
 # Display main NER output and shuffled text outputs
-if "ner_output" in st.session_state:
-    st.markdown(st.session_state.ner_output, unsafe_allow_html=True)
+if "ner_prediction" in session:
+    highlighted_words = st.session_state.get("highlighted_words") if st.session_state.get("highlight_main") else None
+    st.markdown(render_html(session.get("ner_prediction"), st.session_state.selected_entities, highlighted_words), unsafe_allow_html=True)
     st.write("-------")
 
 # Display the shuffled texts if Shuffle button has been pressed
-if st.session_state.get("show_shuffled_outputs", False):
-    for i, shuffled_output in enumerate(st.session_state.shuffled_outputs, 1):
+if st.session_state.get("show_shuffled_outputs", False) and "shuffled_predictions" in session:
+    for i, shuffled_prediction in enumerate(session.get("shuffled_predictions"), 1):
         st.write(f"Shuffled Text {i}:")
-        st.markdown(shuffled_output, unsafe_allow_html=True)
+        st.markdown(render_html(shuffled_prediction, st.session_state.selected_entities), unsafe_allow_html=True)
         st.write("-------")
 
     # Sidebar selection for highlighted words (shown only after shuffle)
@@ -194,4 +202,6 @@ if st.session_state.get("show_shuffled_outputs", False):
         default=original_words,
     key="highlighted_words",
     on_change=update_highlighted_words_output
-)
\ No newline at end of file
+)
+
+render_debug_panel(st.sidebar)
@@ -0,0 +1,74 @@
+import streamlit as st
+
+from registry import ModelRegistry, disagreements, tag_with_models
+from tagger import TAGS
+from tokenization import span_tokens, tokenize_spans
+
+TAG_COLORS = {
+    "O": "#FFC0CB",
+    "ADDR": "#F7E8A4",
+    "LOC": "#ADD8E6",
+    "POST": "#4DC9B0"
+}
+DISAGREE_COLOR = "#E63946"
+
+
+# One registry per server process; models are loaded on first use and shared by sessions
+@st.cache_resource
+def get_registry():
+    return ModelRegistry()
+
+
+def comparison_html(tokens, labels, codes, disagree) -> str:
+    # One row per model, one column per token; columns where the models disagree are outlined
+    html = '<table style="font-family: sans-serif; border-collapse: separate; border-spacing: 4px;">'
+    html += '<tr><th></th>'
+    for i, token in enumerate(tokens):
+        weight = 'bold' if disagree[i] else 'normal'
+        html += f'<th style="text-align: center; font-weight: {weight};">{token}</th>'
+    html += '</tr>'
+    for label, row in zip(labels, codes):
+        html += f'<tr><td style="padding-right: 8px; white-space: nowrap;">{label}</td>'
+        for i, code in enumerate(row):
+            tag = TAGS[code]
+            border = f'2px solid {DISAGREE_COLOR}' if disagree[i] else '2px solid transparent'
+            html += (
+                f'<td style="text-align: center; background-color: {TAG_COLORS[tag]}; border: {border}; '
+                f'border-radius: 5px; padding: 4px 8px; color: black;">{tag}</td>'
+            )
+        html += '</tr>'
+    html += '</table>'
+    return html
+
+
+st.set_page_config(layout="wide")
+st.title("[Model comparison] - Do the models agree ?")
+
+registry = get_registry()
+entries = registry.scan()
+labels = {entry.digest: entry.label for entry in entries}
+
+text = st.text_input("Text Input:", value='นายสมชาย เข็มกลัด 254 ถนน พญาไท แขวง วังใหม่ เขต ปทุมวัน กรุงเทพ 10330')
+selected = st.multiselect(
+    "Models",
+    options=list(labels),
+    default=list(labels)[:3],
+    format_func=labels.get,
+)
+
+if len(selected) < 2:
+    st.info(f"Pick at least two models. Put more `.joblib` files in `{registry.directory}/` to compare them.")
+elif text:
+    tokens = span_tokens(text, tokenize_spans(text))
+    # All selected models tag the same feature batch
+    codes = tag_with_models([registry.get(digest) for digest in selected], [tokens])[0]
+    disagree = disagreements(codes)
+
+    st.markdown(comparison_html(tokens, [labels[digest] for digest in selected], codes, disagree), unsafe_allow_html=True)
+    st.write(f"{int(disagree.sum())} of {len(tokens)} tokens disagree")
+
+with st.sidebar.expander("Debug"):
+    st.caption(
+        f"{len(registry.loaded)} of {len(entries)} models loaded, "
+        f"{registry.nbytes / 2 ** 20:.1f} of {registry.memory_cap / 2 ** 20:.0f} MB, {registry.evictions} evicted"
+    )
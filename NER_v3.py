@@ -1,56 +1,57 @@
-import joblib
+import os
 import spacy
 from spacy.tokens import Doc
 import streamlit as st
-import matplotlib.pyplot as plt
 from collections import Counter
 import random
+import time
 import numpy as np
 import pandas as pd
-import plotly.express as px
 
+from charts import stacked_percentage_figure, tag_heatmap_figure
+from corrections import CorrectionStore
+from decoding import NBestDecoder, alternatives
+from perturbations import PERTURBATION_KINDS, run_perturbations
+from results import ShuffleResults
+from review import REVIEW_QUEUE_PATH, read_review_queue
+from registry import content_hash
+from session_store import render_debug_panel, session_store
+from shuffles import SHUFFLE_STRATEGIES, shuffle_orders
+from telemetry import TELEMETRY_DIR, FileSink, Telemetry, known_words, summarize_window
+from tagger import MODEL_PATH, TAGS, encode_tags, load_model, sequence_features, tokens_to_features
+from tokenization import tokenize_spans, span_tokens, permute, original_spans
+from weights import explain, load_weight_table
 
-model = joblib.load('model/model.joblib')
 
-stopwords = ["ผู้", "ที่", "ซึ่ง", "อัน"]
+# The weight table behind the explanations is indexed once per model, not per rerun
+@st.cache_resource
+def load_model_and_weights():
+    model = load_model()
+    # Stored with every correction, so retraining knows which model got it wrong
+    return model, load_weight_table(model), content_hash(MODEL_PATH)
+
+
+model, weight_table, model_digest = load_model_and_weights()
+correction_store = CorrectionStore()
+
+
+# One telemetry buffer per server process, shared by every session
+@st.cache_resource
+def get_telemetry():
+    return Telemetry(known_words(weight_table), FileSink(f"{TELEMETRY_DIR}/ner_v3.jsonl"))
+
+
+telemetry = get_telemetry()
+nbest_decoder = NBestDecoder(weight_table, k=5)
 
 N_SHUFFLE = 5
+# The what-if tab tags every shuffle up front but renders a page of sentences at a time
+SHUFFLE_COUNTS = [5, 20, 100, 500, 1000]
+SHUFFLE_PAGE_SIZE = 10
+REVIEW_PAGE_SIZE = 10
 N_SHUFFLE_SUMMARY = 100
 
 
-def tokens_to_features(tokens, i):
-    word = tokens[i]
-    features = {
-        "bias": 1.0,
-        "word.word": word,
-        "word[:3]": word[:3],
-        "word.isspace()": word.isspace(),
-        "word.is_stopword()": word in stopwords,
-        "word.isdigit()": word.isdigit(),
-        "word.islen5": word.isdigit() and len(word) == 5
-    }
-    if i > 0:
-        prevword = tokens[i - 1]
-        features.update({
-            "-1.word.prevword": prevword,
-            "-1.word.isspace()": prevword.isspace(),
-            "-1.word.is_stopword()": prevword in stopwords,
-            "-1.word.isdigit()": prevword.isdigit(),
-        })
-    else:
-        features["BOS"] = True
-    if i < len(tokens) - 1:
-        nextword = tokens[i + 1]
-        features.update({
-            "+1.word.nextword": nextword,
-            "+1.word.isspace()": nextword.isspace(),
-            "+1.word.is_stopword()": nextword in stopwords,
-            "+1.word.isdigit()": nextword.isdigit(),
-        })
-    else:
-        features["EOS"] = True
-    return features
-
 TAG_COLORS = {
     "O": "#99ff99",
     "ADDR": "#ffadad",
@@ -130,10 +131,16 @@ def create_token_tag_version_dear(token: str, entity_label: str = None) -> str:
 
 create_token_tag = create_token_tag_version_dear
     
-def parse(text: str):
-    tokens = text.split()
+def parse_tokens(tokens):
+    started = time.perf_counter()
     features = [tokens_to_features(tokens, i) for i in range(len(tokens))]
     predictions = model.predict([features])[0]
+    telemetry.record(tokens, predictions, time.perf_counter() - started)
+    return predictions
+
+def parse(text: str):
+    tokens = span_tokens(text, tokenize_spans(text))
+    predictions = parse_tokens(tokens)
     return tokens, predictions
 
 def make_result_df(tokens, predictions):
@@ -143,11 +150,49 @@ def make_result_df(tokens, predictions):
         'tag': predictions,
     })
 
-def parse_and_visualize(text, selected_entities, highlighted_words, is_initial=False):
+def explanation_markdown(explanation) -> str:
+    lines = [f"**{explanation.label}** rather than **{explanation.runner_up_label}**", ""]
+    if explanation.transition is not None:
+        lines += [
+            f"transition into {explanation.label}: {explanation.transition:+.2f}, "
+            f"into {explanation.runner_up_label}: {explanation.runner_up_transition:+.2f}",
+            "",
+        ]
+    lines += [f"| feature | {explanation.label} | {explanation.runner_up_label} |", "|---|---:|---:|"]
+    for attribute, weight, runner_up_weight in explanation.features:
+        # Some attributes end in a newline token; pipes would split the table cell
+        attribute = attribute.replace("\n", "\\n").replace("|", "\\|")
+        lines.append(f"| `{attribute}` | {weight:+.2f} | {runner_up_weight:+.2f} |")
+    return "\n".join(lines)
+
+def original_text_markdown(text: str, spans, order, tags, highlighted_words) -> str:
+    # The original text, each highlighted word marked where it stands in it with
+    # the tag it got at its shuffled position
+    pieces = []
+    cursor = 0
+    for (start, end), code in sorted(zip(original_spans(spans, order).tolist(), tags.tolist())):
+        if text[start:end] not in highlighted_words:
+            continue
+        color = TAG_COLORS_VERSION_DEAR[TAGS[code]]
+        pieces += [text[cursor:start], f"<span style='background-color: {color};'>{text[start:end]}</span>"]
+        cursor = end
+    pieces.append(text[cursor:])
+    return ''.join(pieces)
+
+def parse_and_visualize(tokens, selected_entities, highlighted_words, is_initial=False, explain_tokens=False,
+                        predictions=None):
     # tokens = text.split()
     # features = [tokens_to_features(tokens, i) for i in range(len(tokens))]
     # predictions = model.predict([features])[0]
-    tokens, predictions = parse(text)
+    if predictions is not None:
+        # Already tagged, e.g. a page of ShuffleResults
+        pass
+    elif explain_tokens:
+        features = sequence_features(tokens)
+        predictions = model.predict_single(features)
+        explanations = explain(weight_table, features, encode_tags(predictions))
+    else:
+        predictions = parse_tokens(tokens)
 
     nlp = spacy.blank("th")
     doc = Doc(nlp.vocab, words=tokens)
@@ -178,17 +223,30 @@ def parse_and_visualize(text, selected_entities, highlighted_words, is_initial=F
                 token_tag = create_token_tag(token.text)
 
         columns[i].markdown(token_tag, unsafe_allow_html=True)
+        if explain_tokens:
+            columns[i].popover('Why ?', use_container_width=True).markdown(explanation_markdown(explanations[i]))
         
     return result_df
 
 
-def shuffle_text(text, seed: int = 7):
-    words = text.split()
-    # print('words', words)
-    # random.shuffle(words)
-    np.random.RandomState(seed).shuffle(words)
-    # print('shuffled words', words)
-    return ' '.join(words)
+# Reloaded whenever batch.py rewrites the file
+@st.cache_data
+def load_review_queue(path: str, modified: float):
+    return read_review_queue(path)
+
+
+def reset_shuffles():
+    # Shuffle orders index the tokens they were made from; a new text needs new ones
+    st.session_state.show_word_selection = False
+    session.pop('shuffle_results')
+
+
+def open_review_item(text: str):
+    # Runs before the rerun, so the text input can still be set
+    st.session_state.text_input = text
+    st.session_state.is_analyzed = True
+    reset_shuffles()
+
 
 def create_dataframe_result(data):
     df_result_counter = pd.DataFrame.from_dict(data, orient='index').reset_index()
@@ -196,26 +254,57 @@ def create_dataframe_result(data):
     return df_result_counter
 
 st.set_page_config(layout="wide")
+# Shuffle orders are kept in the session store, under a per-session byte budget
+session = session_store.session()
 # สร้าง UI
 st.title("[What if analysis] - If the address is SHUFFLED !")
 
 text_input_section, submit_button = st.columns(spec=[0.8, 0.2], vertical_alignment='bottom')
 with text_input_section:
     # Input text
-    text = st.text_input("Text Input:", value='นายสมชาย เข็มกลัด 254 ถนน พญาไท แขวง วังใหม่ เขต ปทุมวัน กรุงเทพ 10330')
+    st.session_state.setdefault('text_input', 'นายสมชาย เข็มกลัด 254 ถนน พญาไท แขวง วังใหม่ เขต ปทุมวัน กรุงเทพ 10330')
+    text = st.text_input("Text Input:", key='text_input', on_change=reset_shuffles)
 with submit_button:
     # Analyze
     if st.button("Analyze !"):
     # if text:
         st.session_state.is_analyzed = True
         st.session_state.show_word_selection = False   
-        st.session_state.shuffled_texts = []
+        session.pop('shuffle_results')
+
+with st.expander('Review queue'):
+    review_path = st.text_input('Queue file', value=REVIEW_QUEUE_PATH,
+                                help='Least confident records, written by `python batch.py ... --review-queue`')
+    review_queue = load_review_queue(review_path, os.path.getmtime(review_path)) if os.path.exists(review_path) else []
+    if not review_queue:
+        st.caption(f'Nothing to review: run `python batch.py addresses.txt --review-queue {review_path}` first')
+    else:
+        n_review_page = -(-len(review_queue) // REVIEW_PAGE_SIZE)
+        review_page = st.number_input('Queue page', min_value=1, max_value=n_review_page, value=1)
+        review_start = (review_page - 1) * REVIEW_PAGE_SIZE
+        review_end = min(review_start + REVIEW_PAGE_SIZE, len(review_queue))
+        st.caption(f'Records {review_start + 1}-{review_end} of {len(review_queue)}, least confident first')
+        for item in review_queue[review_start:review_end]:
+            item_section, open_section = st.columns(spec=[0.9, 0.1], vertical_alignment='center')
+            with item_section:
+                weakest = int(np.argmin(item['token_confidence'])) if item['tokens'] else None
+                st.markdown(
+                    ''.join(create_token_version_pson(token, label) for token, label in zip(item['tokens'], item['labels'])),
+                    unsafe_allow_html=True,
+                )
+                st.caption(f"record {item['record']}, confidence {item['confidence']:.3f}"
+                           + (f", least sure of \"{item['tokens'][weakest]}\"" if weakest is not None else ''))
+            with open_section:
+                st.button('Open', key=f"review_{item['record']}", on_click=open_review_item, args=(item['text'],),
+                          help='Analyze this record, to check it and save a correction')
 
 # Session state initialization
 if 'initial_result' not in st.session_state:
     st.session_state.initial_result = None
-if 'shuffled_texts' not in st.session_state:
-    st.session_state.shuffled_texts = []
+
+# Tokenize once; shuffles are index permutations over these spans
+spans = tokenize_spans(text)
+original_tokens = span_tokens(text, spans)
 
 # Sidebar filters
 # selected_entities = st.sidebar.multiselect(
@@ -260,10 +349,35 @@ O : Other
                 selection_mode='multi'
 
             )
+            explain_tokens = st.toggle('Explain', help='Top state features and transition scores behind each tag')
         if text:
             st.markdown("## Original Prediction:")
             st.session_state.initial_result = text
-            result_df = parse_and_visualize(text, selected_entities, [],is_initial=True)
+            result_df = parse_and_visualize(original_tokens, selected_entities, [],is_initial=True, explain_tokens=explain_tokens)
+
+            paths, path_scores = nbest_decoder.decode(sequence_features(original_tokens))
+            alternative_df = pd.DataFrame(alternatives(paths, path_scores))
+            if len(alternative_df) > 1:
+                runner_up_margin = alternative_df['margin'].iloc[1]
+                if runner_up_margin < nbest_decoder.min_margin:
+                    st.warning(f'Low confidence: the next best labeling is only {runner_up_margin:.2f} behind')
+                with st.expander(f'Alternative labelings (runner-up margin {runner_up_margin:.2f})'):
+                    alternative_df['tags'] = alternative_df['tags'].str.join(' ')
+                    st.dataframe(alternative_df, hide_index=True)
+            with st.expander('Correct this prediction'):
+                corrected_df = st.data_editor(
+                    result_df[['token', 'tag']],
+                    column_config={'tag': st.column_config.SelectboxColumn('tag', options=TAGS, required=True)},
+                    disabled=['token'],
+                    hide_index=True,
+                )
+                if st.button('Save correction'):
+                    corrected_tags = corrected_df['tag'].tolist()
+                    if corrected_tags == result_df['tag'].tolist():
+                        st.info('No tag was changed')
+                    else:
+                        correction_store.append(original_tokens, corrected_tags, model_digest, source='NER_v3')
+                        st.success(f'Saved; {len(correction_store)} corrections waiting for `python retrain.py`')
             st.session_state.ner_done = True
         else:
             st.warning("Please enter text for analysis.")
@@ -271,11 +385,19 @@ O : Other
         # Shuffle button and functionality
         if 'ner_done' in st.session_state and st.session_state.ner_done:
             st.markdown('')
-            shuffled = st.button("Shuffle Text")
+            shuffle_button_section, shuffle_count_section = st.columns(spec=[0.2, 0.8], vertical_alignment='bottom')
+            with shuffle_count_section:
+                n_shuffle = st.select_slider('Shuffles', options=SHUFFLE_COUNTS, value=N_SHUFFLE)
+            with shuffle_button_section:
+                shuffled = st.button("Shuffle Text")
 
             if shuffled:
                 #st.write("Shuffled Texts:")
-                st.session_state.shuffled_texts = [shuffle_text(text, seed=None) for i in range(N_SHUFFLE)]
+                # All shuffles tagged here, in batches; reruns only page through the arrays
+                session.put('shuffle_results', ShuffleResults.from_orders(
+                    model, original_tokens, shuffle_orders('uniform', original_tokens, seed=random.randrange(2 ** 32)),
+                    n_shuffle,
+                ))
                 #for shuffled_text in st.session_state.shuffled_texts:
                     #st.text(shuffled_text)
                     #st.write('----------------------------------------')
@@ -291,7 +413,7 @@ O : Other
 
                 with what_if_tab:
                     all_results = []
-                    original_words = text.split()
+                    original_words = original_tokens
 
                     # st.sidebar.multiselect(
                     #     "Choose Words to Highlight",
@@ -320,11 +442,42 @@ O : Other
                             selection_mode='multi'
                         )
 
-                        for shuffle_id, shuffled_text in enumerate(st.session_state.shuffled_texts):
-                            result_df = parse_and_visualize(shuffled_text, selected_entities, highlighted_words,is_initial=False)
-                            
-                            all_results.append(result_df.assign(shuffle_id=shuffle_id))
-                            st.write('----------------------------------------')
+                        shuffle_results = session.get('shuffle_results')
+                        if shuffle_results is not None:
+                            shuffle_view = st.pills(
+                                'View',
+                                options=['Sentences', 'Heatmap'],
+                                default='Sentences',
+                                help='Heatmap : every shuffle as a row of tag colors, by position',
+                                selection_mode='single'
+                            ) or 'Sentences'
+                            if shuffle_view == 'Heatmap':
+                                highlighted_ids = [i for word in highlighted_words for i in shuffle_results.token_ids(word)]
+                                st.plotly_chart(
+                                    tag_heatmap_figure(shuffle_results, TAG_COLORS_VERSION_DEAR, highlighted_ids),
+                                    theme=None,
+                                )
+                            else:
+                                n_page = -(-len(shuffle_results) // SHUFFLE_PAGE_SIZE)
+                                page = st.number_input('Page', min_value=1, max_value=n_page, value=1) if n_page > 1 else 1
+                                start = (page - 1) * SHUFFLE_PAGE_SIZE
+                                end = min(start + SHUFFLE_PAGE_SIZE, len(shuffle_results))
+                                st.caption(f'Shuffles {start + 1}-{end} of {len(shuffle_results)}')
+                                for shuffle_id in range(start, end):
+                                    order = shuffle_results.orders[shuffle_id]
+                                    result_df = parse_and_visualize(
+                                        permute(shuffle_results.tokens, order), selected_entities, highlighted_words,
+                                        is_initial=False, predictions=[TAGS[code] for code in shuffle_results.tags[shuffle_id]],
+                                    )
+                                    if highlighted_words:
+                                        st.markdown(
+                                            original_text_markdown(text, spans, order, shuffle_results.tags[shuffle_id],
+                                                                   highlighted_words),
+                                            unsafe_allow_html=True,
+                                        )
+
+                                    all_results.append(result_df.assign(shuffle_id=shuffle_id))
+                                    st.write('----------------------------------------')
 
 
 
@@ -332,17 +485,25 @@ O : Other
             st.write(" ")
 
     with summary_tab:
-        original_tokens, original_predictions = parse(text)
-        original_result_df = make_result_df(original_tokens, original_predictions)
-        original_result_df['order'] = 'Index: ' + (original_result_df['index'] + 1).astype(str)
-        original_result_df.sort_values('index', inplace=True)
-
-        all_results = []
-        for shuffle_id in range(N_SHUFFLE_SUMMARY):
-            shuffled_text = shuffle_text(text, seed=shuffle_id)
-            tokens, predictions = parse(shuffled_text)
-            result_df = make_result_df(tokens, predictions)
-            all_results.append(result_df.assign(shuffle_id=shuffle_id))
+        shuffle_strategy = st.pills(
+            'Shuffle strategy',
+            options=SHUFFLE_STRATEGIES,
+            default='uniform',
+            help='''
+uniform : any order
+
+blocks : a keyword and the name after it (แขวง วังใหม่) move together
+
+bounded : no token moves more than 2 positions
+
+relocate : one token moved elsewhere
+            ''',
+            selection_mode='single'
+        ) or 'uniform'
+        # Orders are drawn lazily and tagged in batches
+        summary_results = ShuffleResults.from_orders(
+            model, original_tokens, shuffle_orders(shuffle_strategy, original_tokens), N_SHUFFLE_SUMMARY
+        )
 
         selected_word = st.pills(
             'Word',
@@ -354,39 +515,45 @@ O : Other
         # st.write("Original Text:")
         # st.write(selected_word)
 
-        all_result_df = pd.concat(all_results)
-        all_result_df['order'] = 'Index: ' + (all_result_df['index'] + 1).astype(str)
+        df = summary_results.chart_frame(selected_word)
 
-        word_result_df = all_result_df[all_result_df['token'] == selected_word]
-
-        df = word_result_df.groupby(['index', 'order', 'tag']).agg(count=('token', 'count')).reset_index()
-        df['count_all_word'] = df.groupby('order')['count'].transform('sum')
-        df['percentage'] = df['count'] / df['count_all_word'] * 100
-        df.sort_values(['index', 'tag'])
-
-        # st.write(all_result_df)
-        # st.write(df)
-
-        fig = px.bar(
+        fig = stacked_percentage_figure(
             df,
-            x='order',
-            y='percentage',
-            color='tag',
-            barmode='stack',
-            text='tag',
-            color_discrete_map=TAG_COLORS_VERSION_DEAR,
-            category_orders={
-                'tag': ['ADDR', 'LOC', 'POST', 'O'],
-                'order': original_result_df['order']
-            },
-            
-        )
-        fig.update_layout(
-            font=dict(size=20),
-            yaxis=dict(title='Probability (%)'),
-            xaxis=dict(title='Shuffled Order'),
+            color_map=TAG_COLORS_VERSION_DEAR,
+            tag_order=['ADDR', 'LOC', 'POST', 'O'],
+            position_order=[f'Index: {i + 1}' for i in range(len(original_tokens))],
         )
 
         st.markdown(f'# What if "{selected_word}" is shuffled ?')
         st.markdown(f'###### What "{selected_word}" gonna be ?')
-        st.plotly_chart(fig, theme=None)
\ No newline at end of file
+        st.plotly_chart(fig, theme=None)
+
+        st.markdown('# What if a token is dropped, swapped, moved or replaced ?')
+        ablation_kinds = st.pills(
+            'Perturbation',
+            options=PERTURBATION_KINDS,
+            default=PERTURBATION_KINDS,
+            selection_mode='multi'
+        )
+        _, perturbation_results = run_perturbations(model, original_tokens, ablation_kinds or [])
+        ablation_df = pd.DataFrame({
+            'kind': [result.perturbation.kind for result in perturbation_results],
+            'perturbation': [result.perturbation.describe(original_tokens) for result in perturbation_results],
+            'tags': [' '.join(result.predictions) for result in perturbation_results],
+            'changed tags': [result.n_changed for result in perturbation_results],
+            're-extracted positions': [result.n_extracted for result in perturbation_results],
+            'features (µs)': [result.feature_seconds * 1e6 for result in perturbation_results],
+            'decode (µs)': [result.decode_seconds * 1e6 for result in perturbation_results],
+        })
+        st.dataframe(
+            ablation_df.groupby('kind', sort=False).agg(
+                perturbations=('perturbation', 'count'),
+                changed_tags=('changed tags', 'sum'),
+                re_extracted=('re-extracted positions', 'sum'),
+                features_us=('features (µs)', 'sum'),
+                decode_us=('decode (µs)', 'sum'),
+            )
+        )
+        st.dataframe(ablation_df.sort_values('changed tags', ascending=False), hide_index=True)
+
+render_debug_panel(st.sidebar, [f'Telemetry, last window: {summarize_window(telemetry.last_window)}'])
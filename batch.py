@@ -0,0 +1,299 @@
+import argparse
+import sys
+import time
+from collections import deque
+from itertools import islice
+from multiprocessing import Pool
+
+from canonical import load_canonicalizer
+from consistency import load_consistency_index, validate
+from decoding import MarginalDecoder, NBestDecoder
+from dedup import EXACT, NEAR, Deduplicator
+from fields import decode_fields, to_arrow, write_jsonl
+from pretagger import load_pretagger
+from review import REVIEW_SIZE, ReviewQueue
+from segmenter import load_segmenter
+from streams import QUEUE_DEPTH, TEXT_FIELD, Consumer, Producer, StageStats, open_text_output, read_texts
+from tagger import MODEL_PATH, load_model, tag_texts
+from telemetry import Telemetry, known_words, open_sink
+from weights import load_weight_table
+
+STAGES = ["read", "segment", "dedup", "features", "decode", "fields", "canonicalize", "validate", "write"]
+
+
+def read_batches(texts, batch_size: int):
+    texts = iter(texts)
+    while True:
+        batch = list(islice(texts, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+class BatchTagger:
+    # Everything between reading and writing a batch; runs in this process or in pool workers
+
+    def __init__(self, model_path: str, segment: bool, pretag: bool, nbest: int, min_margin: float,
+                 consistency_index=None, repair: bool = False, canonicalize: bool = False, dedup: str = None,
+                 marginals: bool = False):
+        self.model = load_model(model_path)
+        # One per process: with workers, a repeat is only copied within the same worker
+        self.deduplicator = Deduplicator(near=dedup == "near") if dedup else None
+        self.consistency_index = consistency_index
+        self.repair = repair
+        # Memory-mapped, so workers share the saved index's pages
+        self.canonicalizer = load_canonicalizer() if canonicalize else None
+        self.marginals = MarginalDecoder(self.model) if marginals else None
+        self.nbest = NBestDecoder(load_weight_table(self.model), nbest, min_margin) if nbest else None
+        self.segmenter = load_segmenter() if segment else None
+        self.pretagger = load_pretagger() if pretag else None
+
+    def __call__(self, texts) -> tuple:
+        # (batch, fields, seconds per stage)
+        timings = {}
+        spans = None
+        if self.segmenter is not None:
+            started = time.perf_counter()
+            spans = [self.segmenter.spans(text) for text in texts]
+            timings["segment"] = time.perf_counter() - started
+        batch = tag_texts(self.model, texts, spans, self.pretagger, self.nbest, timings, self.deduplicator,
+                          self.marginals)
+        started = time.perf_counter()
+        fields = decode_fields(batch)
+        timings["fields"] = time.perf_counter() - started
+        if self.canonicalizer is not None:
+            started = time.perf_counter()
+            batch.canonical = self.canonicalizer.canonicalize(batch, fields)
+            timings["canonicalize"] = time.perf_counter() - started
+        if self.consistency_index is not None:
+            started = time.perf_counter()
+            batch.consistency = validate(self.consistency_index, batch, fields, self.repair)
+            timings["validate"] = time.perf_counter() - started
+        return batch, fields, timings
+
+
+_tagger = None
+
+
+def _init_worker(*tagger_args):
+    global _tagger
+    _tagger = BatchTagger(*tagger_args)
+
+
+def _tag_batch(texts) -> tuple:
+    return _tagger(texts)
+
+
+def tag_in_pool(pool, batches, depth: int):
+    # In input order, with at most `depth` batches handed to the workers at once;
+    # Pool.imap would pull the whole input into memory ahead of the workers
+    pending = deque()
+    for texts in batches:
+        pending.append(pool.apply_async(_tag_batch, (texts,)))
+        if len(pending) >= depth:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+class JsonlOutput:
+    def __init__(self, path):
+        # .jsonl.gz and .jsonl.zst are compressed as they are written
+        self.file = open_text_output(path)
+
+    def write(self, batch, table, record_offset):
+        write_jsonl(self.file, batch, table)
+
+    def close(self):
+        if self.file is not sys.stdout:
+            self.file.close()
+
+
+class ArrowOutput:
+    def __init__(self, path, compression: str = "snappy"):
+        self.path = path
+        self.compression = compression
+        self.writer = None
+
+    def _open(self, schema):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if self.path.endswith(".parquet"):
+            return pq.ParquetWriter(self.path, schema, compression=self.compression)
+        return pa.ipc.new_file(self.path, schema)
+
+    def write(self, batch, table, record_offset):
+        arrow_table = to_arrow(batch, table, record_offset)
+        if self.writer is None:
+            self.writer = self._open(arrow_table.schema)
+        self.writer.write_table(arrow_table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def open_output(path: str, parquet_compression: str = "snappy"):
+    if path.endswith((".arrow", ".parquet")):
+        return ArrowOutput(path, parquet_compression)
+    return JsonlOutput(path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Tag addresses in bulk and write structured fields.")
+    parser.add_argument("input", help="one address per line (.txt), .csv or .jsonl, optionally .gz or .zst; - for stdin")
+    parser.add_argument("-o", "--output", default="-",
+                        help=".jsonl (default stdout), .jsonl.gz, .jsonl.zst, .arrow or .parquet")
+    parser.add_argument("--text-field", default=TEXT_FIELD, help="CSV column or JSONL key holding the address")
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="processes tagging batches; 1 tags in this process alongside the reader and writer threads")
+    parser.add_argument("--queue-depth", type=int, default=QUEUE_DEPTH,
+                        help="batches each stage may run ahead of the next")
+    parser.add_argument("--parquet-compression", choices=["snappy", "zstd", "gzip", "none"], default="snappy")
+    parser.add_argument("--segment", action="store_true", help="split unspaced Thai with the address dictionary")
+    parser.add_argument("--pretag", action="store_true", help="skip the CRF for records the gazetteer fully resolves")
+    parser.add_argument("--dedup", choices=["exact", "near"],
+                        help="copy tags to repeats of a record already decoded instead of decoding them again; "
+                             "near also to records differing in a word or two (not always what the CRF would give)")
+    parser.add_argument("--nbest", type=int, default=0, metavar="K",
+                        help="add the top K labelings, the best-vs-runner-up margin and a low_confidence flag")
+    parser.add_argument("--min-margin", type=float, default=1.0, help="margin under which a record is low confidence")
+    parser.add_argument("--confidence", action="store_true",
+                        help="add each record's lowest tag marginal probability, computed while decoding")
+    parser.add_argument("--review-queue", metavar="PATH",
+                        help="also write the least confident records to PATH (JSONL) for NER_v3.py to page through")
+    parser.add_argument("--review-size", type=int, default=REVIEW_SIZE, help="records kept for the review queue")
+    parser.add_argument("--validate", action="store_true",
+                        help="check postal codes against sub-district, district and province; add a per-record score")
+    parser.add_argument("--repair", action="store_true",
+                        help="validate, and replace an inconsistent postal code or province the gazetteer can pin down")
+    parser.add_argument("--canonicalize", action="store_true",
+                        help="map sub-district, district and province spans to official names, allowing typos")
+    parser.add_argument("--telemetry", metavar="PATH_OR_URL",
+                        help="append tag, unknown-word and latency histograms to a JSONL file or POST them to a URL")
+    args = parser.parse_args(argv)
+
+    # The index is built once here; forked workers share it rather than each building their own
+    consistency_index = load_consistency_index() if args.validate or args.repair else None
+    if args.canonicalize:
+        # Built and saved before the workers start, so they only load it
+        load_canonicalizer()
+    tagger_args = (args.model, args.segment, args.pretag, args.nbest, args.min_margin, consistency_index, args.repair,
+                   args.canonicalize, args.dedup, args.confidence or bool(args.review_queue))
+    pool = Pool(args.workers, initializer=_init_worker, initargs=tagger_args) if args.workers > 1 else None
+    tagger = BatchTagger(*tagger_args) if pool is None else None
+    telemetry = None
+    if args.telemetry:
+        table = tagger.nbest.table if tagger is not None and tagger.nbest else load_weight_table(load_model(args.model))
+        telemetry = Telemetry(known_words(table), open_sink(args.telemetry))
+    output = open_output(args.output, args.parquet_compression)
+
+    # Reading (decompression and parsing) and writing (serialization and
+    # compression) run on their own threads, each a bounded queue away from tagging
+    stats = {stage: StageStats(stage) for stage in STAGES}
+    reader = Producer(read_batches(read_texts(args.input, args.text_field), args.batch_size),
+                      stats["read"], args.queue_depth)
+    writer = Consumer(lambda item: output.write(*item), stats["write"], args.queue_depth,
+                      count=lambda item: len(item[0]))
+    batches = (tagger(texts) for texts in reader) if pool is None else tag_in_pool(pool, reader, args.queue_depth)
+
+    n_record = 0
+    n_short_circuited = 0
+    n_low_confidence = 0
+    n_inconsistent = n_repaired = 0
+    n_fuzzy = n_unmatched = 0
+    n_exact = n_near = 0
+    # Bounded, so the queue costs the same on any length of input
+    review_queue = ReviewQueue(args.review_size) if args.review_queue else None
+    # Time the tagging side spent waiting on input (reading is the bottleneck)
+    # and on output (writing is)
+    input_wait = output_wait = 0.0
+    started = time.perf_counter()
+    try:
+        while True:
+            wait_started = time.perf_counter()
+            tagged = next(batches, None)
+            if tagged is None:
+                break
+            batch, fields, timings = tagged
+            if pool is None:
+                input_wait += time.perf_counter() - wait_started - sum(timings.values())
+            for stage, seconds in timings.items():
+                stats[stage].busy += seconds
+                stats[stage].records += len(batch)
+            if telemetry is not None:
+                telemetry.record_batch(batch, timings["features"] + timings["decode"])
+            output_wait += writer.put((batch, fields, n_record))
+            if review_queue is not None:
+                review_queue.push_batch(batch, n_record)
+            n_record += len(batch)
+            if batch.short_circuited is not None:
+                n_short_circuited += int(batch.short_circuited.sum())
+            if batch.duplicates is not None:
+                n_exact += int((batch.duplicates == EXACT).sum())
+                n_near += int((batch.duplicates == NEAR).sum())
+            if batch.low_confidence is not None:
+                n_low_confidence += int(batch.low_confidence.sum())
+            if batch.consistency is not None:
+                n_inconsistent += int((batch.consistency.failed != 0).sum())
+                n_repaired += int(batch.consistency.repaired().sum())
+            if batch.canonical is not None:
+                n_fuzzy += int((batch.canonical.distances > 0).sum())
+                n_unmatched += int(batch.canonical.unmatched().sum())
+        writer.close()
+        if review_queue is not None:
+            review_queue.write(args.review_queue)
+    except BaseException:
+        # The writer thread must be done with the output before it is closed;
+        # the error that stopped tagging is the one reported
+        reader.close()
+        writer.close(discard=True)
+        raise
+    finally:
+        reader.close()
+        output.close()
+        if pool is not None:
+            pool.terminate()
+        if telemetry is not None:
+            telemetry.close()
+
+    elapsed = time.perf_counter() - started
+    print(f"{n_record} records in {elapsed:.2f}s ({n_record / max(elapsed, 1e-9):.0f} records/s)", file=sys.stderr)
+    for stage in STAGES:
+        if stats[stage].records:
+            print(f"  {stats[stage].describe()}", file=sys.stderr)
+    # With workers the main process only hands batches around, so its input wait says nothing
+    if pool is None:
+        print(f"  tagging waited {input_wait:.2f}s for input, {output_wait:.2f}s for output", file=sys.stderr)
+    else:
+        print(f"  tagging waited {output_wait:.2f}s for output", file=sys.stderr)
+    if args.segment:
+        segment_time = stats["segment"].busy
+        print(f"segmentation: {segment_time:.2f}s ({segment_time / max(elapsed, 1e-9):.0%} of total)", file=sys.stderr)
+    if args.pretag:
+        print(f"pre-tagger resolved {n_short_circuited / max(n_record, 1):.1%} of records without the CRF", file=sys.stderr)
+    if args.dedup:
+        n_decoded = stats["decode"].records - n_short_circuited - n_exact - n_near
+        seconds_per_decode = stats["decode"].busy / max(n_decoded, 1)
+        print(f"dedup copied {n_exact} exact and {n_near} near repeats: {n_decoded} records decoded, "
+              f"{(n_exact + n_near) / max(n_decoded + n_exact + n_near, 1):.1%} of decodes "
+              f"(~{(n_exact + n_near) * seconds_per_decode:.2f}s) saved", file=sys.stderr)
+    if review_queue is not None:
+        highest = review_queue.max_confidence()
+        held = f" (confidence at most {highest:.3f})" if highest is not None else ""
+        print(f"{len(review_queue)} least confident records{held} written to {args.review_queue}", file=sys.stderr)
+    if args.nbest:
+        print(f"{n_low_confidence} records with a margin under {args.min_margin} flagged low confidence", file=sys.stderr)
+    if args.canonicalize:
+        print(f"{n_fuzzy} location spans matched an official name only approximately, "
+              f"{n_unmatched} matched none", file=sys.stderr)
+    if consistency_index is not None:
+        print(f"{n_inconsistent} records with an inconsistent postal code or location"
+              + (f", {n_repaired} repaired" if args.repair else ""), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
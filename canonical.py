@@ -0,0 +1,228 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+from functools import lru_cache
+from itertools import combinations
+
+import marisa_trie
+import numpy as np
+
+from fields import FIELD_CODES, decode_fields
+from gazetteer import GAZETTEER_PATH, PROVINCE_ALIASES, PROVINCES_PATH, load_gazetteer
+from tagger import MODEL_PATH, load_model, tag_texts
+
+INDEX_DIR = ".index_cache"
+# Bump whenever what goes into the index changes
+INDEX_VERSION = 1
+MAX_DISTANCE = 2
+CACHE_SIZE = 65536
+LOC_FIELDS = ["sub_district", "district", "province"]
+DISTANCE_DTYPE = np.int8
+
+
+def allowed_distance(length: int, max_distance: int = MAX_DISTANCE) -> int:
+    # Short names take no edits: two edits would turn most 3-letter names into others
+    if length < 4:
+        return 0
+    if length < 7:
+        return min(1, max_distance)
+    return max_distance
+
+
+def deletes(word: str, distance: int) -> set:
+    # Every string left after removing up to `distance` characters, word included
+    variants = {word}
+    for n in range(1, min(distance, len(word)) + 1):
+        for removed in combinations(range(len(word)), n):
+            variants.add("".join(char for i, char in enumerate(word) if i not in removed))
+    return variants
+
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    # Optimal string alignment distance (adjacent transpositions count as one edit),
+    # or limit + 1 as soon as it cannot be within limit
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous2 = None
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = a[i - 1] != b[j - 1]
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+
+def gazetteer_entries(gazetteer) -> list:
+    # (field, name as written, official name); aliases point at their official name
+    entries = set()
+    for sub_district, district, province, _ in gazetteer.entries:
+        for field, name in zip(LOC_FIELDS, (sub_district, district, province)):
+            if name:
+                entries.add((field, name, name))
+    entries.update(("province", province, province) for province in gazetteer.postal_prefixes)
+    entries.update(("province", alias, province) for alias, province in PROVINCE_ALIASES.items())
+    return sorted(entries)
+
+
+class Canonicalizer:
+    # Symmetric-delete index: every name's deletions (up to allowed_distance of its
+    # length) map to the names they came from, so a query only needs its own
+    # deletions looked up, then a true edit distance on the few candidates. The
+    # deletions live in a marisa RecordTrie, memory-mapped from disk when loaded.
+
+    def __init__(self, entries, trie, max_distance: int = MAX_DISTANCE, cache_size: int = CACHE_SIZE):
+        self.entries = entries
+        self.trie = trie
+        self.max_distance = max_distance
+        self.exact = {(field, name): official for field, name, official in entries}
+        # Place names repeat heavily across records
+        self.lookup = lru_cache(maxsize=cache_size)(self._lookup)
+
+    @classmethod
+    def build(cls, entries, max_distance: int = MAX_DISTANCE):
+        items = [
+            (variant, (entry_id,))
+            for entry_id, (_, name, _) in enumerate(entries)
+            for variant in deletes(name, allowed_distance(len(name), max_distance))
+        ]
+        return cls(entries, marisa_trie.RecordTrie("<I", items), max_distance)
+
+    def save(self, path: str):
+        # Trie under a temporary name then renamed, entries next to it as JSON
+        self.trie.save(path + ".tmp")
+        with open(path + ".json.tmp", "w", encoding="utf-8") as file:
+            json.dump({"max_distance": self.max_distance, "entries": self.entries}, file, ensure_ascii=False)
+        os.replace(path + ".json.tmp", path + ".json")
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path + ".json", encoding="utf-8") as file:
+            saved = json.load(file)
+        trie = marisa_trie.RecordTrie("<I")
+        trie.mmap(path)
+        return cls([tuple(entry) for entry in saved["entries"]], trie, saved["max_distance"])
+
+    def _lookup(self, name: str, field: str) -> tuple:
+        # (official name, edit distance) of the closest `field` entry, (None, -1) when
+        # none is within the allowed distance or two different ones tie
+        official = self.exact.get((field, name))
+        if official is not None:
+            return official, 0
+        limit = allowed_distance(len(name), self.max_distance)
+        best, best_distance = None, limit + 1
+        for variant in deletes(name, limit):
+            for (entry_id,) in self.trie.get(variant, ()):
+                entry_field, entry_name, entry_official = self.entries[entry_id]
+                if entry_field != field:
+                    continue
+                # Within what both the query's length and the entry's allow; past it the
+                # distance is only the cutoff, not an edit count
+                bound = min(limit, allowed_distance(len(entry_name), self.max_distance))
+                distance = edit_distance(name, entry_name, bound)
+                if distance > bound:
+                    continue
+                if distance < best_distance:
+                    best, best_distance = entry_official, distance
+                elif distance == best_distance and best is not None and entry_official != best:
+                    best = False
+        if not best:
+            return None, -1
+        return best, best_distance
+
+    def canonicalize(self, batch, table):
+        # Official name and edit distance for every LOC row of a fields.FieldTable
+        names = np.full(len(table), None, dtype=object)
+        distances = np.full(len(table), -1, dtype=DISTANCE_DTYPE)
+        located = np.isin(table.field, [FIELD_CODES[field] for field in LOC_FIELDS])
+        for field in LOC_FIELDS:
+            rows = np.flatnonzero(table.field == FIELD_CODES[field])
+            for row, record, start, end in zip(rows.tolist(), table.record[rows].tolist(),
+                                               table.char_start[rows].tolist(), table.char_end[rows].tolist()):
+                names[row], distances[row] = self.lookup(batch.texts[record][start:end], field)
+        return CanonicalNames(names, distances, located)
+
+
+class CanonicalNames:
+    # Per FieldTable row: the official name (None for non-LOC rows and misses),
+    # its edit distance from the tagged text (-1 where there is no name) and
+    # whether the row is a LOC field at all
+
+    def __init__(self, names, distances, located):
+        self.names = names
+        self.distances = distances
+        self.located = located
+
+    def unmatched(self) -> np.ndarray:
+        return self.located & (self.distances < 0)
+
+
+def index_path(gazetteer_path: str = GAZETTEER_PATH, provinces_path: str = PROVINCES_PATH,
+               max_distance: int = MAX_DISTANCE, index_dir: str = INDEX_DIR) -> str:
+    # Named by what it was built from, so an edited gazetteer gets a new index
+    digest = hashlib.blake2b(digest_size=8)
+    for path in (gazetteer_path, provinces_path):
+        with open(path, "rb") as file:
+            digest.update(file.read())
+    digest.update(json.dumps([INDEX_VERSION, max_distance, sorted(PROVINCE_ALIASES.items())]).encode("utf-8"))
+    return os.path.join(index_dir, f"canonical-{digest.hexdigest()}.marisa")
+
+
+def load_canonicalizer(max_distance: int = MAX_DISTANCE, index_dir: str = INDEX_DIR) -> Canonicalizer:
+    # Built on first use and saved; later runs and every worker memory-map the saved trie
+    path = index_path(max_distance=max_distance, index_dir=index_dir)
+    if not os.path.exists(path):
+        os.makedirs(index_dir, exist_ok=True)
+        Canonicalizer.build(gazetteer_entries(load_gazetteer()), max_distance).save(path)
+    return Canonicalizer.load(path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Map tagged LOC spans to official gazetteer names.")
+    parser.add_argument("input", help="text file with one address per line")
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--max-distance", type=int, default=MAX_DISTANCE)
+    parser.add_argument("--index-dir", default=INDEX_DIR)
+    parser.add_argument("--examples", type=int, default=10, help="fuzzy matches to print")
+    args = parser.parse_args(argv)
+
+    entries = gazetteer_entries(load_gazetteer())
+    started = time.perf_counter()
+    Canonicalizer.build(entries, args.max_distance)
+    build_seconds = time.perf_counter() - started
+    load_canonicalizer(args.max_distance, args.index_dir)
+    started = time.perf_counter()
+    canonicalizer = load_canonicalizer(args.max_distance, args.index_dir)
+    load_seconds = time.perf_counter() - started
+
+    with open(args.input, encoding="utf-8") as file:
+        texts = [line.rstrip("\r\n") for line in file]
+    batch = tag_texts(load_model(args.model), texts)
+    table = decode_fields(batch)
+    started = time.perf_counter()
+    canonical = canonicalizer.canonicalize(batch, table)
+    seconds = time.perf_counter() - started
+    cache = canonicalizer.lookup.cache_info()
+
+    print(f"index: {len(canonicalizer.entries)} names, {len(canonicalizer.trie)} keys; "
+          f"built in {build_seconds * 1000:.0f} ms, loaded in {load_seconds * 1000:.1f} ms")
+    print(f"{int(canonical.located.sum())} LOC spans canonicalized in {seconds * 1000:.1f} ms "
+          f"({cache.misses} distinct lookups, {cache.hits / max(cache.hits + cache.misses, 1):.1%} memoized)")
+    print(f"exact {int((canonical.distances == 0).sum())}, fuzzy {int((canonical.distances > 0).sum())}, "
+          f"unmatched {int(canonical.unmatched().sum())}")
+    fuzzy = np.flatnonzero(canonical.distances > 0)[:args.examples]
+    for row in fuzzy.tolist():
+        text = batch.texts[table.record[row]][table.char_start[row]:table.char_end[row]]
+        print(f"  {text} -> {canonical.names[row]} ({canonical.distances[row]} edits)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import plotly.graph_objects as go
+
+from tagger import TAGS
+
+# Figures and specs are shared across reruns and sessions; neither Streamlit
+# call that renders them mutates what it is given
+CACHE_SIZE = 128
+
+
+class ChartCache:
+    # Small LRU of built charts keyed by a hash of the data they show. Every
+    # session's script thread shares it; charts are built outside the lock.
+
+    def __init__(self, maxsize: int = CACHE_SIZE):
+        self.maxsize = maxsize
+        self.charts = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get_or_build(self, key: str, build):
+        with self.lock:
+            chart = self.charts.get(key)
+            if chart is not None:
+                self.charts.move_to_end(key)
+                self.hits += 1
+                return chart
+            self.misses += 1
+        chart = build()
+        with self.lock:
+            self.charts[key] = chart
+            while len(self.charts) > self.maxsize:
+                self.charts.popitem(last=False)
+        return chart
+
+
+chart_cache = ChartCache()
+
+
+def data_key(*parts) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        if isinstance(part, pd.DataFrame):
+            digest.update(repr(list(part.columns)).encode())
+            digest.update(pd.util.hash_pandas_object(part, index=False).values.tobytes())
+        elif isinstance(part, np.ndarray):
+            # repr would elide the middle of a large array
+            digest.update(repr((part.dtype.str, part.shape)).encode())
+            digest.update(np.ascontiguousarray(part).tobytes())
+        else:
+            digest.update(repr(part).encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def count_bar_spec(df: pd.DataFrame, x: str = 'Class', y: str = 'Count',
+                   x_title: str = 'Entity Class', y_title: str = 'Count', title: str = 'Entity Counts') -> dict:
+    # Vega-Lite spec for st.vega_lite_chart: plain JSON, nothing to release afterwards
+    def build():
+        return {
+            'title': title,
+            'width': 300,
+            'height': 180,
+            'data': {'values': df[[x, y]].to_dict(orient='records')},
+            'mark': 'bar',
+            'encoding': {
+                'x': {'field': x, 'type': 'nominal', 'title': x_title},
+                'y': {'field': y, 'type': 'quantitative', 'title': y_title},
+            },
+        }
+
+    return chart_cache.get_or_build(data_key('count_bar', df, x, y, x_title, y_title, title), build)
+
+
+def stacked_percentage_figure(df: pd.DataFrame, color_map: dict, tag_order: list, position_order: list):
+    # The summary tab's "what does this word become" chart, rebuilt only when its data changes
+    def build():
+        fig = px.bar(
+            df,
+            x='order',
+            y='percentage',
+            color='tag',
+            barmode='stack',
+            text='tag',
+            color_discrete_map=color_map,
+            category_orders={
+                'tag': tag_order,
+                'order': position_order,
+            },
+        )
+        fig.update_layout(
+            font=dict(size=20),
+            yaxis=dict(title='Probability (%)'),
+            xaxis=dict(title='Shuffled Order'),
+        )
+        return fig
+
+    return chart_cache.get_or_build(
+        data_key('stacked_percentage', df, sorted(color_map.items()), tag_order, position_order),
+        build,
+    )
+
+
+def tag_heatmap_figure(results, color_map: dict, highlighted_tokens=()):
+    # One row per shuffle, one column per position, colored by tag code straight
+    # from a results.ShuffleResults; tokens not in highlighted_tokens are left
+    # blank when any are given. Hovering shows the token and tag.
+    def build():
+        n_shuffle, n_position = results.tags.shape
+        z = results.tags.astype(np.float32)
+        if len(highlighted_tokens):
+            z[~np.isin(results.orders, highlighted_tokens)] = np.nan
+        tokens = np.array(results.tokens, dtype=object)[results.orders]
+        n_tag = len(TAGS)
+        colorscale = []
+        for code, tag in enumerate(TAGS):
+            colorscale += [[code / n_tag, color_map[tag]], [(code + 1) / n_tag, color_map[tag]]]
+        fig = go.Figure(go.Heatmap(
+            z=z,
+            x=np.arange(1, n_position + 1),
+            y=np.arange(n_shuffle),
+            customdata=np.stack([tokens, np.array(TAGS, dtype=object)[results.tags]], axis=-1),
+            hovertemplate='shuffle %{y}, index %{x}: %{customdata[0]} → %{customdata[1]}<extra></extra>',
+            colorscale=colorscale,
+            zmin=-0.5,
+            zmax=n_tag - 0.5,
+            colorbar=dict(tickvals=list(range(n_tag)), ticktext=TAGS),
+        ))
+        fig.update_layout(
+            height=min(250 + 3 * n_shuffle, 900),
+            xaxis=dict(title='Shuffled Order', dtick=1),
+            yaxis=dict(title='Shuffle', autorange='reversed'),
+        )
+        return fig
+
+    return chart_cache.get_or_build(
+        data_key('tag_heatmap', results.orders, results.tags, sorted(color_map.items()), list(highlighted_tokens)),
+        build,
+    )
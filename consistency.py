@@ -0,0 +1,238 @@
+import argparse
+import time
+
+import numpy as np
+
+from fields import decode_fields, last_rows, record_values
+from gazetteer import PROVINCE_ALIASES, load_gazetteer
+from pretagger import CAPITAL_DISTRICT
+from tagger import MODEL_PATH, load_model, tag_texts
+from timing import best_time
+
+# Bit i of Consistency.failed is CHECKS[i]
+CHECKS = ["postal_province", "postal_district", "postal_sub_district", "district_province", "sub_district_district"]
+CHECK_BITS = {check: np.int8(1 << bit) for bit, check in enumerate(CHECKS)}
+FAILED_DTYPE = np.int8
+ID_DTYPE = np.int32
+# Failures that changing the postal code, or the province, can fix
+_POSTAL_CHECKS = CHECK_BITS["postal_province"] | CHECK_BITS["postal_district"] | CHECK_BITS["postal_sub_district"]
+_PROVINCE_CHECKS = CHECK_BITS["postal_province"] | CHECK_BITS["district_province"]
+
+
+def _vocabulary(names) -> dict:
+    return {name: i for i, name in enumerate(sorted(set(names) - {""}))}
+
+
+def _unique_values(keys: np.ndarray, values: np.ndarray) -> tuple:
+    # (sorted distinct keys, their value or -1 where one key has several values)
+    order = np.lexsort((values, keys))
+    keys, values = keys[order], values[order]
+    distinct, first = np.unique(keys, return_index=True)
+    n_value = np.add.reduceat(np.r_[True, (keys[1:] != keys[:-1]) | (values[1:] != values[:-1])], first)
+    return distinct, np.where(n_value == 1, values[first], -1)
+
+
+def _contains(sorted_keys: np.ndarray, keys: np.ndarray) -> np.ndarray:
+    if not len(sorted_keys):
+        return np.zeros(len(keys), dtype=bool)
+    index = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+    return sorted_keys[index] == keys
+
+
+def _mapped(sorted_keys: np.ndarray, values: np.ndarray, keys: np.ndarray, valid: np.ndarray) -> np.ndarray:
+    # values[k] for every valid key found in sorted_keys, -1 elsewhere
+    if not len(sorted_keys):
+        return np.full(len(keys), -1, dtype=np.int64)
+    index = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+    return np.where(valid & (sorted_keys[index] == keys), values[index], -1)
+
+
+class ConsistencyIndex:
+    # Names interned to ids, and every (postal code, district), (postal code,
+    # sub-district), (district, province) and (sub-district, district) pair the
+    # gazetteer knows as sorted int64 keys, so a batch is checked with a few
+    # searchsorted calls. Built once, before worker processes fork, and only read after.
+
+    def __init__(self, gazetteer):
+        entries = gazetteer.entries
+        self.sub_districts = _vocabulary(entry[0] for entry in entries)
+        self.districts = _vocabulary(entry[1] for entry in entries)
+        self.provinces = _vocabulary([entry[2] for entry in entries] + list(gazetteer.postal_prefixes))
+        for alias, province in PROVINCE_ALIASES.items():
+            self.provinces[alias] = self.provinces[province]
+        self.province_names = {i: name for name, i in self.provinces.items() if name not in PROVINCE_ALIASES}
+        self.province_prefix = np.full(len(self.province_names), -1, dtype=ID_DTYPE)
+        for province, prefix in gazetteer.postal_prefixes.items():
+            self.province_prefix[self.provinces[province]] = int(prefix)
+
+        sub = np.array([self.sub_districts.get(entry[0], -1) for entry in entries], dtype=np.int64)
+        district = np.array([self.districts.get(entry[1], -1) for entry in entries], dtype=np.int64)
+        province = np.array([self.provinces.get(entry[2], -1) for entry in entries], dtype=np.int64)
+        postal = np.array([int(entry[3]) if entry[3].isdigit() else -1 for entry in entries], dtype=np.int64)
+        n_sub, n_district, n_province = len(self.sub_districts), len(self.districts), len(self.province_names)
+
+        known = postal >= 0
+        self.postal_codes = np.unique(postal[known])
+        self.postal_district = np.unique((postal * n_district + district)[known & (district >= 0)])
+        self.postal_sub_district = np.unique((postal * n_sub + sub)[known & (sub >= 0)])
+        self.district_province = np.unique((district * n_province + province)[(district >= 0) & (province >= 0)])
+        self.sub_district_district = np.unique((sub * n_district + district)[(sub >= 0) & (district >= 0)])
+
+        # For repairs: the one postal code of a (sub-district, district) or a district,
+        # the one province of a district or a postal prefix; -1 where there is more than one
+        pair = known & (sub >= 0) & (district >= 0)
+        self.pair_keys, self.pair_postal = _unique_values((sub * n_district + district)[pair], postal[pair])
+        self.district_keys, self.district_postal = _unique_values(district[known & (district >= 0)],
+                                                                  postal[known & (district >= 0)])
+        self.district_province_keys, self.district_province_ids = _unique_values(
+            district[(district >= 0) & (province >= 0)], province[(district >= 0) & (province >= 0)])
+        prefixes = np.flatnonzero(self.province_prefix >= 0)
+        self.prefix_keys, self.prefix_province = _unique_values(self.province_prefix[prefixes].astype(np.int64),
+                                                                prefixes.astype(np.int64))
+
+    @property
+    def nbytes(self) -> int:
+        return sum(value.nbytes for value in vars(self).values() if isinstance(value, np.ndarray))
+
+
+def load_consistency_index(gazetteer=None) -> ConsistencyIndex:
+    return ConsistencyIndex(gazetteer or load_gazetteer())
+
+
+class Consistency:
+    # Per record: the share of applicable checks that passed (NaN when none
+    # applied, e.g. no postal code and unknown names), a bitmask of failed CHECKS,
+    # and repaired postal code / province, None where left as tagged
+
+    def __init__(self, score, failed, postal_code=None, province=None):
+        self.score = score
+        self.failed = failed
+        self.postal_code = postal_code
+        self.province = province
+
+    def failed_checks(self, record: int) -> list:
+        return [check for check, bit in CHECK_BITS.items() if self.failed[record] & bit]
+
+    def repaired(self) -> np.ndarray:
+        # Records with at least one repair
+        repaired = np.zeros(len(self.score), dtype=bool)
+        for values in (self.postal_code, self.province):
+            if values is not None:
+                repaired |= np.fromiter((value is not None for value in values), dtype=bool, count=len(values))
+        return repaired
+
+    def repairs(self, record: int) -> dict:
+        repaired = {}
+        if self.postal_code is not None and self.postal_code[record] is not None:
+            repaired["postal_code"] = self.postal_code[record]
+        if self.province is not None and self.province[record] is not None:
+            repaired["province"] = self.province[record]
+        return repaired
+
+
+def _ids(vocabulary: dict, values: np.ndarray) -> np.ndarray:
+    return np.fromiter(map(vocabulary.get, values, [-1] * len(values)), dtype=np.int64, count=len(values))
+
+
+def _location_names(batch, table, field: str) -> np.ndarray:
+    # As tagged, or the official name where the batch was canonicalized and one matched
+    values = record_values(batch, table, field)
+    if batch.canonical is not None:
+        records, rows = last_rows(table, field)
+        names = batch.canonical.names[rows]
+        found = np.fromiter((name is not None for name in names), dtype=bool, count=len(names))
+        values[records[found]] = names[found]
+    return values
+
+
+def validate(index: ConsistencyIndex, batch, table, repair: bool = False) -> Consistency:
+    # batch: tagger.TaggedBatch, table: its fields.FieldTable
+    n_record = len(batch)
+    province = _ids(index.provinces, _location_names(batch, table, "province"))
+    district_names = _location_names(batch, table, "district")
+    # "อำเภอ เมือง" is the capital district of the record's province
+    capital = (district_names == CAPITAL_DISTRICT) & (province >= 0)
+    if capital.any():
+        district_names[capital] = [CAPITAL_DISTRICT + index.province_names[p] for p in province[capital].tolist()]
+    district = _ids(index.districts, district_names)
+    sub = _ids(index.sub_districts, _location_names(batch, table, "sub_district"))
+
+    postal_text = record_values(batch, table, "postal_code").astype(str)
+    is_code = (np.char.str_len(postal_text) == 5) & np.char.isdigit(postal_text)
+    postal = np.full(n_record, -1, dtype=np.int64)
+    postal[is_code] = postal_text[is_code].astype(np.int64)
+    postal_known = _contains(index.postal_codes, postal)
+
+    n_sub, n_district, n_province = len(index.sub_districts), len(index.districts), len(index.province_names)
+    prefix = np.where(province >= 0, index.province_prefix[np.maximum(province, 0)], -1)
+    checks = [
+        # (applies, passes) per record, in CHECKS order
+        (is_code & (prefix >= 0), postal // 1000 == prefix),
+        (postal_known & (district >= 0), _contains(index.postal_district, postal * n_district + district)),
+        (postal_known & (sub >= 0), _contains(index.postal_sub_district, postal * n_sub + sub)),
+        ((district >= 0) & (province >= 0), _contains(index.district_province, district * n_province + province)),
+        ((sub >= 0) & (district >= 0), _contains(index.sub_district_district, sub * n_district + district)),
+    ]
+    n_applied = np.zeros(n_record, dtype=np.int32)
+    n_passed = np.zeros(n_record, dtype=np.int32)
+    failed = np.zeros(n_record, dtype=FAILED_DTYPE)
+    for bit, (applies, passes) in zip(CHECK_BITS.values(), checks):
+        n_applied += applies
+        n_passed += applies & passes
+        failed |= np.where(applies & ~passes, bit, 0).astype(FAILED_DTYPE)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        score = (n_passed / n_applied).astype(np.float32)
+    if not repair:
+        return Consistency(score, failed)
+
+    # Postal code: from the (sub-district, district) pair, else the district alone
+    candidate = _mapped(index.pair_keys, index.pair_postal, sub * n_district + district, (sub >= 0) & (district >= 0))
+    candidate = np.where(candidate >= 0, candidate,
+                         _mapped(index.district_keys, index.district_postal, district, district >= 0))
+    fix_postal = ((failed & _POSTAL_CHECKS) != 0) & (candidate >= 0) & (candidate != postal)
+    postal = np.where(fix_postal, candidate, postal)
+
+    # Province: from the district, else from the (possibly repaired) postal prefix
+    candidate = _mapped(index.district_province_keys, index.district_province_ids, district, district >= 0)
+    candidate = np.where(candidate >= 0, candidate,
+                         _mapped(index.prefix_keys, index.prefix_province, postal // 1000, postal >= 0))
+    fix_province = ((failed & _PROVINCE_CHECKS) != 0) & (candidate >= 0) & (candidate != province)
+
+    postal_code = np.full(n_record, None, dtype=object)
+    postal_code[fix_postal] = [f"{code:05d}" for code in postal[fix_postal].tolist()]
+    province_repair = np.full(n_record, None, dtype=object)
+    province_repair[fix_province] = [index.province_names[p] for p in candidate[fix_province].tolist()]
+    return Consistency(score, failed, postal_code, province_repair)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Postal code / location consistency of tagged addresses.")
+    parser.add_argument("input", help="text file with one address per line")
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--repeat", type=int, default=3, help="best of N timings")
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    index = load_consistency_index()
+    index_seconds = time.perf_counter() - started
+    model = load_model(args.model)
+    with open(args.input, encoding="utf-8") as file:
+        texts = [line.rstrip("\r\n") for line in file]
+    batch = tag_texts(model, texts)
+    table = decode_fields(batch)
+
+    consistency, validate_seconds = best_time(lambda: validate(index, batch, table, repair=True), args.repeat)
+    checked = ~np.isnan(consistency.score)
+    print(f"index: {index.nbytes / 2 ** 10:.1f} KB, built in {index_seconds * 1000:.1f} ms")
+    print(f"{len(batch)} records validated and repaired in {validate_seconds * 1000:.1f} ms "
+          f"({len(batch) / validate_seconds * 60 / 1e6:.1f}M records/minute)")
+    print(f"{checked.mean():.1%} of records had something to check; mean score {np.nanmean(consistency.score):.3f}")
+    for check, bit in CHECK_BITS.items():
+        print(f"  {check:<22} failed on {((consistency.failed & bit) != 0).mean():.2%} of records")
+    n_postal = sum(value is not None for value in consistency.postal_code)
+    n_province = sum(value is not None for value in consistency.province)
+    print(f"repaired postal code on {n_postal}, province on {n_province} records")
+
+
+if __name__ == "__main__":
+    main()
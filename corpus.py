@@ -0,0 +1,41 @@
+from tagger import TAG_CODES
+
+# CoNLL-style: one "token<TAB>label" per line, a blank line between addresses.
+# The label is taken after the last tab (or space), so whitespace tokens such
+# as " <TAB>ADDR" survive a round trip.
+
+
+def _split_line(line: str) -> tuple:
+    separator = "\t" if "\t" in line else " "
+    token, _, label = line.rpartition(separator)
+    return token, label
+
+
+def read_conll(path: str) -> list:
+    # [(tokens, labels)] per address
+    sentences = []
+    tokens, labels = [], []
+    with open(path, encoding="utf-8") as file:
+        for line_number, line in enumerate(file, 1):
+            line = line.rstrip("\r\n")
+            if not line.strip("\t"):
+                if tokens:
+                    sentences.append((tokens, labels))
+                    tokens, labels = [], []
+                continue
+            token, label = _split_line(line)
+            if label not in TAG_CODES:
+                raise ValueError(f"{path}:{line_number}: unknown label {label!r}")
+            tokens.append(token)
+            labels.append(label)
+    if tokens:
+        sentences.append((tokens, labels))
+    return sentences
+
+
+def write_conll(path: str, sentences):
+    with open(path, "w", encoding="utf-8") as file:
+        for tokens, labels in sentences:
+            for token, label in zip(tokens, labels):
+                file.write(f"{token}\t{label}\n")
+            file.write("\n")
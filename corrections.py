@@ -0,0 +1,60 @@
+import json
+import os
+import time
+
+from tagger import TAG_CODES
+
+CORRECTIONS_PATH = "corrections/corrections.jsonl"
+
+
+class CorrectionStore:
+    # Append-only JSONL of corrected labelings, one address per line. Lines are
+    # never rewritten, so "the first n corrections" is stable and a retrained
+    # model can record how many it has seen.
+
+    def __init__(self, path: str = CORRECTIONS_PATH):
+        self.path = path
+
+    def append(self, tokens, labels, model_hash: str = None, source: str = None) -> dict:
+        tokens, labels = list(tokens), list(labels)
+        if len(tokens) != len(labels):
+            raise ValueError(f"{len(tokens)} tokens but {len(labels)} labels")
+        unknown = set(labels) - set(TAG_CODES)
+        if unknown:
+            raise ValueError(f"unknown labels {sorted(unknown)}")
+        record = {
+            "time": time.time(),
+            "tokens": tokens,
+            "labels": labels,
+            "model_hash": model_hash,
+            "source": source,
+        }
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        # One write on an O_APPEND descriptor, so concurrent sessions never interleave lines
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+        return record
+
+    def records(self) -> list:
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, encoding="utf-8") as file:
+            # A line cut short by a crash mid-write is skipped, not fatal
+            records = []
+            for line in file:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+            return records
+
+    def sentences(self, start: int = 0) -> list:
+        # [(tokens, labels)] from the start-th correction on
+        return [(record["tokens"], record["labels"]) for record in self.records()[start:]]
+
+    def __len__(self) -> int:
+        return len(self.records())
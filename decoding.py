@@ -0,0 +1,145 @@
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from tagger import MODEL_PATH, TAGS, TAG_CODES, TAG_DTYPE, load_model, sequence_features
+from weights import WEIGHT_DTYPE, forward_backward, load_weight_table, viterbi
+
+
+def kbest_viterbi(transitions: np.ndarray, scores: np.ndarray, k: int) -> tuple:
+    # Top-k tag sequences for (n_token, n_tag) state scores. Every tag keeps its
+    # k best partial paths, so one step is a (n_tag * k, n_tag) sort instead of
+    # a search over all n_tag ** n_token labelings.
+    # Returns ((n_path, n_token) tag codes, (n_path,) scores), best first.
+    n_token, n_tag = scores.shape
+    if not n_token:
+        return np.empty((0, 0), dtype=TAG_DTYPE), np.empty(0, dtype=WEIGHT_DTYPE)
+
+    best = np.full((n_tag, k), -np.inf, dtype=WEIGHT_DTYPE)
+    best[:, 0] = scores[0]
+    # backpointers[i, tag, rank] = previous tag * k + previous rank
+    backpointers = np.empty((n_token, n_tag, k), dtype=np.int32)
+    for i in range(1, n_token):
+        candidates = (best[:, :, None] + transitions[:, None, :]).reshape(n_tag * k, n_tag)
+        top = np.argsort(-candidates, axis=0, kind="stable")[:k]
+        best = np.take_along_axis(candidates, top, axis=0).T + scores[i][:, None]
+        backpointers[i] = top.T
+
+    final = best.ravel()
+    ends = np.argsort(-final, kind="stable")[:k]
+    ends = ends[np.isfinite(final[ends])]
+    # All paths are traced back together
+    paths = np.empty((len(ends), n_token), dtype=TAG_DTYPE)
+    tags, ranks = np.divmod(ends, k)
+    for i in range(n_token - 1, 0, -1):
+        paths[:, i] = tags
+        tags, ranks = np.divmod(backpointers[i, tags, ranks], k)
+    paths[:, 0] = tags
+    return paths, final[ends]
+
+
+class NBestDecoder:
+    # k-best labelings from the exported weights, next to the CRF's own decoding.
+    # A record whose best path beats the runner-up by less than min_margin is
+    # flagged for review.
+
+    def __init__(self, table, k: int = 5, min_margin: float = 1.0):
+        self.table = table
+        self.k = k
+        self.min_margin = min_margin
+
+    def decode(self, sequence) -> tuple:
+        return kbest_viterbi(self.table.transitions, self.table.state_scores(sequence), self.k)
+
+
+class MarginalDecoder:
+    # Best labels and (n_token, n_tag) tag marginals from one lattice per record:
+    # crfsuite's marginals after the same set() its Viterbi runs on, or
+    # forward-backward over the same state scores for a weights.WeightModel
+
+    def __init__(self, model):
+        self.model = model
+        self.tagger = getattr(model, "tagger_", None)
+
+    def decode(self, sequences) -> tuple:
+        # ([labels per record], [marginals per record])
+        predictions = []
+        record_marginals = []
+        if self.tagger is not None:
+            labels = self.tagger.labels()
+            columns = [TAG_CODES[label] for label in labels]
+            for sequence in sequences:
+                self.tagger.set(sequence)
+                predictions.append(self.tagger.tag())
+                marginals = np.empty((len(sequence), len(TAGS)), dtype=np.float32)
+                for i in range(len(sequence)):
+                    marginals[i, columns] = [self.tagger.marginal(label, i) for label in labels]
+                record_marginals.append(marginals)
+            return predictions, record_marginals
+        table = self.model.table
+        for sequence in sequences:
+            scores = table.state_scores(sequence)
+            predictions.append([TAGS[code] for code in viterbi(table, scores)])
+            record_marginals.append(
+                forward_backward(scores, table.transitions)[1].astype(np.float32) if len(sequence)
+                else np.empty((0, len(TAGS)), dtype=np.float32)
+            )
+        return predictions, record_marginals
+
+
+def margins(path_scores: np.ndarray) -> np.ndarray:
+    # Score gap of every path to the best one
+    return path_scores[0] - path_scores if len(path_scores) else path_scores
+
+
+def alternatives(paths: np.ndarray, path_scores: np.ndarray) -> list:
+    return [
+        {"score": float(score), "margin": float(margin), "tags": [TAGS[code] for code in path]}
+        for path, score, margin in zip(paths, path_scores, margins(path_scores))
+    ]
+
+
+def _per_record_seconds(decode, records, repeat: int = 3) -> float:
+    # Best of `repeat` passes, so one noisy pass does not skew the comparison
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for record in records:
+            decode(record)
+        best = min(best, time.perf_counter() - started)
+    return best / max(len(records), 1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cost of k-best decoding against plain decoding.")
+    parser.add_argument("input", help="text file with one address per line")
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--limit", type=int, default=2000, help="addresses to decode")
+    parser.add_argument("--max-k", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    model = load_model(args.model)
+    table = load_weight_table(model)
+    with open(args.input, encoding="utf-8") as file:
+        token_lists = [line.split() for line in file]
+    token_lists = [tokens for tokens in token_lists if tokens][:args.limit]
+    sequences = [sequence_features(tokens) for tokens in token_lists]
+    # Feature extraction and state scores are shared by every decoder, so only decoding is timed
+    state_scores = [table.state_scores(sequence) for sequence in sequences]
+
+    crfsuite = _per_record_seconds(model.predict_single, sequences)
+    plain = _per_record_seconds(lambda scores: viterbi(table, scores), state_scores)
+    print(f"{len(sequences)} addresses, {np.mean([len(tokens) for tokens in token_lists]):.1f} tokens on average",
+          file=sys.stderr)
+    print(f"crfsuite predict_single: {crfsuite * 1e6:8.1f} µs/address", file=sys.stderr)
+    print(f"viterbi (numpy):         {plain * 1e6:8.1f} µs/address", file=sys.stderr)
+    for k in range(1, args.max_k + 1):
+        seconds = _per_record_seconds(lambda scores: kbest_viterbi(table.transitions, scores, k), state_scores)
+        print(f"k-best k={k:<2}:             {seconds * 1e6:8.1f} µs/address ({seconds / plain:.2f}x viterbi)",
+              file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
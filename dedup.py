@@ -0,0 +1,262 @@
+import argparse
+import hashlib
+import unicodedata
+from collections import OrderedDict
+from difflib import SequenceMatcher
+
+import numpy as np
+
+from tagger import MODEL_PATH, load_model, tag_texts
+from timing import best_time
+
+# Near repeats (opt-in): shingle Jaccard at least THRESHOLD, and at most
+# MAX_CHANGED tokens differing per region; the rest is decoded as usual
+THRESHOLD = 0.6
+MAX_CHANGED = 2
+MAX_ENTRIES = 50000
+# 16 bands of 4 rows put a pair with Jaccard 0.6 in a shared bucket ~88% of the time, 0.3 ~12%
+N_PERMUTATION = 64
+N_BAND = 16
+# TaggedBatch.duplicates codes; 0 is a record the CRF decoded
+EXACT = 1
+NEAR = 2
+DUPLICATE_KINDS = {EXACT: "exact", NEAR: "near"}
+
+_MERSENNE = (1 << 61) - 1
+# Zero-width characters and soft hyphens that pasted addresses pick up
+_INVISIBLE = dict.fromkeys(map(ord, "\u200b\u200c\u200d\u2060\ufeff\u00ad"))
+
+
+def normalize(token: str) -> str:
+    return unicodedata.normalize("NFC", token).translate(_INVISIBLE).casefold()
+
+
+def exact_key(tokens) -> bytes:
+    # Records with the same tokens get the same CRF input, whatever the spacing between them
+    return hashlib.blake2b("\x1f".join(tokens).encode("utf-8"), digest_size=16).digest()
+
+
+def shingles(tokens) -> frozenset:
+    # Normalized words and word pairs
+    words = [normalize(token) for token in tokens]
+    return frozenset(words + [first + "\x1f" + second for first, second in zip(words, words[1:])])
+
+
+def jaccard(first: frozenset, second: frozenset) -> float:
+    return len(first & second) / max(len(first | second), 1)
+
+
+class MinHasher:
+    # MinHash signatures cut into bands: records sharing any band are near-duplicate candidates
+
+    def __init__(self, n_permutation: int = N_PERMUTATION, n_band: int = N_BAND, seed: int = 0):
+        state = np.random.RandomState(seed)
+        # a * (32-bit hash) + b stays under 2 ** 63
+        self.a = state.randint(1, 2 ** 31, n_permutation).astype(np.uint64)[:, None]
+        self.b = state.randint(0, 2 ** 31, n_permutation).astype(np.uint64)[:, None]
+        self.n_band = n_band
+        self.band_mix = state.randint(1, 2 ** 62, n_permutation // n_band).astype(np.uint64)
+
+    def bands(self, shingle_sets) -> list:
+        # Band keys of every set, all signatures computed in one pass over the batch.
+        # Python's string hash differs between processes, but signatures never leave this one.
+        sizes = np.array([len(shingle_set) for shingle_set in shingle_sets], dtype=np.int64)
+        if not sizes.sum():
+            return [[] for _ in shingle_sets]
+        hashes = np.fromiter((hash(shingle) & 0xFFFFFFFF for shingle_set in shingle_sets for shingle in shingle_set),
+                             dtype=np.uint64, count=int(sizes.sum()))
+        nonempty = sizes > 0
+        starts = np.r_[0, np.cumsum(sizes)[:-1]][nonempty]
+        signatures = np.minimum.reduceat((self.a * hashes + self.b) % _MERSENNE, starts, axis=1).T
+        # Every band's rows mixed into one integer (wrapping), tagged with the band number
+        mixed = (signatures.reshape(len(starts), self.n_band, -1) * self.band_mix).sum(axis=2)
+        keys = (mixed << np.uint64(6)) | np.arange(self.n_band, dtype=np.uint64)
+        bands = [[] for _ in shingle_sets]
+        for i, record_keys in zip(np.flatnonzero(nonempty).tolist(), keys.tolist()):
+            bands[i] = record_keys
+        return bands
+
+
+def transfer_codes(source_tokens, source_codes, tokens, max_changed: int = MAX_CHANGED):
+    # Tag codes for `tokens` from a near repeat's, or None when that is not safe:
+    # tokens both share are copied, and a differing region is filled with the tag
+    # on both sides of it (a different name inside an O run, say), but only when
+    # the source tagged the region and every neighbour alike and it is short
+    codes = []
+    matcher = SequenceMatcher(None, source_tokens, tokens, autojunk=False)
+    for operation, i1, i2, j1, j2 in matcher.get_opcodes():
+        if operation == "equal":
+            codes.extend(source_codes[i1:i2])
+            continue
+        if max(i2 - i1, j2 - j1) > max_changed:
+            return None
+        around = set(source_codes[max(i1 - 1, 0):min(i2 + 1, len(source_codes))])
+        if len(around) != 1 or (i1 == 0 and i2 == len(source_codes)):
+            return None
+        code = next(iter(around))
+        codes.extend([code] * (j2 - j1))
+    return codes
+
+
+def check_transfer_codes():
+    # A different title and first name: a two-token region inside the O run gets O for both
+    codes = transfer_codes(["นาย", "สมชาย", "เข็มกลัด", "254", "ถนน"], [0, 0, 0, 1, 1],
+                           ["นาง", "สมหญิง", "เข็มกลัด", "254", "ถนน"])
+    if codes != [0, 0, 0, 1, 1]:
+        raise AssertionError(f"two-token substitution transferred as {codes}")
+
+
+class _Entry:
+    # A decoded record; codes (and alternatives or marginals, with those
+    # decoders) are filled in once its batch is decoded
+
+    __slots__ = ("tokens", "shingles", "codes", "alternatives", "marginals")
+
+    def __init__(self, tokens, shingle_set):
+        self.tokens = tokens
+        self.shingles = shingle_set
+        self.codes = None
+        self.alternatives = None
+        self.marginals = None
+
+
+class Deduplicator:
+    # Remembers the last max_entries decoded records by exact key, and with near
+    # their MinHash bands, across batches. split() sends a record to the CRF only
+    # when it neither repeats one of them nor, with near, nearly repeats one whose
+    # tags carry over. Exact repeats always get the tags the CRF would give them;
+    # near repeats only usually do (the CRF can relabel a whole address over a
+    # different name), so compare() measures how often on real input first.
+
+    def __init__(self, near: bool = False, threshold: float = THRESHOLD, max_changed: int = MAX_CHANGED,
+                 max_entries: int = MAX_ENTRIES, hasher: MinHasher = None):
+        self.near = near
+        self.threshold = threshold
+        self.max_changed = max_changed
+        self.max_entries = max_entries
+        self.hasher = hasher or MinHasher()
+        # Least recently used first, so memory stays bounded on endless input
+        self.entries = OrderedDict()
+        self.buckets = OrderedDict()
+
+    def _entry(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def _near(self, shingle_set: frozenset, bands: list):
+        best, best_similarity = None, self.threshold
+        for band in bands:
+            candidate = self.entries.get(self.buckets.get(band))
+            if candidate is not None:
+                similarity = jaccard(shingle_set, candidate.shingles)
+                if similarity >= best_similarity:
+                    best, best_similarity = candidate, similarity
+        return best
+
+    def _add(self, key: bytes, entry: _Entry, bands: list) -> _Entry:
+        self.entries[key] = entry
+        for band in bands:
+            self.buckets[band] = key
+            self.buckets.move_to_end(band)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        while len(self.buckets) > self.max_entries * self.hasher.n_band:
+            self.buckets.popitem(last=False)
+        return entry
+
+    def add(self, tokens) -> _Entry:
+        if not self.near:
+            return self._add(exact_key(tokens), _Entry(tokens, None), [])
+        entry = _Entry(tokens, shingles(tokens))
+        return self._add(exact_key(tokens), entry, self.hasher.bands([entry.shingles])[0])
+
+    def split(self, tokens, records, near: bool = True) -> tuple:
+        # ([(record, entry to fill in)] to decode, [(record, entry, EXACT or NEAR)] to copy);
+        # copies may point at entries of this same batch, so resolve them after decoding.
+        # near=False turns near repeats off for this batch only.
+        records = list(records)
+        keys = [exact_key(tokens[record]) for record in records]
+        near = near and self.near
+        if near:
+            # Signatures only for the first of each key not seen before
+            first = {}
+            for record, key in zip(records, keys):
+                if key not in self.entries:
+                    first.setdefault(key, record)
+            shingle_sets = {key: shingles(tokens[record]) for key, record in first.items()}
+            bands = dict(zip(shingle_sets, self.hasher.bands(list(shingle_sets.values()))))
+        decode = []
+        copies = []
+        for record, key in zip(records, keys):
+            entry = self._entry(key)
+            if entry is not None:
+                copies.append((record, entry, EXACT))
+                continue
+            if not near:
+                decode.append((record, self._add(key, _Entry(tokens[record], None), [])))
+                continue
+            source = self._near(shingle_sets[key], bands[key])
+            if source is not None:
+                copies.append((record, source, NEAR))
+                continue
+            decode.append((record, self._add(key, _Entry(tokens[record], shingle_sets[key]), bands[key])))
+        return decode, copies
+
+    def copy(self, tokens, entry: _Entry, kind: int):
+        # Codes for a record split() matched to entry, None when a near repeat must be decoded after all
+        if kind == EXACT:
+            return entry.codes
+        return transfer_codes(entry.tokens, entry.codes, tokens, self.max_changed)
+
+
+def compare(model, texts, deduplicator_factory=Deduplicator, repeat: int = 3) -> dict:
+    # Every timing starts from an empty deduplicator
+    crf_batch, crf_seconds = best_time(lambda: tag_texts(model, texts), repeat)
+    batch, dedup_seconds = best_time(lambda: tag_texts(model, texts, deduplicator=deduplicator_factory()), repeat)
+    token_duplicates = np.repeat(batch.duplicates, np.diff(batch.offsets))
+    agreement = {}
+    for kind, name in DUPLICATE_KINDS.items():
+        tokens = token_duplicates == kind
+        agreement[name] = float((batch.tags[tokens] == crf_batch.tags[tokens]).mean()) if tokens.any() else 1.0
+    return {
+        "records": len(texts),
+        "exact": int((batch.duplicates == EXACT).sum()),
+        "near": int((batch.duplicates == NEAR).sum()),
+        "crf_seconds": crf_seconds,
+        "dedup_seconds": dedup_seconds,
+        "speedup": crf_seconds / dedup_seconds,
+        "agreement": agreement,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare tagging with repeated records copied against the pure CRF.")
+    parser.add_argument("input", help="text file with one address per line")
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--near", action="store_true", help="also copy tags between near repeats")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD)
+    parser.add_argument("--max-changed", type=int, default=MAX_CHANGED)
+    parser.add_argument("--repeat", type=int, default=3, help="best of N timings")
+    args = parser.parse_args(argv)
+
+    with open(args.input, encoding="utf-8") as file:
+        texts = [line.rstrip("\r\n") for line in file]
+
+    check_transfer_codes()
+    report = compare(load_model(args.model), texts,
+                     lambda: Deduplicator(args.near, args.threshold, args.max_changed), args.repeat)
+    decoded = report["records"] - report["exact"] - report["near"]
+    print(f"records:                {report['records']}")
+    print(f"exact repeats copied:   {report['exact']} ({report['exact'] / max(report['records'], 1):.1%})")
+    print(f"near repeats copied:    {report['near']} ({report['near'] / max(report['records'], 1):.1%})")
+    print(f"decoded:                {decoded} ({1 - decoded / max(report['records'], 1):.1%} of decodes saved)")
+    print(f"pure CRF:               {report['crf_seconds']:.3f}s")
+    print(f"with repeats copied:    {report['dedup_seconds']:.3f}s ({report['speedup']:.2f}x)")
+    print(f"agreement, exact:       {report['agreement']['exact']:.1%}")
+    print(f"agreement, near:        {report['agreement']['near']:.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+import argparse
+import json
+import re
+import sys
+import time
+
+import numpy as np
+
+from fields import FIELDS, decode_fields
+from gazetteer import PROVINCE_ALIASES, load_gazetteer
+from tagger import MODEL_PATH, TAG_CODES, load_model, tag_texts
+from tokenization import tokenize_spans
+
+# e.g. 123/4
+_HOUSE_NUMBER_PATTERN = re.compile(r"\d+/\d+")
+
+
+class AnchorScanner:
+    # Cheap per-token check for things that only show up near an address
+
+    def __init__(self, gazetteer):
+        self.postal_prefixes = gazetteer.postal_code_prefixes()
+        self.words = gazetteer.keywords() | gazetteer.provinces | set(PROVINCE_ALIASES)
+
+    def is_anchor(self, token: str) -> bool:
+        if token.isdigit():
+            return len(token) == 5 and token[:2] in self.postal_prefixes
+        return token in self.words or _HOUSE_NUMBER_PATTERN.fullmatch(token) is not None
+
+    def anchors(self, tokens) -> np.ndarray:
+        return np.fromiter((i for i, token in enumerate(tokens) if self.is_anchor(token)), dtype=np.int64)
+
+
+def candidate_regions(
+    anchors: np.ndarray,
+    n_token: int,
+    before: int = 12,
+    after: int = 4,
+    max_tokens: int = 64,
+    min_anchors: int = 2,
+) -> list:
+    # Bounded windows around anchors, merged while they overlap; no two regions share a token.
+    # A lone anchor is usually an ordinary word that happens to be a place name (เลย, ตาก)
+    if before + after + 1 > max_tokens:
+        raise ValueError(f"a window of {before} + 1 + {after} tokens is longer than max_tokens={max_tokens}")
+    regions = []
+    for anchor in anchors.tolist():
+        start, end = max(anchor - before, 0), min(anchor + after + 1, n_token)
+        if regions and start <= regions[-1][1]:
+            region_start, region_end = regions[-1]
+            if end - region_start <= max_tokens:
+                regions[-1] = (region_start, max(region_end, end))
+                continue
+            # Too long: the region closes where this anchor's own window starts, so
+            # the address around the anchor is tagged whole, with its left context
+            if start > region_start:
+                regions[-1] = (region_start, start)
+            else:
+                regions.pop()
+        regions.append((start, end))
+    if not regions:
+        return []
+    bounds = np.array(regions, dtype=np.int64)
+    counts = np.searchsorted(anchors, bounds[:, 1]) - np.searchsorted(anchors, bounds[:, 0])
+    return [region for region, count in zip(regions, counts.tolist()) if count >= min_anchors]
+
+
+def extract_addresses(model, text: str, scanner: AnchorScanner, spans=None, **window) -> tuple:
+    # Tag only the candidate regions; returns (addresses, number of tokens tagged)
+    if spans is None:
+        spans = tokenize_spans(text)
+    tokens = [text[start:end] for start, end in spans.tolist()]
+    regions = candidate_regions(scanner.anchors(tokens), len(tokens), **window)
+    if not regions:
+        return [], 0
+
+    # Every region is a record over the same document text
+    batch = tag_texts(model, [text] * len(regions), [spans[start:end] for start, end in regions])
+    table = decode_fields(batch)
+    table_bounds = np.searchsorted(table.record, np.arange(len(regions) + 1))
+
+    addresses = []
+    for record in range(len(regions)):
+        tags = batch.tags[batch.offsets[record]:batch.offsets[record + 1]]
+        if not np.isin(tags, (TAG_CODES["LOC"], TAG_CODES["POST"])).any():
+            continue
+        # Trim the surrounding context the model left as O
+        tagged = np.flatnonzero(tags != TAG_CODES["O"])
+        first = batch.offsets[record] + tagged[0]
+        last = batch.offsets[record] + tagged[-1]
+        start, end = int(batch.spans[first, 0]), int(batch.spans[last, 1])
+
+        address = {"char_start": start, "char_end": end, "text": text[start:end]}
+        address.update(dict.fromkeys(FIELDS))
+        for row in range(table_bounds[record], table_bounds[record + 1]):
+            if table.token_start[row] < first or table.token_end[row] > last + 1:
+                continue
+            field = FIELDS[table.field[row]]
+            value = text[table.char_start[row]:table.char_end[row]]
+            address[field] = value if address[field] is None else address[field] + " " + value
+        addresses.append(address)
+    return addresses, int(batch.offsets[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Extract addresses from long documents.")
+    parser.add_argument("documents", nargs="+", help="text files, one document each")
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--before", type=int, default=12, help="tokens kept before an anchor")
+    parser.add_argument("--after", type=int, default=4, help="tokens kept after an anchor")
+    parser.add_argument("--max-tokens", type=int, default=64, help="longest region passed to the CRF")
+    parser.add_argument("--min-anchors", type=int, default=2, help="anchors needed before a region is tagged")
+    args = parser.parse_args(argv)
+    if args.before + args.after + 1 > args.max_tokens:
+        parser.error(f"--before + --after + 1 ({args.before + args.after + 1}) is more than --max-tokens ({args.max_tokens})")
+
+    model = load_model(args.model)
+    scanner = AnchorScanner(load_gazetteer())
+    window = {"before": args.before, "after": args.after, "max_tokens": args.max_tokens, "min_anchors": args.min_anchors}
+
+    n_byte = n_token = n_tagged = 0
+    started = time.perf_counter()
+    for path in args.documents:
+        with open(path, encoding="utf-8") as file:
+            text = file.read()
+        spans = tokenize_spans(text)
+        addresses, tagged = extract_addresses(model, text, scanner, spans, **window)
+        for address in addresses:
+            print(json.dumps({"document": path, **address}, ensure_ascii=False))
+        n_byte += len(text.encode("utf-8"))
+        n_token += len(spans)
+        n_tagged += tagged
+
+    elapsed = time.perf_counter() - started
+    megabytes = n_byte / 2 ** 20
+    print(
+        f"{megabytes:.2f} MB in {elapsed:.2f}s ({megabytes / max(elapsed, 1e-9):.2f} MB/s), "
+        f"CRF ran on {n_tagged / max(n_token, 1):.1%} of {n_token} tokens",
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+import argparse
+import json
+import os
+import time
+from multiprocessing import Pool
+
+import numpy as np
+
+from corpus import read_conll
+from metrics import confusion_matrix, span_counts, span_scores, tag_scores
+from tagger import MODEL_PATH, TAG_DTYPE, TAGS, encode_tags, load_model, sequence_features
+
+BACKENDS = ["crfsuite", "weights", "pretag"]
+PERCENTILES = [50, 90, 95, 99]
+
+_decode = None
+
+
+def make_decoder(model_path: str, backend: str):
+    # Every backend maps a token list to tag codes
+    model = load_model(model_path)
+    if backend == "weights":
+        from weights import load_weight_table, viterbi
+
+        table = load_weight_table(model)
+        return lambda tokens: viterbi(table, table.state_scores(sequence_features(tokens)))
+    if backend == "pretag":
+        from pretagger import load_pretagger
+
+        pretagger = load_pretagger()
+
+        def decode(tokens):
+            codes = pretagger.resolve(tokens)
+            if codes is None:
+                return encode_tags(model.predict_single(sequence_features(tokens)))
+            return np.array(codes, dtype=TAG_DTYPE)
+
+        return decode
+    return lambda tokens: encode_tags(model.predict_single(sequence_features(tokens)))
+
+
+def _init_worker(model_path: str, backend: str):
+    global _decode
+    _decode = make_decoder(model_path, backend)
+
+
+def evaluate_shard(sentences) -> dict:
+    confusion = np.zeros((len(TAGS), len(TAGS)), dtype=np.int64)
+    spans = np.zeros((len(TAGS), 3), dtype=np.int64)
+    latencies = np.empty(len(sentences), dtype=np.float64)
+    n_exact = 0
+    for i, (tokens, labels) in enumerate(sentences):
+        started = time.perf_counter()
+        predicted = _decode(tokens)
+        latencies[i] = time.perf_counter() - started
+        expected = encode_tags(labels)
+        confusion += confusion_matrix(expected, predicted)
+        spans += span_counts(expected, predicted)
+        n_exact += bool((expected == predicted).all())
+    return {"confusion": confusion, "spans": spans, "latencies": latencies, "exact": n_exact}
+
+
+def evaluate(sentences, model_path: str, backend: str, workers: int, shard_size: int) -> dict:
+    shards = [sentences[start:start + shard_size] for start in range(0, len(sentences), shard_size)]
+    started = time.perf_counter()
+    with Pool(workers, initializer=_init_worker, initargs=(model_path, backend)) as pool:
+        results = pool.map(evaluate_shard, shards)
+    elapsed = time.perf_counter() - started
+
+    # Start values keep an empty corpus at zero counts
+    confusion = sum((result["confusion"] for result in results), np.zeros((len(TAGS), len(TAGS)), dtype=np.int64))
+    span_totals = sum((result["spans"] for result in results), np.zeros((len(TAGS), 3), dtype=np.int64))
+    latencies = np.concatenate([result["latencies"] for result in results]) if results else np.empty(0)
+    n_token = sum(len(tokens) for tokens, _ in sentences)
+    # Throughput of one process over decode time alone; wall time also holds pool
+    # start-up and every worker's model load, which dominate small corpora
+    decode_seconds = float(latencies.sum())
+    return {
+        "addresses": len(sentences),
+        "tokens": n_token,
+        "token_accuracy": float(np.trace(confusion) / max(confusion.sum(), 1)),
+        "tags": tag_scores(confusion),
+        "spans": span_scores(span_totals),
+        "exact_match": sum(result["exact"] for result in results) / max(len(sentences), 1),
+        "confusion": confusion.tolist(),
+        "wall_seconds": elapsed,
+        "decode_seconds": decode_seconds,
+        "addresses_per_second": len(sentences) / max(decode_seconds, 1e-9),
+        "tokens_per_second": n_token / max(decode_seconds, 1e-9),
+        "latency_ms": {
+            f"p{percentile}": float(value) * 1000
+            for percentile, value in zip(PERCENTILES, np.percentile(latencies, PERCENTILES) if len(latencies) else [0] * 4)
+        },
+    }
+
+
+def print_report(report: dict):
+    print(f"{report['addresses']} addresses, {report['tokens']} tokens")
+    print(f"token accuracy {report['token_accuracy']:.4f}, address exact match {report['exact_match']:.4f}")
+    print()
+    print(f"{'':6}{'token P':>9}{'R':>8}{'F1':>8}{'span P':>9}{'R':>8}{'F1':>8}{'support':>9}")
+    for tag in TAGS:
+        token = report["tags"][tag]
+        span = report["spans"].get(tag)
+        # O is never a span
+        span_columns = (f"{span['precision']:9.4f}{span['recall']:8.4f}{span['f1']:8.4f}" if span
+                        else f"{'-':>9}{'-':>8}{'-':>8}")
+        print(f"{tag:6}{token['precision']:9.4f}{token['recall']:8.4f}{token['f1']:8.4f}"
+              f"{span_columns}{token['support']:9d}")
+    print()
+    print("confusion (rows: true, columns: predicted)")
+    print(f"{'':6}" + "".join(f"{tag:>8}" for tag in TAGS))
+    for tag, row in zip(TAGS, report["confusion"]):
+        print(f"{tag:6}" + "".join(f"{count:8d}" for count in row))
+    print()
+    latency = ", ".join(f"{name} {value:.3f}" for name, value in report["latency_ms"].items())
+    print(f"{report['addresses_per_second']:.0f} addresses/s, {report['tokens_per_second']:.0f} tokens/s per process "
+          f"over {report['decode_seconds']:.2f}s of decoding ({report['wall_seconds']:.2f}s wall with start-up); "
+          f"latency ms per address: {latency}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Score a model and decoding path against a labeled corpus.")
+    parser.add_argument("corpus", help="CoNLL-style file: token<TAB>label per line, blank line between addresses")
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--backend", choices=BACKENDS, default="crfsuite",
+                        help="crfsuite: model.predict; weights: numpy Viterbi over the weight table; "
+                             "pretag: gazetteer first, CRF for the rest")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--shard-size", type=int, default=1000, help="addresses per shard")
+    parser.add_argument("--json", help="also write the report as JSON")
+    args = parser.parse_args(argv)
+
+    report = evaluate(read_conll(args.corpus), args.model, args.backend, args.workers, args.shard_size)
+    report.update(model=args.model, backend=args.backend, corpus=args.corpus)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+import json
+
+import numpy as np
+
+from decoding import alternatives
+from dedup import DUPLICATE_KINDS
+from gazetteer import DISTRICT_KEYWORDS, PROVINCE_KEYWORDS, SUB_DISTRICT_KEYWORDS
+from tagger import TAG_CODES
+
+FIELDS = ["name", "address", "sub_district", "district", "province", "postal_code"]
+FIELD_CODES = {field: code for code, field in enumerate(FIELDS)}
+FIELD_DTYPE = np.int8
+
+# Keywords name the LOC that follows them; they are not part of its value
+LOC_KEYWORDS = {}
+for _field, _keywords in [
+    ("sub_district", SUB_DISTRICT_KEYWORDS),
+    ("district", DISTRICT_KEYWORDS),
+    ("province", PROVINCE_KEYWORDS),
+]:
+    LOC_KEYWORDS.update(dict.fromkeys(_keywords, FIELD_CODES[_field]))
+
+# Field of every non-LOC tag
+_TAG_FIELDS = np.full(len(TAG_CODES), -1, dtype=FIELD_DTYPE)
+_TAG_FIELDS[TAG_CODES["O"]] = FIELD_CODES["name"]
+_TAG_FIELDS[TAG_CODES["ADDR"]] = FIELD_CODES["address"]
+_TAG_FIELDS[TAG_CODES["POST"]] = FIELD_CODES["postal_code"]
+
+
+class FieldTable:
+    # One row per contiguous field span: record id, field code,
+    # [token_start, token_end) into the batch and [char_start, char_end) into the record text
+
+    def __init__(self, record, field, token_start, token_end, char_start, char_end):
+        self.record = record
+        self.field = field
+        self.token_start = token_start
+        self.token_end = token_end
+        self.char_start = char_start
+        self.char_end = char_end
+
+    def __len__(self):
+        return len(self.record)
+
+
+def token_fields(batch) -> np.ndarray:
+    # Field code per token, -1 for LOC keywords that only label the next LOC
+    tags = batch.tags
+    record = batch.record_ids()
+    fields = _TAG_FIELDS[tags]
+
+    keyword = np.fromiter((LOC_KEYWORDS.get(token, -1) for token in batch.tokens), dtype=FIELD_DTYPE, count=len(tags))
+    is_loc = tags == TAG_CODES["LOC"]
+    fields[is_loc & (keyword >= 0)] = -1
+
+    # A keyword directly before a LOC name decides its slot
+    prev_keyword = np.full(len(tags), -1, dtype=FIELD_DTYPE)
+    prev_keyword[1:] = np.where(record[1:] == record[:-1], keyword[:-1], -1)
+
+    names = np.flatnonzero(is_loc & (keyword < 0))
+    name_record = record[names]
+    # Unlabelled names fill slots from the right: province, district, then sub-district
+    last = np.searchsorted(name_record, name_record, side="right")
+    rank_from_right = last - 1 - np.arange(len(names))
+    positional = np.maximum(FIELD_CODES["province"] - rank_from_right, FIELD_CODES["sub_district"])
+
+    fields[names] = np.where(prev_keyword[names] >= 0, prev_keyword[names], positional)
+    return fields
+
+
+def decode_fields(batch) -> FieldTable:
+    fields = token_fields(batch)
+    record = batch.record_ids()
+
+    kept = np.flatnonzero(fields >= 0)
+    kept_record = record[kept]
+    kept_field = fields[kept]
+
+    # A new span starts at a record boundary, a field change or a skipped keyword
+    starts = np.ones(len(kept), dtype=bool)
+    starts[1:] = (
+        (kept_record[1:] != kept_record[:-1])
+        | (kept_field[1:] != kept_field[:-1])
+        | (kept[1:] != kept[:-1] + 1)
+    )
+    start_index = np.flatnonzero(starts)
+    end_index = np.append(start_index[1:], len(kept)) - 1
+
+    token_start = kept[start_index]
+    token_end = kept[end_index] + 1
+    return FieldTable(
+        record=kept_record[start_index],
+        field=kept_field[start_index],
+        token_start=token_start,
+        token_end=token_end,
+        char_start=batch.spans[token_start, 0] if len(kept) else np.empty(0, dtype=np.int32),
+        char_end=batch.spans[token_end - 1, 1] if len(kept) else np.empty(0, dtype=np.int32),
+    )
+
+
+def last_rows(table: FieldTable, field: str) -> tuple:
+    # (records, table rows) of the last span of `field` in every record that has one
+    rows = np.flatnonzero(table.field == FIELD_CODES[field])
+    records = table.record[rows]
+    last = rows[np.r_[records[1:] != records[:-1], True]] if len(rows) else rows
+    return table.record[last], last
+
+
+def record_values(batch, table: FieldTable, field: str) -> np.ndarray:
+    # The last span of `field` in every record, "" where there is none
+    records, rows = last_rows(table, field)
+    values = np.full(len(batch), "", dtype=object)
+    values[records] = [
+        batch.texts[record][start:end]
+        for record, start, end in zip(records.tolist(), table.char_start[rows].tolist(), table.char_end[rows].tolist())
+    ]
+    return values
+
+
+def iter_records(batch, table: FieldTable):
+    # Per-record dicts are only built here, at output time
+    bounds = np.searchsorted(table.record, np.arange(len(batch) + 1))
+    for record, text in enumerate(batch.texts):
+        values = {field: [] for field in FIELDS}
+        canonical = {}
+        spans = []
+        for row in range(bounds[record], bounds[record + 1]):
+            field = FIELDS[table.field[row]]
+            start, end = int(table.char_start[row]), int(table.char_end[row])
+            values[field].append(text[start:end])
+            spans.append([field, start, end])
+            if batch.canonical is not None and batch.canonical.names[row] is not None:
+                canonical.setdefault(field, []).append(batch.canonical.names[row])
+        output = {"text": text}
+        output.update({field: " ".join(value) if value else None for field, value in values.items()})
+        output["spans"] = spans
+        if batch.canonical is not None:
+            # Official gazetteer names of the LOC fields that matched one
+            output["canonical"] = {field: " ".join(names) for field, names in canonical.items()}
+        if batch.alternatives is not None:
+            margin = float(batch.margins[record])
+            output["margin"] = margin if np.isfinite(margin) else None
+            output["low_confidence"] = bool(batch.low_confidence[record])
+            output["alternatives"] = alternatives(*batch.alternatives[record]) if batch.alternatives[record] else None
+        if batch.confidence is not None:
+            # Lowest marginal probability of a chosen tag in the record
+            output["confidence"] = float(batch.confidence[record])
+        if batch.duplicates is not None:
+            # "exact" or "near" where the tags were copied from an earlier record
+            output["duplicate"] = DUPLICATE_KINDS.get(int(batch.duplicates[record]))
+        if batch.consistency is not None:
+            score = float(batch.consistency.score[record])
+            output["consistency"] = score if np.isfinite(score) else None
+            output["inconsistent"] = batch.consistency.failed_checks(record)
+            repairs = batch.consistency.repairs(record)
+            if repairs:
+                # Fields carry the repaired values; "repaired" keeps what was tagged
+                output["repaired"] = {field: output[field] for field in repairs}
+                output.update(repairs)
+        yield output
+
+
+def write_jsonl(file, batch, table: FieldTable):
+    for output in iter_records(batch, table):
+        file.write(json.dumps(output, ensure_ascii=False))
+        file.write("\n")
+
+
+def to_arrow(batch, table: FieldTable, record_offset: int = 0):
+    # Long format: one row per field span
+    import pyarrow as pa
+
+    values = [
+        batch.texts[record][start:end]
+        for record, start, end in zip(table.record.tolist(), table.char_start.tolist(), table.char_end.tolist())
+    ]
+    columns = {
+        "record": pa.array(table.record + record_offset, type=pa.int64()),
+        "field": pa.DictionaryArray.from_arrays(
+            pa.array(table.field, type=pa.int8()),
+            pa.array(FIELDS),
+        ),
+        "char_start": pa.array(table.char_start, type=pa.int32()),
+        "char_end": pa.array(table.char_end, type=pa.int32()),
+        "value": pa.array(values, type=pa.string()),
+    }
+    if batch.margins is not None:
+        # Record-level confidence repeated on each of its rows
+        columns["margin"] = pa.array(batch.margins[table.record], type=pa.float32())
+        columns["low_confidence"] = pa.array(batch.low_confidence[table.record], type=pa.bool_())
+    if batch.confidence is not None:
+        columns["confidence"] = pa.array(batch.confidence[table.record], type=pa.float32())
+    if batch.duplicates is not None:
+        # dedup.EXACT or dedup.NEAR where copied, 0 where decoded
+        columns["duplicate"] = pa.array(batch.duplicates[table.record], type=pa.int8())
+    if batch.consistency is not None:
+        consistency = batch.consistency
+        columns["consistency"] = pa.array(consistency.score[table.record], type=pa.float32())
+        # Bitmask over consistency.CHECKS
+        columns["inconsistent"] = pa.array(consistency.failed[table.record], type=pa.int8())
+        repaired = np.full(len(table), None, dtype=object)
+        for field, values in [("postal_code", consistency.postal_code), ("province", consistency.province)]:
+            if values is not None:
+                rows = table.field == FIELD_CODES[field]
+                repaired[rows] = values[table.record[rows]]
+        columns["repaired"] = pa.array(repaired, type=pa.string())
+    if batch.canonical is not None:
+        columns["canonical"] = pa.array(batch.canonical.names, type=pa.string())
+        # Edits between value and canonical, -1 where there is no canonical name
+        columns["canonical_distance"] = pa.array(batch.canonical.distances, type=pa.int8())
+    return pa.table(columns)
@@ -0,0 +1,56 @@
+import csv
+
+GAZETTEER_PATH = "data/gazetteer.tsv"
+PROVINCES_PATH = "data/provinces.tsv"
+
+SUB_DISTRICT_KEYWORDS = ["แขวง", "ตำบล", "ต."]
+DISTRICT_KEYWORDS = ["เขต", "อำเภอ", "อ."]
+PROVINCE_KEYWORDS = ["จังหวัด", "จ."]
+ADDRESS_KEYWORDS = [
+    "เลขที่", "บ้านเลขที่", "หมู่", "หมู่ที่", "ม.", "หมู่บ้าน", "อาคาร", "ชั้น", "ห้อง",
+    "ซอย", "ซ.", "ตรอก", "ถนน", "ถ.",
+]
+
+# Common short forms of province names
+PROVINCE_ALIASES = {
+    "กรุงเทพ": "กรุงเทพมหานคร",
+    "กรุงเทพฯ": "กรุงเทพมหานคร",
+    "กทม": "กรุงเทพมหานคร",
+    "กทม.": "กรุงเทพมหานคร",
+}
+
+
+class Gazetteer:
+    # entries are (sub_district, district, province, postal_code) rows, "" where unknown
+
+    def __init__(self, entries, postal_prefixes):
+        self.entries = entries
+        self.postal_prefixes = postal_prefixes
+        self.sub_districts = {entry[0] for entry in entries if entry[0]}
+        self.districts = {entry[1] for entry in entries if entry[1]}
+        self.provinces = set(postal_prefixes) | {entry[2] for entry in entries if entry[2]}
+
+    def names(self) -> set:
+        return self.sub_districts | self.districts | self.provinces | set(PROVINCE_ALIASES)
+
+    def postal_code_prefixes(self) -> set:
+        prefixes = set(self.postal_prefixes.values())
+        prefixes.update(entry[3][:2] for entry in self.entries if entry[3])
+        return prefixes
+
+    def keywords(self) -> set:
+        return set(SUB_DISTRICT_KEYWORDS + DISTRICT_KEYWORDS + PROVINCE_KEYWORDS + ADDRESS_KEYWORDS)
+
+
+def _read_tsv(path):
+    with open(path, encoding="utf-8", newline="") as file:
+        return list(csv.DictReader(file, delimiter="\t"))
+
+
+def load_gazetteer(path: str = GAZETTEER_PATH, provinces_path: str = PROVINCES_PATH) -> Gazetteer:
+    entries = [
+        (row["sub_district"], row["district"], row["province"], row["postal_code"])
+        for row in _read_tsv(path)
+    ]
+    postal_prefixes = {row["province"]: row["postal_prefix"] for row in _read_tsv(provinces_path)}
+    return Gazetteer(entries, postal_prefixes)
@@ -0,0 +1,175 @@
+import argparse
+import logging
+import os
+import threading
+import time
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+INTERACTIONS = ["analyze", "shuffle", "word"]
+PERCENTILES = [50, 95, 99]
+
+
+class ResourceSampler:
+    # Samples this process's RSS in the background; CPU comes from cpu_times deltas
+
+    def __init__(self, interval: float = 0.1):
+        import psutil
+
+        self.process = psutil.Process()
+        self.interval = interval
+        self.peak_rss = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.stopped.is_set():
+            self.peak_rss = max(self.peak_rss, self.process.memory_info().rss)
+            self.stopped.wait(self.interval)
+
+    def __enter__(self):
+        self.cpu_started = sum(self.process.cpu_times()[:2])
+        self.wall_started = time.perf_counter()
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+        self.peak_rss = max(self.peak_rss, self.process.memory_info().rss)
+        self.cpu_seconds = sum(self.process.cpu_times()[:2]) - self.cpu_started
+        self.wall_seconds = time.perf_counter() - self.wall_started
+
+
+def _timed(latencies, session_id, interaction, element):
+    started = time.perf_counter()
+    app = element.run()
+    latencies.append((session_id, interaction, time.perf_counter() - started, bool(app.exception)))
+    return app
+
+
+def _button(app, label: str):
+    # By label: the correction and review "Open" buttons shift positions around
+    for button in app.button:
+        if button.label == label:
+            return button
+    raise ValueError(f"no {label!r} button in {[button.label for button in app.button]}")
+
+
+def run_session(script: str, session_id: int, n_word: int, timeout: float, latencies: list):
+    # One analyst: Analyze -> Shuffle (the summary tab renders in the same rerun) -> switch words
+    from streamlit.testing.v1 import AppTest
+
+    app = AppTest.from_file(script, default_timeout=timeout).run()
+    app = _timed(latencies, session_id, "analyze", _button(app, "Analyze !").click())
+    app = _timed(latencies, session_id, "shuffle", _button(app, "Shuffle Text").click())
+    words = [group for group in app.get("button_group") if group.label == "Word"]
+    if not words:
+        return
+    options = list(words[0].options)
+    for word in options[1:n_word + 1]:
+        words = [group for group in app.get("button_group") if group.label == "Word"]
+        app = _timed(latencies, session_id, "word", words[0].set_value(word))
+
+
+def run_worker(job) -> tuple:
+    # A worker is one server process; its sessions share it as threads, as Streamlit's do
+    worker_id, script, n_session, n_word, timeout = job
+    logging.disable(logging.WARNING)
+    latencies = []
+    failures = []
+
+    def session(session_id):
+        try:
+            run_session(script, session_id, n_word, timeout, latencies)
+        except Exception as error:
+            failures.append(error)
+
+    with ResourceSampler() as sampler:
+        threads = [threading.Thread(target=session, args=(session_id,)) for session_id in range(n_session)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    if failures:
+        # A session that could not run its interactions would otherwise just be missing from the table
+        raise failures[0]
+    resources = {
+        "worker": worker_id,
+        "sessions": n_session,
+        "cpu_percent": sampler.cpu_seconds / sampler.wall_seconds * 100,
+        "peak_rss_mb": sampler.peak_rss / 2 ** 20,
+        "wall_seconds": sampler.wall_seconds,
+    }
+    return latencies, resources
+
+
+def run_configuration(script: str, n_session: int, n_worker: int, n_word: int, timeout: float) -> tuple:
+    # Sessions are spread over n_worker fresh processes, so memory is not carried between configurations
+    sessions = [len(part) for part in np.array_split(np.arange(n_session), n_worker) if len(part)]
+    jobs = [(worker_id, script, count, n_word, timeout) for worker_id, count in enumerate(sessions)]
+    with Pool(len(jobs)) as pool:
+        outputs = pool.map(run_worker, jobs)
+    latency_df = pd.DataFrame(
+        [row for latencies, _ in outputs for row in latencies],
+        columns=["session", "interaction", "seconds", "error"],
+    )
+    return latency_df, pd.DataFrame([resources for _, resources in outputs])
+
+
+def latency_summary(latency_df: pd.DataFrame) -> pd.DataFrame:
+    rows = []
+    for interaction in INTERACTIONS:
+        seconds = latency_df.loc[latency_df["interaction"] == interaction, "seconds"].to_numpy()
+        if not len(seconds):
+            continue
+        row = {"interaction": interaction, "count": len(seconds)}
+        for percentile, value in zip(PERCENTILES, np.percentile(seconds, PERCENTILES)):
+            row[f"p{percentile}_ms"] = value * 1000
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Concurrent headless sessions against a Streamlit app.")
+    parser.add_argument("--script", default="NER_v3.py")
+    parser.add_argument("--sessions", type=int, nargs="+", default=[1, 4, 8],
+                        help="concurrent sessions, one configuration per value")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1],
+                        help="server processes the sessions are spread over, one configuration per value")
+    parser.add_argument("--words", type=int, default=3, help="word switches per session in the summary tab")
+    parser.add_argument("--timeout", type=float, default=600, help="seconds allowed for one rerun")
+    parser.add_argument("-o", "--output", help="write the comparison as .csv or .html")
+    args = parser.parse_args(argv)
+
+    script = os.path.abspath(args.script)
+    reports = []
+    for n_worker in args.workers:
+        for n_session in args.sessions:
+            latency_df, resource_df = run_configuration(script, n_session, n_worker, args.words, args.timeout)
+            summary = latency_summary(latency_df)
+            summary.insert(0, "sessions", n_session)
+            summary.insert(1, "workers", n_worker)
+            summary["errors"] = [
+                int(latency_df.loc[latency_df["interaction"] == interaction, "error"].sum())
+                for interaction in summary["interaction"]
+            ]
+            summary["max_cpu_percent"] = resource_df["cpu_percent"].max()
+            summary["max_peak_rss_mb"] = resource_df["peak_rss_mb"].max()
+            reports.append(summary)
+            print(f"{n_session} sessions on {n_worker} workers")
+            print(summary.drop(columns=["sessions", "workers"]).to_string(index=False, float_format="%.1f"))
+            print(resource_df.to_string(index=False, float_format="%.1f"))
+            print()
+
+    report = pd.concat(reports, ignore_index=True)
+    if args.output and args.output.endswith(".html"):
+        report.to_html(args.output, index=False, float_format=lambda value: f"{value:.1f}")
+    elif args.output:
+        report.to_csv(args.output, index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,7 +5,8 @@ import streamlit as st
 import pandas as pd
 from collections import Counter
 import random
-import matplotlib.pyplot as plt
+
+from charts import count_bar_spec
 
 # โหลดโมเดล
 try:
@@ -168,10 +169,6 @@ if st.session_state.show_shuffle:
                 # Convert result to DataFrame and display as a smaller bar chart
                 df = create_dataframe_result(Counter(result))
                 st.write(df)
-                fig, ax = plt.subplots(figsize=(5, 3))  # Adjust size here (width=5, height=3)
-                ax.bar(df['Class'], df['Count'])
-                ax.set_xlabel("Entity Class")
-                ax.set_ylabel("Count")
-                ax.set_title("Entity Counts")
-                st.pyplot(fig)  # Display the smaller bar chart
+                # Cached Vega-Lite spec instead of a new matplotlib figure per shuffle
+                st.vega_lite_chart(count_bar_spec(df))  # Display the smaller bar chart
                 st.write("---")
@@ -0,0 +1,69 @@
+import numpy as np
+
+from tagger import TAGS
+
+
+def confusion_matrix(true_codes: np.ndarray, predicted_codes: np.ndarray) -> np.ndarray:
+    # counts[true, predicted] over token tag codes
+    n_tag = len(TAGS)
+    counts = np.bincount(
+        np.asarray(true_codes, dtype=np.int64) * n_tag + np.asarray(predicted_codes, dtype=np.int64),
+        minlength=n_tag * n_tag,
+    )
+    return counts.reshape(n_tag, n_tag)
+
+
+def tag_scores(counts: np.ndarray) -> dict:
+    # Per-tag precision, recall, F1 and support from a confusion matrix
+    correct = np.diag(counts).astype(np.float64)
+    predicted = counts.sum(axis=0)
+    support = counts.sum(axis=1)
+    precision = np.divide(correct, predicted, out=np.zeros_like(correct), where=predicted > 0)
+    recall = np.divide(correct, support, out=np.zeros_like(correct), where=support > 0)
+    total = precision + recall
+    f1 = np.divide(2 * precision * recall, total, out=np.zeros_like(correct), where=total > 0)
+    return {
+        tag: {"precision": precision[code], "recall": recall[code], "f1": f1[code], "support": int(support[code])}
+        for code, tag in enumerate(TAGS)
+    }
+
+
+def macro_f1(counts: np.ndarray) -> float:
+    # Unweighted over tags that occur, so the rare LOC and POST count as much as ADDR
+    scores = [score["f1"] for score in tag_scores(counts).values() if score["support"]]
+    return float(np.mean(scores)) if scores else 0.0
+
+
+def tag_spans(codes) -> set:
+    # (start, end, tag code) of every run of one non-O tag
+    codes = np.asarray(codes)
+    if not len(codes):
+        return set()
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    ends = np.r_[starts[1:], len(codes)]
+    outside = TAGS.index("O")
+    return {(int(start), int(end), int(codes[start])) for start, end in zip(starts, ends) if codes[start] != outside}
+
+
+def span_counts(true_codes, predicted_codes) -> np.ndarray:
+    # (n_tag, 3): exactly matching, true and predicted spans per tag
+    counts = np.zeros((len(TAGS), 3), dtype=np.int64)
+    true_spans = tag_spans(true_codes)
+    predicted_spans = tag_spans(predicted_codes)
+    for column, spans in enumerate([true_spans & predicted_spans, true_spans, predicted_spans]):
+        for _, _, code in spans:
+            counts[code, column] += 1
+    return counts
+
+
+def span_scores(counts: np.ndarray) -> dict:
+    scores = {}
+    for code, tag in enumerate(TAGS):
+        matched, n_true, n_predicted = counts[code]
+        if not n_true and not n_predicted:
+            continue
+        precision = matched / n_predicted if n_predicted else 0.0
+        recall = matched / n_true if n_true else 0.0
+        f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+        scores[tag] = {"precision": precision, "recall": recall, "f1": f1, "support": int(n_true)}
+    return scores
@@ -0,0 +1,121 @@
+import time
+
+import numpy as np
+
+from tagger import tokens_to_features
+
+# Stand-in for "a word the model has never seen"
+PLACEHOLDER = "<UNK>"
+
+PERTURBATION_KINDS = ["drop", "swap", "move", "replace"]
+
+
+class Perturbation:
+    # order indexes the original tokens; len(tokens) stands for PLACEHOLDER
+
+    def __init__(self, kind: str, target: int, position: int, order: np.ndarray):
+        self.kind = kind
+        self.target = target
+        self.position = position
+        self.order = order
+
+    def describe(self, tokens) -> str:
+        token = tokens[self.target]
+        if self.kind == "drop":
+            return f"drop {token}"
+        if self.kind == "swap":
+            return f"swap {token} <-> {tokens[self.target + 1]}"
+        if self.kind == "move":
+            return f"move {token} to {self.position + 1}"
+        return f"replace {token} with {PLACEHOLDER}"
+
+
+def generate_perturbations(n_token: int, kinds=PERTURBATION_KINDS) -> list:
+    identity = np.arange(n_token)
+    perturbations = []
+    if "drop" in kinds:
+        for i in range(n_token):
+            perturbations.append(Perturbation("drop", i, i, np.delete(identity, i)))
+    if "swap" in kinds:
+        for i in range(n_token - 1):
+            order = identity.copy()
+            order[i], order[i + 1] = i + 1, i
+            perturbations.append(Perturbation("swap", i, i + 1, order))
+    if "move" in kinds:
+        for i in range(n_token):
+            rest = np.delete(identity, i)
+            for position in range(n_token):
+                if position != i:
+                    perturbations.append(Perturbation("move", i, position, np.insert(rest, position, i)))
+    if "replace" in kinds:
+        for i in range(n_token):
+            order = identity.copy()
+            order[i] = n_token
+            perturbations.append(Perturbation("replace", i, i, order))
+    return perturbations
+
+
+class WindowFeatureCache:
+    # Features of a position only depend on (previous, current, next) token,
+    # so a window seen before (in the original or another perturbation) is reused
+
+    def __init__(self, tokens):
+        self.tokens = list(tokens) + [PLACEHOLDER]
+        self.cache = {}
+        self.n_extracted = 0
+
+    def sequence_features(self, order: np.ndarray) -> list:
+        order = order.tolist()
+        tokens = None
+        features = []
+        last = len(order) - 1
+        for k, index in enumerate(order):
+            key = (order[k - 1] if k > 0 else None, index, order[k + 1] if k < last else None)
+            feature = self.cache.get(key)
+            if feature is None:
+                if tokens is None:
+                    tokens = [self.tokens[i] for i in order]
+                feature = self.cache[key] = tokens_to_features(tokens, k)
+                self.n_extracted += 1
+            features.append(feature)
+        return features
+
+
+class PerturbationResult:
+    def __init__(self, perturbation, predictions, n_changed, n_extracted, feature_seconds, decode_seconds):
+        self.perturbation = perturbation
+        self.predictions = predictions
+        self.n_changed = n_changed
+        self.n_extracted = n_extracted
+        self.feature_seconds = feature_seconds
+        self.decode_seconds = decode_seconds
+
+
+def run_perturbations(model, tokens, kinds=PERTURBATION_KINDS) -> tuple:
+    # Returns (original predictions, results); the original and every perturbation
+    # are decoded in one model.predict call
+    n_token = len(tokens)
+    cache = WindowFeatureCache(tokens)
+    sequences = [cache.sequence_features(np.arange(n_token))]
+
+    perturbations = generate_perturbations(n_token, kinds)
+    extracted = []
+    for perturbation in perturbations:
+        started = time.perf_counter()
+        n_extracted = cache.n_extracted
+        sequences.append(cache.sequence_features(perturbation.order))
+        extracted.append((cache.n_extracted - n_extracted, time.perf_counter() - started))
+
+    started = time.perf_counter()
+    original, *predictions = model.predict(sequences)
+    # Each perturbation's share of the batched decode
+    decode_seconds = (time.perf_counter() - started) / len(sequences)
+
+    original_tags = np.array(list(original) + [None], dtype=object)
+    results = []
+    for perturbation, perturbed, (n_extracted, feature_seconds) in zip(perturbations, predictions, extracted):
+        # Tokens that kept their identity but not their tag
+        kept = perturbation.order < n_token
+        n_changed = int((np.array(perturbed, dtype=object)[kept] != original_tags[perturbation.order[kept]]).sum())
+        results.append(PerturbationResult(perturbation, perturbed, n_changed, n_extracted, feature_seconds, decode_seconds))
+    return original, results
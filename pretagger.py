@@ -0,0 +1,127 @@
+import argparse
+
+import numpy as np
+
+from gazetteer import (
+    DISTRICT_KEYWORDS,
+    PROVINCE_ALIASES,
+    PROVINCE_KEYWORDS,
+    SUB_DISTRICT_KEYWORDS,
+    load_gazetteer,
+)
+from tagger import MODEL_PATH, TAG_CODES, TAG_DTYPE, load_model, tag_texts
+from timing import best_time
+
+# Short form of the capital district, as in "อำเภอ เมือง"
+CAPITAL_DISTRICT = "เมือง"
+
+POST = TAG_CODES["POST"]
+LOC = TAG_CODES["LOC"]
+
+
+class PreTagger:
+    # Resolves tokens the gazetteer is sure about; -1 marks tokens left to the CRF
+
+    def __init__(self, gazetteer):
+        self.postal_prefixes = gazetteer.postal_code_prefixes()
+        self.provinces = gazetteer.provinces | set(PROVINCE_ALIASES)
+
+        # Sub-district and district names are only trusted right after their keyword
+        self.names_after = {}
+        for keyword in SUB_DISTRICT_KEYWORDS:
+            self.names_after[keyword] = gazetteer.sub_districts
+        for keyword in DISTRICT_KEYWORDS:
+            self.names_after[keyword] = gazetteer.districts | {CAPITAL_DISTRICT}
+        for keyword in PROVINCE_KEYWORDS:
+            self.names_after[keyword] = self.provinces
+
+    def pretag(self, tokens) -> list:
+        codes = []
+        previous = None
+        for token in tokens:
+            if len(token) == 5 and token.isdigit() and token[:2] in self.postal_prefixes:
+                codes.append(POST)
+            elif token in self.provinces or token in self.names_after.get(previous, ()):
+                codes.append(LOC)
+            else:
+                codes.append(-1)
+            previous = token
+        return codes
+
+    def resolve(self, tokens):
+        # Codes for a fully resolved record, None when any token is left to the CRF.
+        # Names, house numbers and the keywords themselves are never resolved, so on
+        # real addresses this is mostly records of a postal code alone.
+        codes = self.pretag(tokens)
+        return None if -1 in codes else codes
+
+
+def load_pretagger(gazetteer=None) -> PreTagger:
+    return PreTagger(gazetteer or load_gazetteer())
+
+
+def compare(model, texts, pretagger: PreTagger, repeat: int = 3) -> dict:
+    # Pre-tagged path against the pure CRF on the same records
+    crf_batch, crf_time = best_time(lambda: tag_texts(model, texts), repeat)
+    batch, pretag_time = best_time(lambda: tag_texts(model, texts, pretagger=pretagger), repeat)
+
+    # Agreement on every token the gazetteer resolved, wherever the record ended up
+    pretags = np.fromiter(
+        (code for i in range(len(batch)) for code in pretagger.pretag(batch.record_tokens(i))),
+        dtype=TAG_DTYPE,
+    )
+    confident = pretags >= 0
+    record = batch.record_ids()
+    short_circuited = batch.short_circuited[record]
+    # Short-circuited records with nothing but postal codes (or no tokens) carry no place names
+    postal_only = np.ones(len(batch), dtype=bool)
+    np.logical_and.at(postal_only, record, pretags == POST)
+    agreement = pretags == crf_batch.tags
+    return {
+        "records": len(texts),
+        "short_circuited": float(batch.short_circuited.mean()) if len(texts) else 0.0,
+        "short_circuited_postal_only": (
+            float((batch.short_circuited & postal_only).sum() / batch.short_circuited.sum())
+            if batch.short_circuited.any() else 0.0
+        ),
+        "crf_seconds": crf_time,
+        "pretag_seconds": pretag_time,
+        "speedup": crf_time / max(pretag_time, 1e-9),
+        "confident_tokens": float(confident.mean()) if len(confident) else 0.0,
+        "token_agreement": float(agreement[confident].mean()) if confident.any() else 1.0,
+        # The CRF labels many district and sub-district names ADDR, so LOC agreement is the one to watch
+        "tag_agreement": {
+            tag: float(agreement[pretags == code].mean()) if (pretags == code).any() else 1.0
+            for tag, code in (("POST", POST), ("LOC", LOC))
+        },
+        "short_circuited_token_agreement": (
+            float((batch.tags[short_circuited] == crf_batch.tags[short_circuited]).mean())
+            if short_circuited.any() else 1.0
+        ),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare gazetteer pre-tagging with the pure CRF.")
+    parser.add_argument("input", help="text file with one address per line")
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--repeat", type=int, default=3, help="best of N timings")
+    args = parser.parse_args(argv)
+
+    with open(args.input, encoding="utf-8") as file:
+        texts = [line.rstrip("\r\n") for line in file]
+
+    report = compare(load_model(args.model), texts, load_pretagger(), args.repeat)
+    print(f"records:                  {report['records']}")
+    print(f"short-circuited records:  {report['short_circuited']:.1%} "
+          f"({report['short_circuited_postal_only']:.1%} of them empty or postal codes only)")
+    print(f"pure CRF:                 {report['crf_seconds']:.3f}s")
+    print(f"with pre-tagger:          {report['pretag_seconds']:.3f}s ({report['speedup']:.2f}x)")
+    print(f"confident tokens:         {report['confident_tokens']:.1%}")
+    print(f"agreement, confident:     {report['token_agreement']:.1%} "
+          f"(POST {report['tag_agreement']['POST']:.1%}, LOC {report['tag_agreement']['LOC']:.1%})")
+    print(f"agreement, short-circuit: {report['short_circuited_token_agreement']:.1%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from multiprocessing import Pool
+
+import numpy as np
+
+from tagger import TAG_DTYPE, TAGS, encode_tags, load_model, sequence_features
+
+MODELS_DIR = "model"
+MEMORY_CAP_BYTES = 512 * 2 ** 20
+HASH_LENGTH = 12
+
+
+def content_hash(path: str) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(2 ** 20), b""):
+            digest.update(block)
+    return digest.hexdigest()[:HASH_LENGTH]
+
+
+def metadata_path(model_path: str) -> str:
+    # Training metadata sits next to the model, e.g. model/trained.json
+    return os.path.splitext(model_path)[0] + ".json"
+
+
+def read_metadata(model_path: str) -> dict:
+    path = metadata_path(model_path)
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as file:
+        return json.load(file)
+
+
+class ModelEntry:
+    def __init__(self, path: str, digest: str, nbytes: int, modified: float):
+        self.path = path
+        self.name = os.path.splitext(os.path.basename(path))[0]
+        self.digest = digest
+        # File size, used as the estimate of the loaded model's footprint
+        self.nbytes = nbytes
+        self.modified = modified
+
+    @property
+    def label(self) -> str:
+        return f"{self.name} ({self.digest})"
+
+
+class ModelRegistry:
+    # Models in a directory, identified by content hash: the same file under two
+    # names is one model, and a retrained file under an old name is a new one.
+    # Models are only loaded when asked for and evicted least recently used first
+    # once their total size goes over memory_cap.
+
+    def __init__(self, directory: str = MODELS_DIR, memory_cap: int = MEMORY_CAP_BYTES):
+        self.directory = directory
+        self.memory_cap = memory_cap
+        self.entries = {}
+        # Every file found, including duplicates of an entry under another name
+        self.paths = {}
+        self.loaded = OrderedDict()
+        self.nbytes = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        # (path, size, mtime) -> digest, so rescanning does not rehash unchanged files
+        self._digests = {}
+
+    def scan(self) -> list:
+        entries = {}
+        paths = {}
+        for path in sorted(glob.glob(os.path.join(self.directory, "*.joblib"))):
+            stat = os.stat(path)
+            key = (path, stat.st_size, stat.st_mtime)
+            digest = self._digests.get(key)
+            if digest is None:
+                digest = self._digests[key] = content_hash(path)
+            entries.setdefault(digest, ModelEntry(path, digest, stat.st_size, stat.st_mtime))
+            paths[path] = digest
+        self.entries = entries
+        self.paths = paths
+        return list(entries.values())
+
+    def resolve(self, key: str) -> ModelEntry:
+        # A content hash (or a prefix of one), a file name or a path
+        if not self.entries:
+            self.scan()
+        for path, digest in self.paths.items():
+            name = os.path.basename(path)
+            if key in (path, name, os.path.splitext(name)[0]) or digest.startswith(key):
+                return self.entries[digest]
+        raise KeyError(f"No model {key!r} in {self.directory}")
+
+    def verify(self, entry: ModelEntry) -> dict:
+        # The file must still be the one scanned, and the one its metadata was
+        # written for; a half-copied or swapped model fails here rather than
+        # being served under the old hash
+        digest = content_hash(entry.path)
+        if digest != entry.digest:
+            raise ValueError(f"{entry.path} changed since it was scanned ({entry.digest} -> {digest})")
+        metadata = read_metadata(entry.path)
+        expected = metadata.get("model_hash")
+        if expected and expected != digest:
+            raise ValueError(f"{entry.path} is {digest} but {metadata_path(entry.path)} describes {expected}")
+        return metadata
+
+    def get(self, key: str):
+        entry = self.resolve(key)
+        with self.lock:
+            held = self.loaded.get(entry.digest)
+            if held is not None:
+                self.loaded.move_to_end(entry.digest)
+                return held[0]
+        self.verify(entry)
+        model = load_model(entry.path)
+        with self.lock:
+            if entry.digest not in self.loaded:
+                # Size kept with the model: a rescan may drop its entry while it is still loaded
+                self.loaded[entry.digest] = (model, entry.nbytes)
+                self.nbytes += entry.nbytes
+            # The model just asked for always stays, even if it alone is over the cap
+            while self.nbytes > self.memory_cap and len(self.loaded) > 1:
+                _, (_, nbytes) = self.loaded.popitem(last=False)
+                self.nbytes -= nbytes
+                self.evictions += 1
+        return model
+
+
+def tag_with_models(models, token_lists) -> list:
+    # Features are extracted once and every model decodes the same batch.
+    # Returns one (n_model, n_token) array of tag codes per record.
+    sequences = [sequence_features(tokens) for tokens in token_lists]
+    predictions = [model.predict(sequences) for model in models]
+    return [
+        np.stack([encode_tags(model_predictions[record]) for model_predictions in predictions])
+        if token_lists[record] else np.empty((len(models), 0), dtype=TAG_DTYPE)
+        for record in range(len(token_lists))
+    ]
+
+
+def disagreements(codes: np.ndarray) -> np.ndarray:
+    # Tokens on which not every model agrees
+    return (codes != codes[0]).any(axis=0)
+
+
+_models = None
+
+
+def _init_worker(paths):
+    global _models
+    _models = [load_model(path) for path in paths]
+
+
+def disagreement_counts(texts) -> dict:
+    token_lists = [tokens for tokens in (text.split() for text in texts) if tokens]
+    n_model = len(_models)
+    pairwise = np.zeros((n_model, n_model), dtype=np.int64)
+    # Tokens by the first model's tag, and how many of them the others disagree on
+    by_tag = np.zeros((2, len(TAGS)), dtype=np.int64)
+    n_token = n_disagree = n_record_disagree = 0
+    for codes in tag_with_models(_models, token_lists):
+        disagree = disagreements(codes)
+        n_token += codes.shape[1]
+        n_disagree += int(disagree.sum())
+        n_record_disagree += bool(disagree.any())
+        pairwise += (codes[:, None, :] != codes[None, :, :]).sum(axis=2)
+        np.add.at(by_tag[0], codes[0], 1)
+        np.add.at(by_tag[1], codes[0][disagree], 1)
+    return {
+        "records": len(token_lists),
+        "records_disagree": n_record_disagree,
+        "tokens": n_token,
+        "tokens_disagree": n_disagree,
+        "pairwise": pairwise,
+        "by_tag": by_tag,
+    }
+
+
+def _read_chunks(path: str, chunk_size: int):
+    with open(path, encoding="utf-8") as file:
+        texts = []
+        for line in file:
+            texts.append(line)
+            if len(texts) == chunk_size:
+                yield texts
+                texts = []
+        if texts:
+            yield texts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Models in a directory, and how often they disagree on a corpus.")
+    parser.add_argument("input", nargs="?", help="text file with one address per line; omit to list the models")
+    parser.add_argument("--models-dir", default=MODELS_DIR)
+    parser.add_argument("--models", nargs="+", help="names or content hashes to compare (default: all)")
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    args = parser.parse_args(argv)
+
+    registry = ModelRegistry(args.models_dir)
+    entries = registry.scan()
+    if args.input is None:
+        for entry in entries:
+            print(f"{entry.digest}  {entry.nbytes / 2 ** 20:6.1f} MB  {entry.path}")
+        return
+    if args.models:
+        entries = [registry.resolve(key) for key in args.models]
+    if len(entries) < 2:
+        parser.error("need at least two distinct models to compare")
+
+    started = time.perf_counter()
+    total = None
+    with Pool(args.workers, initializer=_init_worker, initargs=([entry.path for entry in entries],)) as pool:
+        for counts in pool.imap_unordered(disagreement_counts, _read_chunks(args.input, args.chunk_size)):
+            if total is None:
+                total = counts
+            else:
+                for key, value in counts.items():
+                    total[key] = total[key] + value
+    elapsed = time.perf_counter() - started
+    if total is None:
+        parser.error(f"{args.input} is empty")
+
+    print(f"{total['records']} records, {total['tokens']} tokens in {elapsed:.1f}s")
+    print(f"records with a disagreement: {total['records_disagree'] / max(total['records'], 1):.2%}")
+    print(f"tokens with a disagreement:  {total['tokens_disagree'] / max(total['tokens'], 1):.2%}")
+    print(f"by {entries[0].label} tag:")
+    for code, tag in enumerate(TAGS):
+        n_tag, n_tag_disagree = total["by_tag"][:, code]
+        print(f"  {tag:<5} {n_tag_disagree / max(n_tag, 1):.2%} of {n_tag}")
+    print("pairwise token disagreement:")
+    for i, entry in enumerate(entries):
+        for j in range(i + 1, len(entries)):
+            rate = total["pairwise"][i, j] / max(total["tokens"], 1)
+            print(f"  {entry.label} vs {entries[j].label}: {rate:.2%}")
+
+
+if __name__ == "__main__":
+    main()
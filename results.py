@@ -0,0 +1,181 @@
+import argparse
+from itertools import islice
+
+import numpy as np
+import pandas as pd
+
+from tagger import MODEL_PATH, TAGS, TAG_DTYPE, encode_tags, load_model, sequence_features
+from tokenization import permute, shuffle_permutation
+
+TOKEN_ID_DTYPE = np.int16
+# Shuffles tagged per model.predict call when orders come from a generator
+PREDICT_BATCH = 256
+
+
+def _order_array(n_shuffle: int, n_token: int) -> np.ndarray:
+    if n_token > np.iinfo(TOKEN_ID_DTYPE).max:
+        raise ValueError(f"{n_token} tokens do not fit in {np.dtype(TOKEN_ID_DTYPE).name} token ids "
+                         f"(at most {np.iinfo(TOKEN_ID_DTYPE).max})")
+    return np.empty((n_shuffle, n_token), dtype=TOKEN_ID_DTYPE)
+
+
+class ShuffleResults:
+    # Shuffle results as two (n_shuffle, n_token) arrays: token ids into the
+    # original token list at every position, and int8 tag codes. Labels such
+    # as 'Index: 3' are only built for the handful of rows a chart needs.
+
+    def __init__(self, tokens, orders: np.ndarray, tags: np.ndarray):
+        self.tokens = list(tokens)
+        self.orders = orders
+        self.tags = tags
+
+    @classmethod
+    def from_predictions(cls, tokens, orders, predictions):
+        n_token = len(tokens)
+        order_array = _order_array(len(orders), n_token)
+        tag_array = np.empty((len(orders), n_token), dtype=TAG_DTYPE)
+        for row, (order, labels) in enumerate(zip(orders, predictions)):
+            order_array[row] = order
+            tag_array[row] = encode_tags(labels)
+        return cls(tokens, order_array, tag_array)
+
+    @classmethod
+    def from_orders(cls, model, tokens, orders, n_shuffle: int, batch_size: int = PREDICT_BATCH):
+        # Tag the first n_shuffle orders of a (possibly endless) generator such as
+        # shuffles.shuffle_orders; only batch_size shuffles' features exist at a time
+        n_token = len(tokens)
+        order_array = _order_array(n_shuffle, n_token)
+        tag_array = np.empty((n_shuffle, n_token), dtype=TAG_DTYPE)
+        orders = islice(orders, n_shuffle)
+        row = 0
+        while True:
+            batch = list(islice(orders, batch_size))
+            if not batch:
+                break
+            predictions = model.predict([sequence_features(permute(tokens, order)) for order in batch])
+            for order, labels in zip(batch, predictions):
+                order_array[row] = order
+                tag_array[row] = encode_tags(labels)
+                row += 1
+        return cls(tokens, order_array[:row], tag_array[:row])
+
+    def __len__(self):
+        return len(self.orders)
+
+    @property
+    def nbytes(self) -> int:
+        return self.orders.nbytes + self.tags.nbytes
+
+    def token_ids(self, word: str) -> np.ndarray:
+        return np.array([i for i, token in enumerate(self.tokens) if token == word], dtype=TOKEN_ID_DTYPE)
+
+    def position_tag_counts(self, word: str) -> np.ndarray:
+        # (n_position, n_tag) counts of the tags `word` got at each position
+        mask = np.isin(self.orders, self.token_ids(word))
+        positions = np.nonzero(mask)[1]
+        counts = np.zeros((self.orders.shape[1], len(TAGS)), dtype=np.int64)
+        np.add.at(counts, (positions, self.tags[mask]), 1)
+        return counts
+
+    def chart_frame(self, word: str) -> pd.DataFrame:
+        # Same columns the summary chart used to build from the per-shuffle frames
+        counts = self.position_tag_counts(word)
+        index, tag = np.nonzero(counts)
+        df = pd.DataFrame({
+            'index': index,
+            'order': [f'Index: {i + 1}' for i in index],
+            'tag': [TAGS[code] for code in tag],
+            'count': counts[index, tag],
+        })
+        df['count_all_word'] = counts.sum(axis=1)[index]
+        df['percentage'] = df['count'] / df['count_all_word'] * 100
+        return df
+
+    def to_arrow(self):
+        # Long table; token and tag columns are dictionary arrays over the original lists
+        import pyarrow as pa
+
+        n_shuffle, n_token = self.orders.shape
+        return pa.table({
+            'shuffle_id': pa.array(np.repeat(np.arange(n_shuffle, dtype=np.int32), n_token)),
+            'position': pa.array(np.tile(np.arange(n_token, dtype=TOKEN_ID_DTYPE), n_shuffle)),
+            'token': pa.DictionaryArray.from_arrays(pa.array(self.orders.ravel()), pa.array(self.tokens, pa.string())),
+            'tag': pa.DictionaryArray.from_arrays(pa.array(self.tags.ravel()), pa.array(TAGS, pa.string())),
+        })
+
+    def write_arrow(self, path: str):
+        import pyarrow as pa
+
+        table = self.to_arrow()
+        with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+    def write_parquet(self, path: str):
+        import pyarrow.parquet as pq
+
+        pq.write_table(self.to_arrow(), path)
+
+    @classmethod
+    def from_arrow(cls, table):
+        # Every shuffle is a permutation of all tokens, so the dictionary length is the row width
+        token = table.column('token').combine_chunks()
+        tag = table.column('tag').combine_chunks()
+        tokens = token.dictionary.to_pylist()
+        return cls(
+            tokens,
+            token.indices.to_numpy(zero_copy_only=True).reshape(-1, len(tokens)),
+            _tag_codes(tag).reshape(-1, len(tokens)),
+        )
+
+    @classmethod
+    def read_arrow(cls, path: str):
+        # Memory-mapped: the id and tag arrays point straight into the file
+        import pyarrow as pa
+
+        return cls.from_arrow(pa.ipc.open_file(pa.memory_map(path, 'r')).read_all())
+
+
+def _tag_codes(tag) -> np.ndarray:
+    # Tag dictionaries written by to_arrow are TAGS itself; remap anything else
+    codes = tag.indices.to_numpy(zero_copy_only=True)
+    dictionary = tag.dictionary.to_pylist()
+    if dictionary == TAGS:
+        return codes
+    return np.array([TAGS.index(label) for label in dictionary], dtype=TAG_DTYPE)[codes]
+
+
+def legacy_frame(tokens, orders, predictions) -> pd.DataFrame:
+    # What the summary tab used to hold: one object-dtype frame per shuffle, concatenated
+    frames = []
+    for shuffle_id, (order, labels) in enumerate(zip(orders, predictions)):
+        frames.append(pd.DataFrame({
+            'index': np.arange(len(order)),
+            'token': [tokens[i] for i in order],
+            'tag': labels,
+        }).assign(shuffle_id=shuffle_id))
+    df = pd.concat(frames)
+    df['order'] = 'Index: ' + (df['index'] + 1).astype(str)
+    return df
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Memory of shuffle results: per-shuffle frames vs ShuffleResults.")
+    parser.add_argument("--text", default="นายสมชาย เข็มกลัด 254 ถนน พญาไท แขวง วังใหม่ เขต ปทุมวัน กรุงเทพ 10330")
+    parser.add_argument("--shuffles", type=int, default=10000)
+    parser.add_argument("--model", default=MODEL_PATH)
+    args = parser.parse_args(argv)
+
+    model = load_model(args.model)
+    tokens = args.text.split()
+    orders = [shuffle_permutation(len(tokens), seed=seed) for seed in range(args.shuffles)]
+    predictions = model.predict([sequence_features(permute(tokens, order)) for order in orders])
+
+    legacy_bytes = legacy_frame(tokens, orders, predictions).memory_usage(deep=True).sum()
+    results = ShuffleResults.from_predictions(tokens, orders, predictions)
+    print(f"{args.shuffles} shuffles of {len(tokens)} tokens")
+    print(f"per-shuffle frames: {legacy_bytes / 2 ** 20:8.2f} MB")
+    print(f"ShuffleResults:     {results.nbytes / 2 ** 20:8.2f} MB ({legacy_bytes / results.nbytes:.0f}x smaller)")
+
+
+if __name__ == "__main__":
+    main()
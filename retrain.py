@@ -0,0 +1,218 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import joblib
+import numpy as np
+
+from corpus import read_conll
+from corrections import CORRECTIONS_PATH, CorrectionStore
+from registry import MODELS_DIR, ModelRegistry, content_hash, metadata_path
+from tagger import FEATURE_VERSION, TAGS, encode_tags, sequence_features
+from weights import (
+    WEIGHT_DTYPE, WeightModel, WeightTable, feature_attributes, forward_backward, load_weight_table, viterbi,
+)
+
+L2 = 0.1
+MAX_ITERATIONS = 50
+REPLAY_SIZE = 500
+
+
+def design_matrix(table: WeightTable, sequences) -> tuple:
+    # Sparse (n_token, n_column) attribute values over only the table rows the
+    # sequences touch; attributes the table has never seen get new rows.
+    # Returns (attribute_ids, table row of each column, matrix).
+    from scipy import sparse
+
+    attribute_ids = dict(table.attribute_ids)
+    columns = {}
+    token_index, column_index, values = [], [], []
+    n_token = 0
+    for sequence in sequences:
+        for features in sequence:
+            for attribute, value in feature_attributes(features):
+                if not value:
+                    continue
+                row = attribute_ids.setdefault(attribute, len(attribute_ids))
+                token_index.append(n_token)
+                column_index.append(columns.setdefault(row, len(columns)))
+                values.append(value)
+            n_token += 1
+    matrix = sparse.csr_matrix((values, (token_index, column_index)), shape=(n_token, len(columns)))
+    return attribute_ids, np.fromiter(columns, dtype=np.int64, count=len(columns)), matrix
+
+
+class WarmStart:
+    # CRF negative log-likelihood of the given sentences plus an L2 pull towards
+    # the starting weights, over the rows those sentences touch and the
+    # transitions. Every other row keeps its weight: its gradient would be the
+    # pull alone, which is zero at the start.
+
+    def __init__(self, table: WeightTable, sequences, labels, sentence_weights, l2: float = L2):
+        self.table = table
+        self.l2 = l2
+        self.attribute_ids, self.rows, self.matrix = design_matrix(table, sequences)
+        lengths = np.fromiter(map(len, labels), dtype=np.int64, count=len(labels))
+        self.offsets = np.r_[0, np.cumsum(lengths)]
+        self.codes = np.concatenate([encode_tags(sentence) for sentence in labels]) if labels else np.empty(0, dtype=np.int64)
+        self.sentence_weights = np.asarray(sentence_weights, dtype=np.float64)
+        self.gold = np.repeat(self.sentence_weights, lengths)[:, None] * np.eye(len(TAGS))[self.codes]
+
+        n_new = len(self.attribute_ids) - len(table.state)
+        self.state = np.vstack([table.state, np.zeros((n_new, len(TAGS)), dtype=table.state.dtype)]).astype(np.float64)
+        self.start = np.concatenate([self.state[self.rows].ravel(), table.transitions.astype(np.float64).ravel()])
+
+    def unpack(self, theta: np.ndarray) -> tuple:
+        n_transition = len(TAGS) * len(TAGS)
+        return theta[:-n_transition].reshape(-1, len(TAGS)), theta[-n_transition:].reshape(len(TAGS), len(TAGS))
+
+    def loss(self, theta: np.ndarray) -> tuple:
+        weights, transitions = self.unpack(theta)
+        scores = self.matrix @ weights
+        # d loss / d scores, starting from minus the gold labels
+        score_gradient = -self.gold
+        transition_gradient = np.zeros_like(transitions)
+        nll = 0.0
+        for sentence, weight in enumerate(self.sentence_weights):
+            start, end = self.offsets[sentence], self.offsets[sentence + 1]
+            codes = self.codes[start:end]
+            log_z, marginals, pairs = forward_backward(scores[start:end], transitions)
+            gold = scores[np.arange(start, end), codes].sum() + transitions[codes[:-1], codes[1:]].sum()
+            nll += weight * (log_z - gold)
+            score_gradient[start:end] += weight * marginals
+            transition_gradient += weight * pairs
+            np.add.at(transition_gradient, (codes[:-1], codes[1:]), -weight)
+        drift = theta - self.start
+        gradient = np.concatenate([(self.matrix.T @ score_gradient).ravel(), transition_gradient.ravel()])
+        return nll + self.l2 / 2 * drift @ drift, gradient + self.l2 * drift
+
+    def fit(self, max_iterations: int = MAX_ITERATIONS) -> tuple:
+        # (new WeightTable, scipy result)
+        from scipy.optimize import minimize
+
+        result = minimize(self.loss, self.start, jac=True, method="L-BFGS-B", options={"maxiter": max_iterations})
+        weights, transitions = self.unpack(result.x)
+        state = self.state.copy()
+        state[self.rows] = weights
+        table = WeightTable(self.attribute_ids, state.astype(WEIGHT_DTYPE), transitions.astype(WEIGHT_DTYPE))
+        return table, result
+
+
+def token_accuracy(table: WeightTable, sequences, labels):
+    # None when there are no tokens to score
+    correct = total = 0
+    for sequence, sentence in zip(sequences, labels):
+        correct += int((viterbi(table, table.state_scores(sequence)) == encode_tags(sentence)).sum())
+        total += len(sentence)
+    return correct / total if total else None
+
+
+def _accuracy(value) -> str:
+    return "n/a" if value is None else f"{value:.4f}"
+
+
+def publish(model, output: str, metadata: dict) -> dict:
+    # The model is written under a temporary name, hashed, then renamed into
+    # place after its metadata. Until both renames are done the registry sees a
+    # hash mismatch and refuses the model rather than serving a partial one.
+    directory = os.path.dirname(output) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, model_tmp = tempfile.mkstemp(suffix=".tmp", dir=directory)
+    os.close(fd)
+    joblib.dump(model, model_tmp)
+    metadata = dict(metadata, model_hash=content_hash(model_tmp))
+    metadata_tmp = metadata_path(output) + ".tmp"
+    with open(metadata_tmp, "w", encoding="utf-8") as file:
+        json.dump(metadata, file, ensure_ascii=False, indent=2)
+    os.replace(metadata_tmp, metadata_path(output))
+    os.replace(model_tmp, output)
+    return metadata
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Warm-start a model from its current weights on new corrections plus sampled old data."
+    )
+    parser.add_argument("--model", default="model", help="base model: name, file or content hash in --models-dir")
+    parser.add_argument("--models-dir", default=MODELS_DIR)
+    parser.add_argument("--corrections", default=CORRECTIONS_PATH)
+    parser.add_argument("--replay", help="CoNLL-style corpus to sample old data from, e.g. the training corpus")
+    parser.add_argument("--replay-size", type=int, default=REPLAY_SIZE,
+                        help="old addresses (earlier corrections and --replay) trained on alongside the new ones")
+    parser.add_argument("--new-weight", type=float,
+                        help="weight of a new correction relative to an old address "
+                             "(default: old addresses per new correction, at least 1)")
+    parser.add_argument("--l2", type=float, default=L2, help="pull towards the base model's weights")
+    parser.add_argument("--max-iterations", type=int, default=MAX_ITERATIONS)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", default=os.path.join(MODELS_DIR, "retrained.joblib"),
+                        help="model path; metadata is written next to it as .json")
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    registry = ModelRegistry(args.models_dir)
+    base = registry.resolve(args.model)
+    base_metadata = registry.verify(base)
+    table = load_weight_table(registry.get(base.digest))
+
+    # Corrections already in the base model are old data now
+    store = CorrectionStore(args.corrections)
+    corrections = store.sentences()
+    n_seen = min(base_metadata.get("corrections_trained", 0), len(corrections))
+    new = corrections[n_seen:]
+    if not new:
+        parser.error(f"no corrections in {args.corrections} newer than the {n_seen} {base.label} was trained on")
+    old = corrections[:n_seen] + (read_conll(args.replay) if args.replay else [])
+    rng = np.random.RandomState(args.seed)
+    old = [old[i] for i in rng.permutation(len(old))[:args.replay_size]]
+
+    sentences = new + old
+    sequences = [sequence_features(tokens) for tokens, _ in sentences]
+    labels = [sentence_labels for _, sentence_labels in sentences]
+    # Otherwise a few corrections are outvoted by the replayed addresses and not learned
+    new_weight = args.new_weight if args.new_weight is not None else max(len(old) / len(new), 1.0)
+    weights = [new_weight] * len(new) + [1.0] * len(old)
+    before = (token_accuracy(table, sequences[:len(new)], labels[:len(new)]),
+              token_accuracy(table, sequences[len(new):], labels[len(new):]))
+
+    warm_start = WarmStart(table, sequences, labels, weights, args.l2)
+    retrained, result = warm_start.fit(args.max_iterations)
+    after = (token_accuracy(retrained, sequences[:len(new)], labels[:len(new)]),
+             token_accuracy(retrained, sequences[len(new):], labels[len(new):]))
+    fit_seconds = time.perf_counter() - started
+
+    metadata = publish(WeightModel(retrained), args.output, {
+        "backend": "weights",
+        "parent_hash": base.digest,
+        "feature_version": FEATURE_VERSION,
+        "feature_set": "full",
+        "corrections": os.path.abspath(args.corrections),
+        "corrections_trained": len(corrections),
+        "new_corrections": len(new),
+        "replay": os.path.abspath(args.replay) if args.replay else None,
+        "replayed": len(old),
+        "new_weight": new_weight,
+        "l2": args.l2,
+        "iterations": int(result.nit),
+        "loss": float(result.fun),
+        "updated_rows": len(warm_start.rows),
+        "new_attributes": len(warm_start.attribute_ids) - len(table.state),
+        "accuracy_new_before": before[0],
+        "accuracy_new_after": after[0],
+        "accuracy_old_before": before[1],
+        "accuracy_old_after": after[1],
+        "fit_seconds": fit_seconds,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    })
+    print(f"{len(new)} new corrections (weight {new_weight:g}), {len(old)} old addresses; "
+          f"{len(warm_start.rows)} weight rows updated "
+          f"({metadata['new_attributes']} new) in {result.nit} iterations, {fit_seconds:.1f}s")
+    print(f"token accuracy on new corrections {_accuracy(before[0])} -> {_accuracy(after[0])}, "
+          f"old data {_accuracy(before[1])} -> {_accuracy(after[1])}")
+    print(f"model in {args.output} ({metadata['model_hash']}, from {base.label}), metadata in {metadata_path(args.output)}")
+
+
+if __name__ == "__main__":
+    main()
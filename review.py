@@ -0,0 +1,121 @@
+import argparse
+import heapq
+import json
+import os
+import tempfile
+
+import numpy as np
+
+from decoding import MarginalDecoder
+from dedup import exact_key
+from tagger import MODEL_PATH, load_model, tag_texts
+from timing import best_time
+
+REVIEW_QUEUE_PATH = "review/queue.jsonl"
+REVIEW_SIZE = 1000
+
+
+def review_item(batch, record: int, record_offset: int = 0, token_confidence=None) -> dict:
+    if token_confidence is None:
+        token_confidence = batch.token_confidence()
+    start, end = batch.offsets[record], batch.offsets[record + 1]
+    return {
+        "record": record_offset + record,
+        "confidence": float(batch.confidence[record]),
+        "text": batch.texts[record],
+        "tokens": batch.record_tokens(record),
+        "labels": batch.record_labels(record),
+        "token_confidence": [round(value, 4) for value in token_confidence[start:end].tolist()],
+    }
+
+
+class ReviewQueue:
+    # The `size` least confident records of a whole stream, in constant memory:
+    # a heap keyed on -confidence, so the most confident record held is the one
+    # pushed out. A record repeating one already held (same tokens) is skipped.
+
+    def __init__(self, size: int = REVIEW_SIZE):
+        self.size = size
+        self.heap = []
+        self.keys = set()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def threshold(self) -> float:
+        # Confidence a record must be under to get in
+        return -self.heap[0][0] if len(self.heap) >= self.size else np.inf
+
+    def max_confidence(self):
+        # Of the records held, None when there are none
+        return -self.heap[0][0] if self.heap else None
+
+    def push_batch(self, batch, record_offset: int = 0):
+        # Only records under the current threshold are looked at, least confident first
+        candidates = np.flatnonzero(batch.confidence < self.threshold())
+        candidates = candidates[np.argsort(batch.confidence[candidates], kind="stable")]
+        token_confidence = batch.token_confidence() if len(candidates) else None
+        for record in candidates.tolist():
+            confidence = float(batch.confidence[record])
+            if confidence >= self.threshold():
+                break
+            key = exact_key(batch.record_tokens(record))
+            if key in self.keys:
+                continue
+            item = review_item(batch, record, record_offset, token_confidence)
+            entry = (-confidence, -(record_offset + record), key, item)
+            if len(self.heap) < self.size:
+                heapq.heappush(self.heap, entry)
+            else:
+                self.keys.discard(heapq.heappushpop(self.heap, entry)[2])
+            self.keys.add(key)
+
+    def items(self) -> list:
+        # Least confident first
+        return [entry[3] for entry in sorted(self.heap, key=lambda entry: (-entry[0], -entry[1]))]
+
+    def write(self, path: str = REVIEW_QUEUE_PATH):
+        # Whole file replaced at once, so an app paging through it never sees half of one
+        directory = os.path.dirname(path) or "."
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", dir=directory, suffix=".tmp", delete=False) as file:
+            for item in self.items():
+                file.write(json.dumps(item, ensure_ascii=False))
+                file.write("\n")
+        os.replace(file.name, path)
+
+
+def read_review_queue(path: str = REVIEW_QUEUE_PATH) -> list:
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cost of tag marginals and the least confident records of a file.")
+    parser.add_argument("input", help="text file with one address per line")
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--size", type=int, default=10, help="records to show")
+    parser.add_argument("--repeat", type=int, default=3, help="best of N timings")
+    args = parser.parse_args(argv)
+
+    model = load_model(args.model)
+    with open(args.input, encoding="utf-8") as file:
+        texts = [line.rstrip("\r\n") for line in file]
+
+    plain, plain_seconds = best_time(lambda: tag_texts(model, texts), args.repeat)
+    batch, marginal_seconds = best_time(lambda: tag_texts(model, texts, marginals=MarginalDecoder(model)), args.repeat)
+    queue = ReviewQueue(args.size)
+    queue.push_batch(batch)
+    print(f"{len(texts)} records: {plain_seconds:.3f}s plain, {marginal_seconds:.3f}s with marginals "
+          f"({marginal_seconds / plain_seconds - 1:+.0%}); labels agree on {(plain.tags == batch.tags).mean():.1%} of tokens")
+    print(f"record confidence: median {np.median(batch.confidence):.3f}, "
+          f"{(batch.confidence < 0.5).mean():.1%} of records under 0.5")
+    for item in queue.items():
+        print(f"  {item['confidence']:.3f}  " + " ".join(
+            f"{token}/{label}" for token, label in zip(item["tokens"], item["labels"])))
+
+
+if __name__ == "__main__":
+    main()
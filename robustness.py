@@ -0,0 +1,175 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+from collections import defaultdict
+from itertools import islice
+from multiprocessing import Pool
+
+import pandas as pd
+
+from perturbations import generate_perturbations
+from registry import content_hash
+from shuffles import MAX_DISTANCE, shuffle_orders
+from tagger import MODEL_PATH, load_model, sequence_features
+from tokenization import permute
+
+# "shuffle" is the uniform strategy of shuffles.py; "move" every single-token move
+MODES = ["shuffle", "blocks", "bounded", "relocate", "move"]
+PREDICT_BATCH = 256
+
+_model = None
+
+
+def _init_worker(model_path):
+    global _model
+    _model = load_model(model_path)
+
+
+def _orders(tokens, mode: str, n_shuffle: int, seed: int, max_distance: int):
+    # Lazy; shuffles are drawn as they are tagged
+    if mode == "move":
+        return (perturbation.order for perturbation in generate_perturbations(len(tokens), ["move"]))
+    strategy = "uniform" if mode == "shuffle" else mode
+    return islice(shuffle_orders(strategy, tokens, seed, max_distance), n_shuffle)
+
+
+def analyze_chunk(job) -> str:
+    # Tag every address of a chunk plus its shuffles and write per-(word, tag) counts
+    chunk_id, first_record, texts, mode, n_shuffle, seed, max_distance, checkpoint_dir = job
+    path = os.path.join(checkpoint_dir, f"chunk_{chunk_id:06d}.parquet")
+    if os.path.exists(path):
+        return path
+
+    counts = defaultdict(lambda: [0, 0])
+    for record, text in enumerate(texts, first_record):
+        tokens = text.split()
+        if len(tokens) < 2:
+            continue
+        original = _model.predict_single(sequence_features(tokens))
+        orders = _orders(tokens, mode, n_shuffle, seed + record * n_shuffle, max_distance)
+        while True:
+            batch = list(islice(orders, PREDICT_BATCH))
+            if not batch:
+                break
+            predictions = _model.predict([sequence_features(permute(tokens, order)) for order in batch])
+            for order, shuffled in zip(batch, predictions):
+                for position, index in enumerate(order.tolist()):
+                    if position == index:
+                        continue
+                    count = counts[(tokens[index], original[index])]
+                    count[0] += 1
+                    count[1] += shuffled[position] == original[index]
+
+    df = pd.DataFrame(
+        [(word, tag, moved, kept) for (word, tag), (moved, kept) in counts.items()],
+        columns=["word", "tag", "moved", "kept"],
+    )
+    # Write then rename so a killed run never leaves a half-written checkpoint
+    df.to_parquet(path + ".tmp", index=False)
+    os.replace(path + ".tmp", path)
+    return path
+
+
+def checkpoint_key(input_path: str, model_path: str, mode: str, n_shuffle: int, seed: int, max_distance: int,
+                   chunk_size: int) -> str:
+    # Everything the chunk counts depend on, so a rerun with other settings (another --mode, say) starts afresh
+    key = [os.path.abspath(input_path), os.path.getsize(input_path), content_hash(model_path),
+           mode, n_shuffle, seed, max_distance, chunk_size]
+    return hashlib.blake2b(json.dumps(key).encode("utf-8"), digest_size=8).hexdigest()
+
+
+def read_chunks(path: str, chunk_size: int):
+    with open(path, encoding="utf-8") as file:
+        texts = []
+        for line in file:
+            texts.append(line.rstrip("\r\n"))
+            if len(texts) == chunk_size:
+                yield texts
+                texts = []
+        if texts:
+            yield texts
+
+
+def summarize(chunk_paths) -> tuple:
+    frames = [pd.read_parquet(path) for path in chunk_paths]
+    if not frames:
+        frames = [pd.DataFrame({"word": [], "tag": [], "moved": [], "kept": []})]
+    df = pd.concat(frames, ignore_index=True)
+    word_df = df.groupby(["word", "tag"], as_index=False)[["moved", "kept"]].sum()
+    word_df["stability"] = word_df["kept"] / word_df["moved"]
+    tag_df = word_df.groupby("tag", as_index=False)[["moved", "kept"]].sum()
+    tag_df["stability"] = tag_df["kept"] / tag_df["moved"]
+    return word_df.sort_values("moved", ascending=False), tag_df
+
+
+def write_html(path: str, word_df, tag_df, n_record: int, elapsed: float, min_moved: int):
+    frequent = word_df[word_df["moved"] >= min_moved]
+    sections = [
+        ("Stability by tag", tag_df),
+        (f"Least stable words (moved at least {min_moved} times)", frequent.nsmallest(50, "stability")),
+        (f"Most stable words (moved at least {min_moved} times)", frequent.nlargest(50, "stability")),
+    ]
+    html = [
+        "<html><head><meta charset='utf-8'><title>Robustness report</title></head>",
+        "<body style='font-family: sans-serif;'>",
+        "<h1>Robustness report</h1>",
+        f"<p>{n_record} addresses in {elapsed:.1f}s. Stability is how often a word keeps "
+        "its original tag after it has been moved.</p>",
+    ]
+    for title, df in sections:
+        html.append(f"<h2>{title}</h2>")
+        html.append(df.to_html(index=False, float_format=lambda value: f"{value:.3f}"))
+    html.append("</body></html>")
+    with open(path, "w", encoding="utf-8") as file:
+        file.write("\n".join(html))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Per-token shuffle stability over an address corpus.")
+    parser.add_argument("input", help="text file with one address per line")
+    parser.add_argument("-o", "--output-dir", default="robustness_report")
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("--mode", choices=MODES, default="shuffle",
+                        help="uniform shuffles; keyword+name blocks shuffled; tokens moved at most --max-distance; "
+                             "one random token relocated; or every single-token move")
+    parser.add_argument("--shuffles", type=int, default=20, help="shuffles per address, in every mode but move")
+    parser.add_argument("--max-distance", type=int, default=MAX_DISTANCE, help="for --mode bounded")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--chunk-size", type=int, default=1000, help="addresses per checkpoint")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--min-moved", type=int, default=20, help="minimum moves for a word to be ranked")
+    args = parser.parse_args(argv)
+
+    checkpoint_dir = os.path.join(args.output_dir, "checkpoints", checkpoint_key(
+        args.input, args.model, args.mode, args.shuffles, args.seed, args.max_distance, args.chunk_size,
+    ))
+    os.makedirs(checkpoint_dir, exist_ok=True)
+
+    # Chunks already in checkpoint_dir are skipped, so rerunning the same command resumes
+    def jobs():
+        first_record = 0
+        for chunk_id, texts in enumerate(read_chunks(args.input, args.chunk_size)):
+            yield chunk_id, first_record, texts, args.mode, args.shuffles, args.seed, args.max_distance, checkpoint_dir
+            first_record += len(texts)
+
+    started = time.perf_counter()
+    chunk_paths = []
+    with Pool(args.workers, initializer=_init_worker, initargs=(args.model,)) as pool:
+        for path in pool.imap(analyze_chunk, jobs()):
+            chunk_paths.append(path)
+            print(f"\r{len(chunk_paths)} chunks done", end="", flush=True)
+    print()
+    elapsed = time.perf_counter() - started
+
+    word_df, tag_df = summarize(chunk_paths)
+    word_df.to_parquet(os.path.join(args.output_dir, "word_stability.parquet"), index=False)
+    tag_df.to_parquet(os.path.join(args.output_dir, "tag_stability.parquet"), index=False)
+    n_record = sum(1 for _ in open(args.input, encoding="utf-8"))
+    write_html(os.path.join(args.output_dir, "report.html"), word_df, tag_df, n_record, elapsed, args.min_moved)
+    print(f"{n_record} addresses in {elapsed:.1f}s, report in {args.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
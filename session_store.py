@@ -0,0 +1,142 @@
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+SESSION_BUDGET_BYTES = 8 * 2 ** 20
+MAX_IDLE_SECONDS = 30 * 60
+RECLAIM_INTERVAL_SECONDS = 60
+
+
+def payload_nbytes(value) -> int:
+    # Rough size of what we keep per session: arrays, strings and containers of them
+    if isinstance(value, np.ndarray) or hasattr(value, "nbytes"):
+        # Arrays, and holders of them such as results.ShuffleResults
+        return value.nbytes
+    if isinstance(value, str):
+        return sys.getsizeof(value)
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(payload_nbytes(item) for item in value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(payload_nbytes(k) + payload_nbytes(v) for k, v in value.items())
+    return sys.getsizeof(value)
+
+
+class SessionPayloads:
+    # Per-session key/value payloads under a byte budget, least recently used evicted first
+
+    def __init__(self, budget: int = SESSION_BUDGET_BYTES):
+        self.budget = budget
+        self.items = OrderedDict()
+        self.sizes = {}
+        self.nbytes = 0
+        self.evictions = 0
+        self.last_access = time.monotonic()
+
+    def get(self, key, default=None):
+        self.last_access = time.monotonic()
+        if key not in self.items:
+            return default
+        self.items.move_to_end(key)
+        return self.items[key]
+
+    def put(self, key, value):
+        self.last_access = time.monotonic()
+        self.pop(key)
+        size = payload_nbytes(value)
+        self.items[key] = value
+        self.sizes[key] = size
+        self.nbytes += size
+        # The newest payload always stays, even if it alone is over budget
+        while self.nbytes > self.budget and len(self.items) > 1:
+            old_key, _ = self.items.popitem(last=False)
+            self.nbytes -= self.sizes.pop(old_key)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        if key not in self.items:
+            return default
+        self.nbytes -= self.sizes.pop(key)
+        return self.items.pop(key)
+
+    def __contains__(self, key):
+        return key in self.items
+
+
+def _current_session_id() -> str:
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx is not None else "default"
+
+
+def _is_active_session(session_id: str) -> bool:
+    from streamlit.runtime import Runtime
+
+    if not Runtime.exists():
+        return True
+    return Runtime.instance().is_active_session(session_id)
+
+
+class SessionStore:
+    # Process-wide registry of SessionPayloads, so one server can see and cap
+    # what every connected analyst holds
+
+    def __init__(self, budget: int = SESSION_BUDGET_BYTES, max_idle_seconds: float = MAX_IDLE_SECONDS):
+        self.budget = budget
+        self.max_idle_seconds = max_idle_seconds
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.last_reclaim = time.monotonic()
+        self.reclaimed = 0
+
+    def session(self, session_id: str = None) -> SessionPayloads:
+        session_id = session_id or _current_session_id()
+        with self.lock:
+            payloads = self.sessions.get(session_id)
+            if payloads is None:
+                payloads = self.sessions[session_id] = SessionPayloads(self.budget)
+        if time.monotonic() - self.last_reclaim > RECLAIM_INTERVAL_SECONDS:
+            self.reclaim()
+        return payloads
+
+    def reclaim(self) -> int:
+        # Drop sessions that disconnected or have been idle too long
+        now = time.monotonic()
+        with self.lock:
+            stale = [
+                session_id for session_id, payloads in self.sessions.items()
+                if now - payloads.last_access > self.max_idle_seconds or not _is_active_session(session_id)
+            ]
+            for session_id in stale:
+                del self.sessions[session_id]
+            self.last_reclaim = now
+            self.reclaimed += len(stale)
+        return len(stale)
+
+    def total_nbytes(self) -> int:
+        with self.lock:
+            return sum(payloads.nbytes for payloads in self.sessions.values())
+
+
+session_store = SessionStore()
+
+
+def render_debug_panel(container, extra=()):
+    # extra: more caption lines from the page, e.g. telemetry
+    import streamlit as st
+
+    session = session_store.session()
+    with container.expander("Debug"):
+        st.caption(
+            f"This session: {session.nbytes / 1024:.1f} KB of {session.budget / 1024:.0f} KB, "
+            f"{len(session.items)} payloads, {session.evictions} evicted"
+        )
+        st.caption(
+            f"All sessions: {session_store.total_nbytes() / 1024:.1f} KB in {len(session_store.sessions)} sessions, "
+            f"{session_store.reclaimed} reclaimed"
+        )
+        for line in extra:
+            st.caption(line)
@@ -0,0 +1,122 @@
+import argparse
+import time
+from itertools import count, islice
+
+import numpy as np
+
+from gazetteer import ADDRESS_KEYWORDS, DISTRICT_KEYWORDS, PROVINCE_KEYWORDS, SUB_DISTRICT_KEYWORDS
+from tokenization import SPAN_DTYPE, shuffle_permutation
+
+SHUFFLE_STRATEGIES = ["uniform", "blocks", "bounded", "relocate"]
+MAX_DISTANCE = 2
+
+# A keyword and the name after it ("แขวง วังใหม่", "ถนน พญาไท") move as one block
+BLOCK_KEYWORDS = frozenset(SUB_DISTRICT_KEYWORDS + DISTRICT_KEYWORDS + PROVINCE_KEYWORDS + ADDRESS_KEYWORDS)
+
+# Every generator below is lazy and endless: one index permutation per next(),
+# nothing kept between samples. Sample k has its own counter-based stream
+# (Philox keyed by seed, counter k), so it is the same however many samples came
+# before it or who is consuming them, and costs a tenth of a fresh RandomState.
+
+
+def _sample_states(seed: int):
+    for sample in count():
+        yield np.random.Generator(np.random.Philox(key=seed, counter=[0, 0, 0, sample]))
+
+
+def keyword_blocks(tokens, keywords=BLOCK_KEYWORDS) -> np.ndarray:
+    # Start index of every block, plus len(tokens) at the end
+    starts = []
+    i = 0
+    while i < len(tokens):
+        starts.append(i)
+        i += 2 if tokens[i] in keywords and i + 1 < len(tokens) else 1
+    return np.array(starts + [len(tokens)], dtype=SPAN_DTYPE)
+
+
+def uniform_shuffles(n_token: int, seed: int = 0):
+    # Sample k is shuffle_permutation(n_token, seed + k), what the apps always drew,
+    # so existing seeds keep giving the same shuffles
+    for sample in count():
+        yield shuffle_permutation(n_token, seed=(seed + sample) % 2 ** 32)
+
+
+def block_shuffles(blocks: np.ndarray, seed: int = 0):
+    # Blocks from keyword_blocks change places; tokens inside a block keep their order
+    pieces = [np.arange(start, end, dtype=SPAN_DTYPE) for start, end in zip(blocks[:-1].tolist(), blocks[1:].tolist())]
+    for state in _sample_states(seed):
+        if not pieces:
+            yield np.empty(0, dtype=SPAN_DTYPE)
+            continue
+        yield np.concatenate([pieces[block] for block in state.permutation(len(pieces)).tolist()])
+
+
+def bounded_shuffles(n_token: int, max_distance: int = MAX_DISTANCE, seed: int = 0):
+    # No token ends up more than max_distance positions from where it started:
+    # sorting i + U[0, max_distance + 1) can only pass a token over its max_distance neighbours
+    positions = np.arange(n_token)
+    for state in _sample_states(seed):
+        keys = positions + state.uniform(0, max_distance + 1, n_token)
+        yield np.argsort(keys, kind="stable").astype(SPAN_DTYPE)
+
+
+def relocations(n_token: int, seed: int = 0):
+    # One token taken out and put back at another position, the rest in order
+    identity = np.arange(n_token, dtype=SPAN_DTYPE)
+    for state in _sample_states(seed):
+        if n_token < 2:
+            yield identity
+            continue
+        token = state.integers(n_token)
+        position = state.integers(n_token - 1)
+        position += position >= token
+        yield np.insert(np.delete(identity, token), position, token)
+
+
+def shuffle_orders(strategy: str, tokens, seed: int = 0, max_distance: int = MAX_DISTANCE):
+    if strategy == "uniform":
+        return uniform_shuffles(len(tokens), seed)
+    if strategy == "blocks":
+        return block_shuffles(keyword_blocks(tokens), seed)
+    if strategy == "bounded":
+        return bounded_shuffles(len(tokens), max_distance, seed)
+    if strategy == "relocate":
+        return relocations(len(tokens), seed)
+    raise ValueError(f"unknown shuffle strategy {strategy!r}, expected one of {SHUFFLE_STRATEGIES}")
+
+
+def main(argv=None):
+    import tracemalloc
+
+    parser = argparse.ArgumentParser(description="Draw rate and peak memory of the shuffle generators.")
+    parser.add_argument("--text", default="นายสมชาย เข็มกลัด 254 ถนน พญาไท แขวง วังใหม่ เขต ปทุมวัน กรุงเทพ 10330")
+    parser.add_argument("--samples", type=int, default=10000)
+    parser.add_argument("--max-distance", type=int, default=MAX_DISTANCE)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    tokens = args.text.split()
+    blocks = keyword_blocks(tokens)
+    print(f"{len(tokens)} tokens in {len(blocks) - 1} blocks: "
+          + " | ".join(" ".join(tokens[start:end]) for start, end in zip(blocks[:-1], blocks[1:])))
+    for strategy in SHUFFLE_STRATEGIES:
+        started = time.perf_counter()
+        distinct = set()
+        displacement = 0
+        for order in islice(shuffle_orders(strategy, tokens, args.seed, args.max_distance), args.samples):
+            distinct.add(order.tobytes())
+            displacement = max(displacement, int(np.abs(order - np.arange(len(order))).max()))
+        elapsed = time.perf_counter() - started
+        # Apart from the timing: tracemalloc slows allocation down a lot
+        tracemalloc.start()
+        for _ in islice(shuffle_orders(strategy, tokens, args.seed, args.max_distance), args.samples):
+            pass
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{strategy:<9} {args.samples / elapsed:9.0f} samples/s, {len(distinct):6d} distinct, "
+              f"max displacement {displacement:2d}, "
+              f"peak {peak / 2 ** 10:.1f} KB while drawing")
+
+
+if __name__ == "__main__":
+    main()
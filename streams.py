@@ -0,0 +1,216 @@
+import csv
+import gzip
+import io
+import json
+import mmap
+import os
+import queue
+import sys
+import threading
+import time
+
+# Compression is taken from the last suffix and the record format from the one
+# before it: addresses.csv.gz, addresses.jsonl.zst, addresses.txt
+COMPRESSIONS = {".gz": "gzip", ".zst": "zstd", ".zstd": "zstd"}
+FORMATS = {".csv": "csv", ".jsonl": "jsonl", ".ndjson": "jsonl", ".json": "jsonl"}
+TEXT_FIELD = "text"
+QUEUE_DEPTH = 4
+
+_DONE = object()
+
+
+def split_suffixes(path: str) -> tuple:
+    # (format, compression); compression is None for plain files
+    root, suffix = os.path.splitext(path.lower())
+    compression = COMPRESSIONS.get(suffix)
+    if compression is not None:
+        root, suffix = os.path.splitext(root)
+    return FORMATS.get(suffix, "text"), compression
+
+
+def _mmap_lines(path: str):
+    # Lines of an uncompressed file straight from the page cache, no read buffer copies
+    with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        for line in iter(mapped.readline, b""):
+            yield line.decode("utf-8")
+
+
+def open_lines(path: str):
+    # An iterable of text lines (newlines kept) from a file, a compressed file or stdin
+    if path == "-":
+        return sys.stdin
+    _, compression = split_suffixes(path)
+    if compression == "gzip":
+        return io.TextIOWrapper(gzip.open(path, "rb"), encoding="utf-8", newline="")
+    if compression == "zstd":
+        import pyarrow as pa
+
+        return io.TextIOWrapper(pa.CompressedInputStream(pa.OSFile(path), "zstd"), encoding="utf-8", newline="")
+    if os.path.getsize(path) == 0:
+        # mmap cannot map an empty file
+        return iter(())
+    return _mmap_lines(path)
+
+
+def read_texts(path: str, text_field: str = TEXT_FIELD):
+    # Address texts, one at a time: every line of a text file (blank lines kept so
+    # output stays aligned with input), the text_field column of a CSV with a
+    # header, or the text_field key of every JSONL object
+    record_format, _ = split_suffixes(path)
+    lines = open_lines(path)
+    try:
+        if record_format == "csv":
+            for row in csv.DictReader(lines):
+                yield row.get(text_field) or ""
+        elif record_format == "jsonl":
+            for line in lines:
+                if line.strip():
+                    yield json.loads(line).get(text_field) or ""
+        else:
+            for line in lines:
+                yield line.rstrip("\r\n")
+    finally:
+        if hasattr(lines, "close") and lines is not sys.stdin:
+            lines.close()
+
+
+def open_text_output(path: str):
+    # A text file to write to, compressed by its suffix; "-" is stdout
+    if path == "-":
+        return sys.stdout
+    _, compression = split_suffixes(path)
+    if compression == "gzip":
+        # gzip's default level 9 is several times slower to write than 6 for a slightly smaller file
+        return io.TextIOWrapper(gzip.open(path, "wb", compresslevel=6), encoding="utf-8")
+    if compression == "zstd":
+        import pyarrow as pa
+
+        return io.TextIOWrapper(pa.CompressedOutputStream(path, "zstd"), encoding="utf-8")
+    return open(path, "w", encoding="utf-8")
+
+
+class StageStats:
+    # Busy time and records of one pipeline stage; time blocked on a queue is
+    # counted as waiting instead, for stages that run on their own thread
+
+    def __init__(self, name: str):
+        self.name = name
+        self.records = 0
+        self.busy = 0.0
+        self.waiting = None
+
+    def rate(self) -> float:
+        return self.records / max(self.busy, 1e-9)
+
+    def describe(self) -> str:
+        line = f"{self.name:<12} {self.records:>9d} records {self.busy:8.2f}s busy ({self.rate():>9.0f} records/s)"
+        if self.waiting is not None:
+            line += f", {self.waiting:.2f}s waiting"
+        return line
+
+
+class Producer:
+    # Runs `iterable` on a thread into a bounded queue, so it can run ahead of its
+    # consumer by at most `depth` items and no further; errors are re-raised on the
+    # consumer's side
+
+    def __init__(self, iterable, stats: StageStats, depth: int = QUEUE_DEPTH, count=len):
+        self.iterable = iterable
+        self.stats = stats
+        self.stats.waiting = 0.0
+        self.count = count
+        self.queue = queue.Queue(maxsize=depth)
+        self.error = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        # Gives up once the consumer has stopped, so the thread never blocks forever
+        started = time.perf_counter()
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        self.stats.waiting += time.perf_counter() - started
+
+    def _run(self):
+        try:
+            iterator = iter(self.iterable)
+            while not self.stopped.is_set():
+                started = time.perf_counter()
+                item = next(iterator, _DONE)
+                self.stats.busy += time.perf_counter() - started
+                if item is _DONE:
+                    break
+                self.stats.records += self.count(item)
+                self._put(item)
+        except BaseException as error:
+            self.error = error
+        self._put(_DONE)
+
+    def __iter__(self):
+        while True:
+            item = self.queue.get()
+            if item is _DONE:
+                if self.error is not None:
+                    raise self.error
+                return
+            yield item
+
+    def close(self):
+        self.stopped.set()
+
+
+class Consumer:
+    # Calls `function` on a thread for every item put, through a bounded queue;
+    # put blocks once `depth` items are waiting, which holds the producer back
+
+    def __init__(self, function, stats: StageStats, depth: int = QUEUE_DEPTH, count=len):
+        self.function = function
+        self.stats = stats
+        self.stats.waiting = 0.0
+        self.count = count
+        self.queue = queue.Queue(maxsize=depth)
+        self.error = None
+        self.discard = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            started = time.perf_counter()
+            item = self.queue.get()
+            self.stats.waiting += time.perf_counter() - started
+            if item is _DONE:
+                return
+            if self.error is not None or self.discard:
+                # Drain without work after a failure, so put never blocks
+                continue
+            started = time.perf_counter()
+            try:
+                self.function(item)
+            except BaseException as error:
+                self.error = error
+            self.stats.busy += time.perf_counter() - started
+            self.stats.records += self.count(item)
+
+    def put(self, item) -> float:
+        # Seconds spent waiting for room in the queue
+        if self.error is not None:
+            raise self.error
+        started = time.perf_counter()
+        self.queue.put(item)
+        return time.perf_counter() - started
+
+    def close(self, discard: bool = False):
+        # Waits for everything queued to be written. With discard, what is still
+        # queued is dropped and nothing is raised, for shutting down after another error.
+        self.discard = self.discard or discard
+        if self.thread.is_alive():
+            self.queue.put(_DONE)
+            self.thread.join()
+        if self.error is not None and not discard:
+            raise self.error
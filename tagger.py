@@ -0,0 +1,275 @@
+import time
+from itertools import chain
+
+import joblib
+import numpy as np
+
+from tokenization import tokenize_spans, span_tokens
+
+MODEL_PATH = "model/model.joblib"
+
+# Same order as model.classes_
+TAGS = ["O", "ADDR", "LOC", "POST"]
+TAG_CODES = {tag: code for code, tag in enumerate(TAGS)}
+TAG_DTYPE = np.int8
+DUPLICATE_DTYPE = np.int8
+
+stopwords = ["ผู้", "ที่", "ซึ่ง", "อัน"]
+
+# Bump whenever tokens_to_features changes what it emits; stored with every trained model
+FEATURE_VERSION = 1
+
+# Groups of feature keys a feature set can switch off; bias/BOS/EOS are always kept
+FEATURE_GROUPS = {
+    "word": ["word.word"],
+    "prefix": ["word[:3]"],
+    "shape": ["word.isspace()", "word.is_stopword()", "word.isdigit()", "word.islen5"],
+    "context_words": ["-1.word.prevword", "+1.word.nextword"],
+    "context_shape": [
+        "-1.word.isspace()", "-1.word.is_stopword()", "-1.word.isdigit()",
+        "+1.word.isspace()", "+1.word.is_stopword()", "+1.word.isdigit()",
+    ],
+}
+FEATURE_SETS = {
+    "full": list(FEATURE_GROUPS),
+    "no_prefix": ["word", "shape", "context_words", "context_shape"],
+    "no_context_words": ["word", "prefix", "shape", "context_shape"],
+    "no_context": ["word", "prefix", "shape"],
+}
+_KEY_GROUPS = {key: group for group, keys in FEATURE_GROUPS.items() for key in keys}
+
+
+def tokens_to_features(tokens, i):
+    word = tokens[i]
+    features = {
+        "bias": 1.0,
+        "word.word": word,
+        "word[:3]": word[:3],
+        "word.isspace()": word.isspace(),
+        "word.is_stopword()": word in stopwords,
+        "word.isdigit()": word.isdigit(),
+        "word.islen5": word.isdigit() and len(word) == 5
+    }
+    if i > 0:
+        prevword = tokens[i - 1]
+        features.update({
+            "-1.word.prevword": prevword,
+            "-1.word.isspace()": prevword.isspace(),
+            "-1.word.is_stopword()": prevword in stopwords,
+            "-1.word.isdigit()": prevword.isdigit(),
+        })
+    else:
+        features["BOS"] = True
+    if i < len(tokens) - 1:
+        nextword = tokens[i + 1]
+        features.update({
+            "+1.word.nextword": nextword,
+            "+1.word.isspace()": nextword.isspace(),
+            "+1.word.is_stopword()": nextword in stopwords,
+            "+1.word.isdigit()": nextword.isdigit(),
+        })
+    else:
+        features["EOS"] = True
+    return features
+
+
+def sequence_features(tokens, feature_set: str = "full"):
+    # A model trained on a smaller feature set has no weights for the rest,
+    # so tagging it with the full set gives the same result
+    features = [tokens_to_features(tokens, i) for i in range(len(tokens))]
+    if feature_set == "full":
+        return features
+    groups = set(FEATURE_SETS[feature_set])
+    return [
+        {key: value for key, value in token_features.items() if key not in _KEY_GROUPS or _KEY_GROUPS[key] in groups}
+        for token_features in features
+    ]
+
+
+def load_model(path: str = MODEL_PATH):
+    return joblib.load(path)
+
+
+def encode_tags(labels) -> np.ndarray:
+    return np.fromiter((TAG_CODES[label] for label in labels), dtype=TAG_DTYPE)
+
+
+class TaggedBatch:
+    # Columnar tagging result for many records: tokens of record r are
+    # tokens[offsets[r]:offsets[r + 1]], with character spans into texts[r]
+
+    def __init__(self, texts, tokens, spans, offsets, tags, short_circuited=None,
+                 alternatives=None, margins=None, low_confidence=None, duplicates=None,
+                 marginals=None, confidence=None):
+        self.texts = texts
+        self.tokens = tokens
+        self.spans = spans
+        self.offsets = offsets
+        self.tags = tags
+        # Records fully resolved by the pre-tagger, None when no pre-tagger ran
+        self.short_circuited = short_circuited
+        # With an n-best decoder: per record (paths, scores) or None when the CRF
+        # did not run, the best-vs-runner-up score gap (NaN when it did not run)
+        # and whether that gap is under the decoder's min_margin
+        self.alternatives = alternatives
+        self.margins = margins
+        self.low_confidence = low_confidence
+        # Per record, dedup.EXACT or dedup.NEAR where the tags were copied from a
+        # repeat instead of decoded, 0 where decoded; None when nothing was deduplicated
+        self.duplicates = duplicates
+        # With a marginal decoder: (n_token, n_tag) tag marginals, one-hot where the
+        # pre-tagger decided, and per record the lowest marginal of a chosen tag
+        self.marginals = marginals
+        self.confidence = confidence
+        # consistency.Consistency of the decoded fields, when validated
+        self.consistency = None
+        # canonical.CanonicalNames of the decoded fields' LOC spans, when canonicalized
+        self.canonical = None
+
+    def __len__(self):
+        return len(self.texts)
+
+    def record_ids(self) -> np.ndarray:
+        return np.repeat(np.arange(len(self.texts)), np.diff(self.offsets))
+
+    def record_tokens(self, record: int) -> list:
+        return self.tokens[self.offsets[record]:self.offsets[record + 1]]
+
+    def record_labels(self, record: int) -> list:
+        return [TAGS[code] for code in self.tags[self.offsets[record]:self.offsets[record + 1]]]
+
+    def token_confidence(self) -> np.ndarray:
+        # Marginal of the chosen tag at every token
+        return self.marginals[np.arange(len(self.tags)), self.tags]
+
+
+def _margin(path_scores: np.ndarray) -> float:
+    return path_scores[0] - path_scores[1] if len(path_scores) > 1 else np.inf
+
+
+def tag_texts(model, texts, spans=None, pretagger=None, nbest=None, timings=None, deduplicator=None,
+              marginals=None) -> TaggedBatch:
+    # spans: precomputed token spans per text, e.g. from segmenter.Segmenter.spans
+    # pretagger: e.g. pretagger.PreTagger; the CRF only sees records it cannot resolve
+    # nbest: e.g. decoding.NBestDecoder; alternatives reuse the CRF's feature dicts
+    # timings: a dict that "features", "decode" (and "dedup") seconds are added to
+    # deduplicator: e.g. dedup.Deduplicator; repeats of records it has seen decoded are copied
+    # marginals: e.g. decoding.MarginalDecoder; decodes in place of model.predict, adding tag marginals
+    started = time.perf_counter()
+    if spans is None:
+        spans = [tokenize_spans(text) for text in texts]
+    tokens = [span_tokens(text, text_spans) for text, text_spans in zip(texts, spans)]
+
+    short_circuited = None
+    record_codes = [None] * len(texts)
+    if pretagger is None:
+        ambiguous = range(len(tokens))
+    else:
+        record_codes = [pretagger.resolve(record_tokens) for record_tokens in tokens]
+        short_circuited = np.array([codes is not None for codes in record_codes], dtype=bool)
+        ambiguous = np.flatnonzero(~short_circuited).tolist()
+
+    dedup_seconds = 0.0
+    if deduplicator is not None:
+        dedup_started = time.perf_counter()
+        # Alternatives and marginals can only be copied from an exact repeat
+        pending, copies = deduplicator.split(tokens, ambiguous, near=nbest is None and marginals is None)
+        ambiguous = [record for record, _ in pending]
+        dedup_seconds = time.perf_counter() - dedup_started
+
+    # One predict call for the whole batch
+    sequences = [sequence_features(tokens[i]) for i in ambiguous]
+    decode_started = time.perf_counter()
+    record_marginals = None
+    if marginals is not None:
+        record_marginals = [None] * len(texts)
+        predictions, decoded_marginals = marginals.decode(sequences)
+        for i, token_marginals in zip(ambiguous, decoded_marginals):
+            record_marginals[i] = token_marginals
+    else:
+        predictions = model.predict(sequences) if sequences else []
+    if pretagger is None and deduplicator is None:
+        codes = encode_tags(chain.from_iterable(predictions))
+    else:
+        for i, record_predictions in zip(ambiguous, predictions):
+            record_codes[i] = [TAG_CODES[label] for label in record_predictions]
+
+    alternatives = margins = low_confidence = None
+    if nbest is not None:
+        alternatives = [None] * len(texts)
+        margins = np.full(len(texts), np.nan, dtype=np.float32)
+        for i, sequence in zip(ambiguous, sequences):
+            paths, path_scores = alternatives[i] = nbest.decode(sequence)
+            margins[i] = _margin(path_scores)
+    decode_seconds = time.perf_counter() - decode_started
+
+    duplicates = None
+    if deduplicator is not None:
+        dedup_started = time.perf_counter()
+        for i, entry in pending:
+            entry.codes = record_codes[i]
+            entry.alternatives = alternatives[i] if alternatives is not None else None
+            entry.marginals = record_marginals[i] if record_marginals is not None else None
+        duplicates = np.zeros(len(texts), dtype=DUPLICATE_DTYPE)
+        undecided = []
+        for i, entry, kind in copies:
+            copied = deduplicator.copy(tokens[i], entry, kind)
+            if copied is None:
+                undecided.append(i)
+                continue
+            record_codes[i] = copied
+            duplicates[i] = kind
+            if alternatives is not None:
+                alternatives[i] = entry.alternatives
+                margins[i] = _margin(entry.alternatives[1])
+            if record_marginals is not None:
+                record_marginals[i] = entry.marginals
+        dedup_seconds += time.perf_counter() - dedup_started
+        if undecided:
+            # Near repeats whose differences could not be filled in safely
+            undecided_started = time.perf_counter()
+            predictions = model.predict([sequence_features(tokens[i]) for i in undecided])
+            for i, record_predictions in zip(undecided, predictions):
+                record_codes[i] = [TAG_CODES[label] for label in record_predictions]
+                deduplicator.add(tokens[i]).codes = record_codes[i]
+            decode_seconds += time.perf_counter() - undecided_started
+    if pretagger is not None or deduplicator is not None:
+        codes = np.fromiter(chain.from_iterable(record_codes), dtype=TAG_DTYPE)
+    if nbest is not None:
+        low_confidence = margins < nbest.min_margin
+    token_marginals = confidence = None
+    if marginals is not None:
+        if short_circuited is not None:
+            # The pre-tagger is taken at its word
+            for i in np.flatnonzero(short_circuited).tolist():
+                record_marginals[i] = np.eye(len(TAGS), dtype=np.float32)[record_codes[i]]
+        token_marginals = (np.concatenate(record_marginals) if record_marginals
+                           else np.empty((0, len(TAGS)), dtype=np.float32))
+        chosen = token_marginals[np.arange(len(codes)), codes]
+        lengths = np.array([len(record_tokens) for record_tokens in tokens], dtype=np.int64)
+        confidence = np.ones(len(texts), dtype=np.float32)
+        if len(chosen):
+            starts = np.r_[0, np.cumsum(lengths)[:-1]]
+            confidence[lengths > 0] = np.minimum.reduceat(chosen, starts[lengths > 0])
+    if timings is not None:
+        timings["features"] = timings.get("features", 0.0) + decode_started - started - dedup_seconds
+        timings["decode"] = timings.get("decode", 0.0) + decode_seconds
+        if deduplicator is not None:
+            timings["dedup"] = timings.get("dedup", 0.0) + dedup_seconds
+
+    offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+    np.cumsum([len(record_tokens) for record_tokens in tokens], out=offsets[1:])
+    return TaggedBatch(
+        texts=list(texts),
+        tokens=list(chain.from_iterable(tokens)),
+        spans=np.concatenate(spans) if spans else np.empty((0, 2), dtype=np.int32),
+        offsets=offsets,
+        tags=codes,
+        short_circuited=short_circuited,
+        alternatives=alternatives,
+        margins=margins,
+        low_confidence=low_confidence,
+        duplicates=duplicates,
+        marginals=token_marginals,
+        confidence=confidence,
+    )
@@ -0,0 +1,250 @@
+import argparse
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+from itertools import chain
+
+import numpy as np
+
+from tagger import MODEL_PATH, TAGS, TAG_CODES, load_model, tag_texts
+from timing import best_time
+
+TELEMETRY_DIR = "telemetry"
+CAPACITY = 4096
+FLUSH_INTERVAL_SECONDS = 60
+POLL_SECONDS = 0.05
+# Tag and unknown-word statistics look at every TOKEN_SAMPLE-th request; they
+# cost per token, latency and length per request
+TOKEN_SAMPLE = 4
+
+# Fixed bin edges, so windows flushed at different times can be added up
+LATENCY_BINS = np.geomspace(1e-5, 10, 31)
+TOKEN_BINS = np.array([0, 1, 2, 4, 6, 8, 10, 12, 16, 20, 24, 32, 48, 64, 128, 256])
+FRACTION_BINS = np.linspace(0, 1, 11)
+
+_WORD_ATTRIBUTE = "word.word:"
+
+
+def known_words(table) -> frozenset:
+    # Words the model has a word.word weight for, from weights.WeightTable
+    return frozenset(
+        attribute[len(_WORD_ATTRIBUTE):] for attribute in table.attributes if attribute.startswith(_WORD_ATTRIBUTE)
+    )
+
+
+def histogram(values: np.ndarray, bins: np.ndarray) -> dict:
+    # Values outside the edges land in the first or last bin
+    counts, _ = np.histogram(np.clip(values, bins[0], bins[-1]), bins)
+    return {"bins": bins.tolist(), "counts": counts.tolist()}
+
+
+class FileSink:
+    def __init__(self, path: str):
+        self.path = path
+
+    def write(self, window: dict):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as file:
+            file.write(json.dumps(window, ensure_ascii=False))
+            file.write("\n")
+
+
+class HttpSink:
+    def __init__(self, url: str, timeout: float = 2.0):
+        self.url = url
+        self.timeout = timeout
+
+    def write(self, window: dict):
+        import urllib.request
+
+        request = urllib.request.Request(
+            self.url,
+            data=json.dumps(window, ensure_ascii=False).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        urllib.request.urlopen(request, timeout=self.timeout).close()
+
+
+def open_sink(target: str):
+    if target.startswith(("http://", "https://")):
+        return HttpSink(target)
+    return FileSink(target)
+
+
+class Telemetry:
+    # Requests are only appended to a bounded ring buffer; counting tags and
+    # unknown words and binning happen once per flushed window, off the
+    # per-request path. A background thread flushes every flush_interval
+    # seconds, or early once the buffer is half full so nothing is overwritten.
+
+    def __init__(self, known_words, sink=None, capacity: int = CAPACITY,
+                 flush_interval: float = FLUSH_INTERVAL_SECONDS, token_sample: int = TOKEN_SAMPLE):
+        self.known_words = known_words
+        self.token_sample = token_sample
+        self.sink = sink
+        self.capacity = capacity
+        self.flush_interval = flush_interval
+        self.buffer = deque(maxlen=capacity)
+        self.lock = threading.Lock()
+        self.window_started = time.time()
+        self.last_window = None
+        # Windows the sink failed to take; telemetry never fails a request
+        self.dropped = 0
+        # Requests of a batch larger than the ring, never recorded; reported with the next window
+        self.dropped_requests = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._flush_periodically, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def _flush_periodically(self):
+        next_flush = time.monotonic() + self.flush_interval
+        while not self.stopped.wait(POLL_SECONDS):
+            if len(self.buffer) >= self.capacity // 2 or time.monotonic() >= next_flush:
+                self.flush()
+                next_flush = time.monotonic() + self.flush_interval
+
+    def close(self):
+        self.stopped.set()
+        self.flush()
+
+    def record(self, tokens, labels, seconds: float):
+        # tokens and labels are kept by reference; callers must not mutate them afterwards
+        self.buffer.append((tokens, labels, seconds))
+
+    def record_batch(self, batch, seconds: float):
+        # A tagger.TaggedBatch; its records share the batch latency evenly
+        share = seconds / max(len(batch), 1)
+        if len(self.buffer) + len(batch) > self.capacity:
+            self.flush()
+        # Only the last `capacity` records fit; the ring would push the others out unseen
+        first = max(len(batch) - self.capacity, 0)
+        if first:
+            with self.lock:
+                self.dropped_requests += first
+        for record in range(first, len(batch)):
+            start, end = batch.offsets[record], batch.offsets[record + 1]
+            self.record(batch.tokens[start:end], batch.tags[start:end], share)
+
+    def aggregate(self, requests, dropped_requests: int = 0) -> dict:
+        token_lists, label_lists, latencies = zip(*requests)
+        n_tokens = np.fromiter(map(len, token_lists), dtype=np.int64, count=len(requests))
+        latency = np.fromiter(latencies, dtype=np.float64, count=len(requests))
+
+        sample_tokens = token_lists[::self.token_sample]
+        sample_n_tokens = n_tokens[::self.token_sample]
+        sample_labels = label_lists[::self.token_sample]
+        if all(isinstance(labels, np.ndarray) and labels.dtype.kind == "i" for labels in sample_labels):
+            # Tag codes, e.g. slices of TaggedBatch.tags
+            codes = np.concatenate(sample_labels).astype(np.int64) if sample_labels else np.empty(0, dtype=np.int64)
+        else:
+            # Tag names; get(code, code) passes any codes through
+            labels = list(chain.from_iterable(sample_labels))
+            codes = np.fromiter(map(TAG_CODES.get, labels, labels), dtype=np.int64, count=len(labels))
+        known = np.fromiter(
+            map(self.known_words.__contains__, chain.from_iterable(sample_tokens)), dtype=bool, count=len(codes)
+        )
+        n_sample = len(sample_tokens)
+        record = np.repeat(np.arange(n_sample), sample_n_tokens)
+        tag_counts = np.bincount(record * len(TAGS) + codes, minlength=n_sample * len(TAGS))
+        tag_counts = tag_counts.reshape(n_sample, len(TAGS))
+        unknown_counts = sample_n_tokens - np.bincount(record, weights=known, minlength=n_sample)
+        n_safe = np.maximum(sample_n_tokens, 1)
+
+        window = {
+            "start": self.window_started,
+            "end": time.time(),
+            "requests": len(requests),
+            "dropped_requests": dropped_requests,
+            "tokens": int(n_tokens.sum()),
+            "latency_seconds": histogram(latency, LATENCY_BINS),
+            "tokens_per_request": histogram(n_tokens, TOKEN_BINS),
+            # Everything below is over the sampled requests only
+            "sampled_requests": n_sample,
+            "sampled_tokens": len(codes),
+            "tags": dict(zip(TAGS, tag_counts.sum(axis=0).tolist())),
+            "unknown_tokens": int(len(codes) - known.sum()),
+            "unknown_fraction": histogram(unknown_counts / n_safe, FRACTION_BINS),
+        }
+        for code, tag in enumerate(TAGS):
+            window[f"share_{tag}"] = histogram(tag_counts[:, code] / n_safe, FRACTION_BINS)
+        return window
+
+    def flush(self):
+        with self.lock:
+            # Drained one popleft at a time: a record() landing meanwhile stays for the next window
+            requests = [self.buffer.popleft() for _ in range(len(self.buffer))]
+            if not requests:
+                return None
+            window = self.last_window = self.aggregate(requests, self.dropped_requests)
+            self.dropped_requests = 0
+            self.window_started = window["end"]
+        if self.sink is not None:
+            try:
+                self.sink.write(window)
+            except OSError:
+                self.dropped += 1
+        return window
+
+
+def summarize_window(window: dict) -> str:
+    if window is None:
+        return "no requests yet"
+    tokens = max(window["sampled_tokens"], 1)
+    shares = ", ".join(f"{tag} {count / tokens:.0%}" for tag, count in window["tags"].items())
+    summary = f"{window['requests']} requests, {shares}, {window['unknown_tokens'] / tokens:.1%} unknown words"
+    if window.get("dropped_requests"):
+        summary += f", {window['dropped_requests']} requests dropped"
+    return summary
+
+
+def main(argv=None):
+    from fields import decode_fields
+    from weights import load_weight_table
+
+    parser = argparse.ArgumentParser(description="Overhead of request telemetry on single-address requests.")
+    parser.add_argument("input", help="text file with one address per line")
+    parser.add_argument("--model", default=MODEL_PATH)
+    parser.add_argument("-o", "--output", default=os.path.join(TELEMETRY_DIR, "benchmark.jsonl"),
+                        help="telemetry file or http(s) endpoint")
+    parser.add_argument("--repeat", type=int, default=3, help="best of N timings")
+    args = parser.parse_args(argv)
+
+    model = load_model(args.model)
+    with open(args.input, encoding="utf-8") as file:
+        texts = [text for text in (line.strip() for line in file) if text]
+    # Replayed requests arrive far faster than real ones; size the buffer so none are overwritten
+    telemetry = Telemetry(known_words(load_weight_table(model)), open_sink(args.output), capacity=2 * len(texts))
+
+    def serve():
+        # One address per request, end to end: tokens, tags and fields
+        requests = []
+        for text in texts:
+            started = time.perf_counter()
+            batch = tag_texts(model, [text])
+            decode_fields(batch)
+            requests.append((batch.tokens, batch.tags, time.perf_counter() - started))
+        return requests
+
+    def replay():
+        for request in requests:
+            telemetry.record(*request)
+        telemetry.flush()
+
+    # Timed apart and best of N: the difference of two noisy end-to-end runs is
+    # far larger than what is being measured
+    # CPU time of the whole process, so work done by the flusher thread counts too
+    requests, serve_seconds = best_time(serve, args.repeat, time.process_time)
+    _, telemetry_seconds = best_time(replay, args.repeat, time.process_time)
+    print(f"{len(requests)} requests: {serve_seconds / len(requests) * 1e6:.1f} µs serving, "
+          f"{telemetry_seconds / len(requests) * 1e6:.2f} µs telemetry per request "
+          f"({telemetry_seconds / serve_seconds:.2%} overhead)", file=sys.stderr)
+    print(summarize_window(telemetry.last_window), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
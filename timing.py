@@ -0,0 +1,11 @@
+import time
+
+
+def best_time(function, repeat: int, clock=time.perf_counter) -> tuple:
+    # (result of the last call, fastest of `repeat` calls in seconds of `clock`)
+    times = []
+    for _ in range(repeat):
+        started = clock()
+        result = function()
+        times.append(clock() - started)
+    return result, min(times)
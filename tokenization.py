@@ -0,0 +1,38 @@
+import re
+
+import numpy as np
+
+# Same tokens as str.split(): runs of non-whitespace characters
+_TOKEN_PATTERN = re.compile(r"\S+")
+
+SPAN_DTYPE = np.int32
+
+
+def tokenize_spans(text: str) -> np.ndarray:
+    # (n_token, 2) array of [start, end) character offsets into `text`
+    offsets = np.fromiter(
+        (offset for match in _TOKEN_PATTERN.finditer(text) for offset in match.span()),
+        dtype=SPAN_DTYPE,
+    )
+    return offsets.reshape(-1, 2)
+
+
+def span_tokens(text: str, spans: np.ndarray) -> list:
+    # Slice every token out of the original text once; permutations reuse these objects
+    return [text[start:end] for start, end in spans.tolist()]
+
+
+def shuffle_permutation(n_token: int, seed: int = None) -> np.ndarray:
+    # Same order as np.random.RandomState(seed).shuffle(text.split()), as an index array
+    return np.random.RandomState(seed).permutation(n_token).astype(SPAN_DTYPE)
+
+
+def permute(tokens: list, order: np.ndarray) -> list:
+    # Reorder token references without building a new text
+    return [tokens[i] for i in order.tolist()]
+
+
+def original_spans(spans: np.ndarray, order: np.ndarray) -> np.ndarray:
+    # Character range in the original text for every position of a permuted sequence
+    return spans[order]
+
@@ -0,0 +1,197 @@
+import argparse
+import itertools
+import json
+import os
+import time
+from multiprocessing import Pool
+
+import joblib
+import numpy as np
+
+from corpus import read_conll
+from metrics import confusion_matrix, macro_f1, tag_scores
+from registry import MODELS_DIR, content_hash, metadata_path
+from tagger import FEATURE_SETS, FEATURE_VERSION, TAGS, encode_tags, sequence_features
+
+CACHE_DIR = ".feature_cache"
+MAX_ITERATIONS = 100
+# Grid values around the shipped model (c1=0.154, c2=0.022)
+GRID_C1 = [0.01, 0.05, 0.15, 0.5, 1.0]
+GRID_C2 = [0.002, 0.02, 0.1, 0.5]
+# Random search draws c1 and c2 from exponentials with these scales
+RANDOM_C1_SCALE = 0.5
+RANDOM_C2_SCALE = 0.05
+
+
+def make_crf(c1: float, c2: float, max_iterations: int = MAX_ITERATIONS):
+    import sklearn_crfsuite
+
+    return sklearn_crfsuite.CRF(
+        algorithm="lbfgs",
+        c1=c1,
+        c2=c2,
+        max_iterations=max_iterations,
+        all_possible_transitions=True,
+    )
+
+
+def cached_features(cache_dir: str, corpus_digest: str, sentences, feature_set: str) -> str:
+    # Features depend only on the corpus, the extractor version and the feature set,
+    # so every trial (and every later run) with the same three reads the same file
+    path = os.path.join(cache_dir, f"{corpus_digest}-v{FEATURE_VERSION}-{feature_set}.joblib")
+    if not os.path.exists(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        features = [sequence_features(tokens, feature_set) for tokens, _ in sentences]
+        joblib.dump(features, path + ".tmp")
+        os.replace(path + ".tmp", path)
+    return path
+
+
+_features = {}
+_labels = None
+
+
+def _init_worker(labels):
+    global _labels
+    _labels = labels
+
+
+def _load_features(path: str) -> list:
+    # Each worker reads a cached feature file once
+    features = _features.get(path)
+    if features is None:
+        features = _features[path] = joblib.load(path)
+    return features
+
+
+def k_folds(n_sentence: int, k: int, seed: int) -> list:
+    order = np.random.RandomState(seed).permutation(n_sentence)
+    return [np.sort(fold) for fold in np.array_split(order, k)]
+
+
+def score_predictions(labels, predictions) -> np.ndarray:
+    return confusion_matrix(
+        encode_tags(itertools.chain.from_iterable(labels)),
+        encode_tags(itertools.chain.from_iterable(predictions)),
+    )
+
+
+def run_trial(job) -> tuple:
+    # One (parameters, fold) pair: train on the other folds, score the held-out one
+    trial_id, fold_id, params, features_path, test_index, max_iterations = job
+    features = _load_features(features_path)
+    test = set(test_index.tolist())
+    train_index = [i for i in range(len(features)) if i not in test]
+
+    crf = make_crf(params["c1"], params["c2"], max_iterations)
+    crf.fit([features[i] for i in train_index], [_labels[i] for i in train_index])
+    predictions = crf.predict([features[i] for i in test_index])
+    return trial_id, fold_id, score_predictions([_labels[i] for i in test_index], predictions)
+
+
+def search_space(args) -> list:
+    if args.search == "grid":
+        return [
+            {"c1": c1, "c2": c2, "feature_set": feature_set}
+            for feature_set in args.feature_sets for c1 in args.c1 for c2 in args.c2
+        ]
+    rng = np.random.RandomState(args.seed)
+    return [
+        {
+            "c1": float(rng.exponential(RANDOM_C1_SCALE)),
+            "c2": float(rng.exponential(RANDOM_C2_SCALE)),
+            "feature_set": args.feature_sets[rng.randint(len(args.feature_sets))],
+        }
+        for _ in range(args.trials)
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Train a CRF with a cross-validated hyperparameter search.")
+    parser.add_argument("corpus", help="CoNLL-style file: token<TAB>label per line, blank line between addresses")
+    parser.add_argument("-o", "--output", default=os.path.join(MODELS_DIR, "trained.joblib"),
+                        help="model path; metadata is written next to it as .json")
+    parser.add_argument("--search", choices=["grid", "random"], default="random")
+    parser.add_argument("--trials", type=int, default=20, help="parameter draws for random search")
+    parser.add_argument("--c1", type=float, nargs="+", default=GRID_C1, help="grid values")
+    parser.add_argument("--c2", type=float, nargs="+", default=GRID_C2, help="grid values")
+    parser.add_argument("--feature-sets", nargs="+", choices=list(FEATURE_SETS), default=["full"])
+    parser.add_argument("--folds", type=int, default=5)
+    parser.add_argument("--max-iterations", type=int, default=MAX_ITERATIONS)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--cache-dir", default=CACHE_DIR, help="extracted features, reused across trials and runs")
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    sentences = read_conll(args.corpus)
+    labels = [sentence_labels for _, sentence_labels in sentences]
+    corpus_digest = content_hash(args.corpus)
+    features_paths = {
+        feature_set: cached_features(args.cache_dir, corpus_digest, sentences, feature_set)
+        for feature_set in args.feature_sets
+    }
+    folds = k_folds(len(sentences), args.folds, args.seed)
+    space = search_space(args)
+    jobs = [
+        (trial_id, fold_id, params, features_paths[params["feature_set"]], test_index, args.max_iterations)
+        for trial_id, params in enumerate(space)
+        for fold_id, test_index in enumerate(folds)
+    ]
+    print(f"{len(sentences)} addresses, {len(space)} parameter sets x {len(folds)} folds = {len(jobs)} fits")
+
+    fold_scores = [[None] * len(folds) for _ in space]
+    counts = [np.zeros((len(TAGS), len(TAGS)), dtype=np.int64) for _ in space]
+    with Pool(args.workers, initializer=_init_worker, initargs=(labels,)) as pool:
+        for n_done, (trial_id, fold_id, fold_counts) in enumerate(pool.imap_unordered(run_trial, jobs), 1):
+            fold_scores[trial_id][fold_id] = macro_f1(fold_counts)
+            counts[trial_id] += fold_counts
+            print(f"\r{n_done}/{len(jobs)} fits", end="", flush=True)
+    print()
+    search_seconds = time.perf_counter() - started
+
+    trials = [
+        dict(params, mean_f1=float(np.mean(scores)), std_f1=float(np.std(scores)), fold_f1=scores)
+        for params, scores in zip(space, fold_scores)
+    ]
+    best_id = int(np.argmax([trial["mean_f1"] for trial in trials]))
+    best = trials[best_id]
+    print(f"best: c1={best['c1']:.4g} c2={best['c2']:.4g} feature_set={best['feature_set']} "
+          f"macro F1 {best['mean_f1']:.4f} ± {best['std_f1']:.4f}")
+
+    # Final model on the whole corpus
+    fit_started = time.perf_counter()
+    crf = make_crf(best["c1"], best["c2"], args.max_iterations)
+    crf.fit(joblib.load(features_paths[best["feature_set"]]), labels)
+    fit_seconds = time.perf_counter() - fit_started
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    joblib.dump(crf, args.output)
+    metadata = {
+        "model_hash": content_hash(args.output),
+        "feature_version": FEATURE_VERSION,
+        "feature_set": best["feature_set"],
+        "c1": best["c1"],
+        "c2": best["c2"],
+        "max_iterations": args.max_iterations,
+        "corpus": os.path.abspath(args.corpus),
+        "corpus_hash": corpus_digest,
+        "addresses": len(sentences),
+        "folds": args.folds,
+        "seed": args.seed,
+        "cv_macro_f1": best["mean_f1"],
+        "cv_macro_f1_std": best["std_f1"],
+        "cv_tag_scores": tag_scores(counts[best_id]),
+        "search": args.search,
+        "trials": trials,
+        "search_seconds": search_seconds,
+        "fit_seconds": fit_seconds,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+    with open(metadata_path(args.output), "w", encoding="utf-8") as file:
+        json.dump(metadata, file, ensure_ascii=False, indent=2)
+    print(f"model in {args.output} ({metadata['model_hash']}), metadata in {metadata_path(args.output)}")
+
+
+if __name__ == "__main__":
+    main()
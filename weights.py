@@ -0,0 +1,192 @@
+import os
+import re
+import tempfile
+
+import numpy as np
+
+from tagger import TAGS, TAG_CODES
+
+WEIGHT_DTYPE = np.float32
+
+# model.state_features_ parses the same dump line by line and breaks on
+# attributes that contain a newline (e.g. "+1.word.nextword:\n"), so entries
+# are matched up to the " --> LABEL: weight" that ends them instead
+_LABELS = "|".join(re.escape(tag) for tag in TAGS)
+_STATE_PATTERN = re.compile(rf"^  \(0\) (.*?) --> ({_LABELS}): (\S+)$", re.MULTILINE | re.DOTALL)
+_TRANSITION_PATTERN = re.compile(rf"^  \(1\) ({_LABELS}) --> ({_LABELS}): (\S+)$", re.MULTILINE)
+
+
+def feature_attributes(features: dict):
+    # The (attribute, value) pairs crfsuite sees for one token's feature dict
+    for key, value in features.items():
+        if isinstance(value, str):
+            yield f"{key}:{value}", 1.0
+        else:
+            yield key, float(value)
+
+
+class WeightTable:
+    # state[attribute_ids[attr]] holds the per-label weights of attr (in TAGS order);
+    # transitions[i, j] is the score of tag i followed by tag j
+
+    def __init__(self, attribute_ids: dict, state: np.ndarray, transitions: np.ndarray):
+        self.attribute_ids = attribute_ids
+        self.attributes = list(attribute_ids)
+        self.state = state
+        self.transitions = transitions
+
+    def lookup(self, features: dict) -> tuple:
+        # Row ids and values of the attributes the model has weights for
+        ids, values = [], []
+        for attribute, value in feature_attributes(features):
+            row = self.attribute_ids.get(attribute)
+            if row is not None and value:
+                ids.append(row)
+                values.append(value)
+        return np.array(ids, dtype=np.int64), np.array(values, dtype=WEIGHT_DTYPE)
+
+    def contributions(self, features: dict) -> tuple:
+        # (row ids, (n_attribute, n_tag) weight * value)
+        ids, values = self.lookup(features)
+        return ids, self.state[ids] * values[:, None]
+
+    def state_scores(self, sequence) -> np.ndarray:
+        # (n_token, n_tag) emission scores of a sequence of feature dicts
+        scores = np.zeros((len(sequence), len(TAGS)), dtype=WEIGHT_DTYPE)
+        for i, features in enumerate(sequence):
+            scores[i] = self.contributions(features)[1].sum(axis=0)
+        return scores
+
+
+def parse_dump(text: str) -> WeightTable:
+    attribute_ids = {}
+    state = []
+    for attribute, label, weight in _STATE_PATTERN.findall(text):
+        row = attribute_ids.get(attribute)
+        if row is None:
+            row = attribute_ids[attribute] = len(state)
+            state.append([0.0] * len(TAGS))
+        state[row][TAG_CODES[label]] = float(weight)
+
+    transitions = np.zeros((len(TAGS), len(TAGS)), dtype=WEIGHT_DTYPE)
+    for previous, label, weight in _TRANSITION_PATTERN.findall(text):
+        transitions[TAG_CODES[previous], TAG_CODES[label]] = float(weight)
+    return WeightTable(attribute_ids, np.array(state, dtype=WEIGHT_DTYPE).reshape(-1, len(TAGS)), transitions)
+
+
+def load_weight_table(model) -> WeightTable:
+    # Built once per loaded model from crfsuite's text dump
+    if isinstance(model, WeightModel):
+        return model.table
+    fd, path = tempfile.mkstemp(suffix=".txt")
+    os.close(fd)
+    try:
+        model.tagger_.dump(path)
+        with open(path, encoding="utf-8", errors="replace", newline="") as file:
+            return parse_dump(file.read())
+    finally:
+        os.remove(path)
+
+
+def viterbi(table: WeightTable, scores: np.ndarray) -> np.ndarray:
+    # Best tag codes for (n_token, n_tag) state scores
+    n_token = len(scores)
+    if not n_token:
+        return np.empty(0, dtype=np.int8)
+    best = scores[0].copy()
+    backpointers = np.empty((n_token, len(TAGS)), dtype=np.int8)
+    for i in range(1, n_token):
+        candidates = best[:, None] + table.transitions
+        backpointers[i] = candidates.argmax(axis=0)
+        best = candidates.max(axis=0) + scores[i]
+    path = np.empty(n_token, dtype=np.int8)
+    path[-1] = best.argmax()
+    for i in range(n_token - 1, 0, -1):
+        path[i - 1] = backpointers[i, path[i]]
+    return path
+
+
+def _logsumexp(values: np.ndarray, axis: int) -> np.ndarray:
+    top = values.max(axis=axis, keepdims=True)
+    return np.log(np.exp(values - top).sum(axis=axis)) + top.squeeze(axis)
+
+
+def forward_backward(scores: np.ndarray, transitions: np.ndarray) -> tuple:
+    # log Z, (n_token, n_tag) tag marginals and expected (n_tag, n_tag) transition counts
+    n_token = len(scores)
+    alpha = np.empty_like(scores)
+    beta = np.zeros_like(scores)
+    alpha[0] = scores[0]
+    for i in range(1, n_token):
+        alpha[i] = _logsumexp(alpha[i - 1][:, None] + transitions, 0) + scores[i]
+    for i in range(n_token - 2, -1, -1):
+        beta[i] = _logsumexp(transitions + (scores[i + 1] + beta[i + 1])[None, :], 1)
+    log_z = _logsumexp(alpha[-1], 0)
+    marginals = np.exp(alpha + beta - log_z)
+    pairs = alpha[:-1, :, None] + transitions[None] + (scores[1:] + beta[1:])[:, None, :] - log_z
+    return log_z, marginals, np.exp(pairs).sum(axis=0)
+
+
+class WeightModel:
+    # A model that is only a weight table, decoded with the numpy Viterbi above.
+    # retrain.py publishes these: crfsuite cannot start training from existing
+    # weights, so a warm-started model cannot be a crfsuite one. It answers
+    # predict/predict_single like sklearn_crfsuite.CRF, so it loads and tags
+    # wherever a joblib model does.
+
+    def __init__(self, table: WeightTable):
+        self.table = table
+        self.classes_ = list(TAGS)
+
+    def predict_single(self, sequence) -> list:
+        return [TAGS[code] for code in viterbi(self.table, self.table.state_scores(sequence))]
+
+    def predict(self, sequences) -> list:
+        return [self.predict_single(sequence) for sequence in sequences]
+
+
+class TokenExplanation:
+    # Why one token got `tag` rather than `runner_up`: the state features that
+    # separate the two most, and the transition scores into each from the previous tag
+
+    def __init__(self, tag: int, runner_up: int, state_scores, transition, runner_up_transition, features):
+        self.tag = tag
+        self.runner_up = runner_up
+        self.state_scores = state_scores
+        self.transition = transition
+        self.runner_up_transition = runner_up_transition
+        # [(attribute, contribution to tag, contribution to runner_up)]
+        self.features = features
+
+    @property
+    def label(self) -> str:
+        return TAGS[self.tag]
+
+    @property
+    def runner_up_label(self) -> str:
+        return TAGS[self.runner_up]
+
+
+def explain(table: WeightTable, sequence, tags, top: int = 5) -> list:
+    # sequence: feature dicts; tags: the decoded tag codes
+    explanations = []
+    for i, (features, tag) in enumerate(zip(sequence, tags)):
+        tag = int(tag)
+        ids, contributions = table.contributions(features)
+        state_scores = contributions.sum(axis=0)
+        transition_in = table.transitions[int(tags[i - 1])] if i > 0 else np.zeros(len(TAGS), dtype=WEIGHT_DTYPE)
+        # Runner-up: the best other tag for this position given the previous decision
+        local = state_scores + transition_in
+        local[tag] = -np.inf
+        runner_up = int(local.argmax())
+        margin = contributions[:, tag] - contributions[:, runner_up]
+        ranked = np.argsort(-np.abs(margin))[:top]
+        explanations.append(TokenExplanation(
+            tag,
+            runner_up,
+            state_scores,
+            float(transition_in[tag]) if i > 0 else None,
+            float(transition_in[runner_up]) if i > 0 else None,
+            [(table.attributes[ids[k]], float(contributions[k, tag]), float(contributions[k, runner_up])) for k in ranked],
+        ))
+    return explanations